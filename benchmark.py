@@ -0,0 +1,439 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import sklearn
+
+from handle_pickle import atomic_write
+from load_data import build_fold_index, get_paths, load_folds, read_keel
+from models import decision_tree, naive_bayes, random_forest
+from neighbours import SHARED_CACHE
+from profiling import current_rss, peak_rss
+from sampling import (
+    perform_adasyn,
+    perform_smote,
+    random_oversampling,
+    random_undersampling,
+)
+from umce import _SUBSET_CACHE, create_imbalanced_ensemble
+
+BASELINE_VERSION = 1
+DEFAULT_SIZES = (10**5, 10**6, 10**7)
+
+# A benchmark takes a dataset (train_df, test_df) and runs one function on it.
+# max_rows skips the synthetic datasets that would take hours to run.
+Benchmark = namedtuple("Benchmark", ["name", "func", "max_rows"])
+
+BENCHMARKS = [
+    Benchmark(
+        "random_undersampling",
+        lambda train, test: random_undersampling(train, "Class"),
+        None,
+    ),
+    Benchmark(
+        "random_oversampling",
+        lambda train, test: random_oversampling(train, "Class"),
+        None,
+    ),
+    Benchmark(
+        "perform_smote", lambda train, test: perform_smote(train, "Class"), 10**6
+    ),
+    Benchmark(
+        "perform_adasyn", lambda train, test: perform_adasyn(train, "Class"), 10**6
+    ),
+    Benchmark(
+        "random_forest", lambda train, test: random_forest([train], [test]), 10**6
+    ),
+    Benchmark(
+        "decision_tree", lambda train, test: decision_tree([train], [test]), None
+    ),
+    Benchmark("naive_bayes", lambda train, test: naive_bayes([train], [test]), None),
+    Benchmark(
+        "create_imbalanced_ensemble",
+        lambda train, test: create_imbalanced_ensemble([train], [test]),
+        10**6,
+    ),
+]
+
+BENCHMARKS_BY_NAME = {benchmark.name: benchmark for benchmark in BENCHMARKS}
+SYNTHETIC_PREFIX = "synthetic-"
+
+
+def clear_caches():
+    """
+    Empty the in-memory caches, so every run does the full work.
+    """
+    SHARED_CACHE.clear()
+    _SUBSET_CACHE.clear()
+
+
+def synthetic_dataset(n_rows, n_features=8, imbalance_ratio=9.0, random_state=42):
+    """
+    Generate an imbalanced dataset in the layout of the KEEL datasets.
+
+    The minority class is shifted from the majority class, so the models
+    have something to learn, and the labels are "positive"/"negative".
+
+    :param n_rows: int
+        The number of rows.
+    :param n_features: int, optional
+        The number of features (default is 8).
+    :param imbalance_ratio: float, optional
+        The number of majority rows per minority row (default is 9).
+    :param random_state: int, optional
+        Seed of the generator (default is 42).
+    :return: DataFrame
+        The dataset with a "Class" column.
+    """
+    rng = np.random.default_rng(random_state)
+    positive = rng.random(n_rows) < 1 / (1 + imbalance_ratio)
+    X = rng.standard_normal((n_rows, n_features))
+    X[positive] += 1.0
+
+    df = pd.DataFrame(X, columns=[f"x{i}" for i in range(n_features)])
+    df["Class"] = np.where(positive, "positive", "negative")
+    return df
+
+
+def keel_folds():
+    """
+    Find the first fold of every bundled KEEL dataset, without reading it.
+
+    :return: dict
+        Dictionary {dataset: {"fold", "train", "test"}} with the file paths.
+    """
+    folds = {}
+    for paths in get_paths():
+        first = build_fold_index(paths)[0]
+        folds[os.path.basename(os.path.dirname(first["train"]))] = first
+    return folds
+
+
+def synthetic_rows(dataset):
+    """
+    Get the number of training rows of a synthetic dataset from its name.
+
+    :param dataset: str
+        The name of the dataset, e.g. "synthetic-100000".
+    :return: int or None
+        The number of rows, or None for a KEEL dataset.
+    """
+    if not dataset.startswith(SYNTHETIC_PREFIX):
+        return None
+    return int(dataset[len(SYNTHETIC_PREFIX) :])
+
+
+def dataset_names(sizes=DEFAULT_SIZES, keel=True):
+    """
+    List the datasets to benchmark, without loading or generating them.
+
+    :param sizes: list of int, optional
+        The number of training rows of each synthetic dataset (default is
+        10^5 to 10^7).
+    :param keel: bool, optional
+        Whether to include the bundled KEEL datasets (default is True).
+    :return: list of str
+        The KEEL dataset names, then "synthetic-<size>" for every size.
+    """
+    names = list(keel_folds()) if keel else []
+    return names + [f"{SYNTHETIC_PREFIX}{size}" for size in sizes]
+
+
+def load_dataset(dataset, random_state=42):
+    """
+    Load a KEEL dataset or generate a synthetic train/test split.
+
+    :param dataset: str
+        A name as returned by dataset_names.
+    :param random_state: int, optional
+        Seed of the synthetic generator (default is 42).
+    :return: tuple
+        Tuple (train_df, test_df). A synthetic test set has a quarter of
+        the training rows.
+    """
+    size = synthetic_rows(dataset)
+    if size is None:
+        first = keel_folds()[dataset]
+        return tuple(
+            read_keel(first[split])[1].rename(columns={"class": "Class"})
+            for split in ("train", "test")
+        )
+    return (
+        synthetic_dataset(size, random_state=random_state),
+        synthetic_dataset(size // 4, random_state=random_state + 1),
+    )
+
+
+def time_call(func, *args, repeat=3):
+    """
+    Time a function over several runs.
+
+    :param func: callable
+        The function to time.
+    :param repeat: int, optional
+        Number of runs (default is 3).
+    :return: dict
+        The fastest and median wall time, the median CPU time, both in
+        seconds, the RSS before the runs, the peak RSS of the process and
+        its growth over the runs, in megabytes, and the number of runs.
+    """
+    start_rss = current_rss()
+    walls, cpus = [], []
+    for _ in range(repeat):
+        clear_caches()
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        func(*args)
+        walls.append(time.perf_counter() - start_wall)
+        cpus.append(time.process_time() - start_cpu)
+
+    peak = peak_rss()
+    return {
+        "wall_min": min(walls),
+        "wall_median": statistics.median(walls),
+        "cpu_median": statistics.median(cpus),
+        "rss_before": start_rss,
+        "peak_rss": peak,
+        "peak_rss_delta": None if None in (start_rss, peak) else peak - start_rss,
+        "repeat": repeat,
+    }
+
+
+def time_benchmark(name, dataset, repeat=3):
+    """
+    Load a dataset and time one benchmark on it.
+
+    :param name: str
+        The name of the benchmark, see BENCHMARKS.
+    :param dataset: str
+        The name of the dataset, see dataset_names.
+    :param repeat: int, optional
+        Number of runs (default is 3).
+    :return: dict
+        The timings, see time_call, and the number of training rows.
+    """
+    train, test = load_dataset(dataset)
+    timings = time_call(BENCHMARKS_BY_NAME[name].func, train, test, repeat=repeat)
+    timings["rows"] = len(train)
+    return timings
+
+
+def isolated(func, *args, **kwargs):
+    """
+    Run a function in a new process and return its result.
+
+    The peak RSS of a fresh process only covers what the function loaded
+    and ran, so every benchmark gets its own memory measurement.
+
+    :param func: callable
+        A module-level function, it is pickled by reference.
+    :return: object
+        The return value of func.
+    """
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(func, *args, **kwargs).result()
+
+
+def run_benchmarks(datasets, benchmarks=None, repeat=3, loaders=True):
+    """
+    Run the benchmarks on every dataset.
+
+    Every benchmark runs in its own process, which loads or generates its
+    dataset, so only one dataset is in memory at a time.
+
+    :param datasets: list of str
+        Names of the datasets, see dataset_names.
+    :param benchmarks: list of Benchmark, optional
+        The benchmarks to run (default is BENCHMARKS).
+    :param repeat: int, optional
+        Number of runs of every benchmark (default is 3).
+    :param loaders: bool, optional
+        Whether to also time loading the bundled KEEL files (default is True).
+    :return: dict
+        Dictionary {"<benchmark>/<dataset>": timings}.
+    """
+    benchmarks = BENCHMARKS if benchmarks is None else benchmarks
+    results = {}
+
+    if loaders:
+        paths = get_paths()
+        first = sorted(paths[0])[0]
+        results["read_keel/" + os.path.basename(first)] = isolated(
+            time_call, read_keel, first, repeat=repeat
+        )
+        results["load_folds/data_raw"] = isolated(
+            time_call, load_folds, paths, repeat=repeat
+        )
+
+    for dataset in datasets:
+        rows = synthetic_rows(dataset)
+        for benchmark in benchmarks:
+            if benchmark.max_rows is not None and (rows or 0) > benchmark.max_rows:
+                continue
+            key = f"{benchmark.name}/{dataset}"
+            print(f"Running {key}", file=sys.stderr)
+            results[key] = isolated(time_benchmark, benchmark.name, dataset, repeat)
+
+    return results
+
+
+def environment():
+    """
+    Describe the machine and library versions a baseline was recorded on.
+
+    :return: dict
+        The environment description.
+    """
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "sklearn": sklearn.__version__,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def save_baseline(results, path):
+    """
+    Save benchmark results as a JSON baseline.
+
+    :param results: dict
+        Results as returned by run_benchmarks.
+    :param path: str
+        Path of the JSON file.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    baseline = {
+        "version": BASELINE_VERSION,
+        "environment": environment(),
+        "results": results,
+    }
+    with atomic_write(path) as json_file:
+        json.dump(baseline, json_file, indent=4)
+
+
+def load_baseline(path):
+    """
+    Load the results of a JSON baseline.
+
+    :param path: str
+        Path of the JSON file.
+    :return: dict
+        Dictionary {"<benchmark>/<dataset>": timings}.
+    """
+    with open(path, "r") as json_file:
+        baseline = json.load(json_file)
+    if baseline.get("version") != BASELINE_VERSION:
+        raise ValueError(f"Unsupported baseline version in {path}")
+    return baseline["results"]
+
+
+def compare(results, baseline, threshold=0.1, measure="wall_min"):
+    """
+    Compare benchmark results against a baseline.
+
+    :param results: dict
+        The current results.
+    :param baseline: dict
+        The baseline results.
+    :param threshold: float, optional
+        Relative change above which a benchmark counts as a regression or
+        an improvement (default is 0.1, i.e. 10%).
+    :param measure: str, optional
+        The timing compared (default is "wall_min", the least noisy one).
+    :return: DataFrame
+        One row per benchmark with the baseline and current timing, their
+        ratio and a status of "regression", "improvement", "unchanged",
+        "new" or "missing".
+    """
+    rows = []
+    for key in list(baseline) + [key for key in results if key not in baseline]:
+        before = baseline.get(key, {}).get(measure)
+        after = results.get(key, {}).get(measure)
+        if before is None or after is None:
+            status = "new" if before is None else "missing"
+            ratio = None
+        else:
+            ratio = after / before if before else float("inf")
+            if ratio > 1 + threshold:
+                status = "regression"
+            elif ratio < 1 - threshold:
+                status = "improvement"
+            else:
+                status = "unchanged"
+        rows.append(
+            {
+                "benchmark": key,
+                "baseline": before,
+                "current": after,
+                "ratio": ratio,
+                "status": status,
+            }
+        )
+    return pd.DataFrame(rows).set_index("benchmark")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the sampling, training and evaluation functions."
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="*",
+        default=list(DEFAULT_SIZES),
+        help="Rows of the synthetic datasets, none to skip them.",
+    )
+    parser.add_argument("--no-keel", action="store_true", help="Skip data_raw.")
+    parser.add_argument("--only", nargs="*", help="Names of the benchmarks to run.")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--output",
+        default=os.path.join("benchmarks", "latest.json"),
+        help="Where to save the results.",
+    )
+    parser.add_argument("--compare", help="Baseline JSON to compare against.")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Run the benchmarks from the command line.
+
+    :return: int
+        Exit code, 1 if a benchmark regressed against the baseline.
+    """
+    args = parse_args(argv)
+    benchmarks = [b for b in BENCHMARKS if not args.only or b.name in args.only]
+
+    datasets = dataset_names(args.sizes, keel=not args.no_keel)
+    results = run_benchmarks(
+        datasets,
+        benchmarks,
+        repeat=args.repeat,
+        loaders=not args.no_keel and not args.only,
+    )
+    save_baseline(results, args.output)
+    print(f"Saved {len(results)} benchmarks to {args.output}")
+
+    if args.compare:
+        comparison = compare(results, load_baseline(args.compare), args.threshold)
+        print(comparison.to_string())
+        return int((comparison["status"] == "regression").any())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
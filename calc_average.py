@@ -1,37 +1,226 @@
 import os
 import json
-from collections import defaultdict
 
+import numpy as np
+import pandas as pd
+from scipy import stats
 
-def average_metrics(json_dict):
-    averaged_dict = defaultdict(dict)
+from handle_pickle import atomic_write, load_pickle, save_pickle
 
-    for dataset, models in json_dict.items():
-        for model, metrics_list in models.items():
-            averaged_metrics = defaultdict(float)
+KEYS = ["method", "dataset", "model", "fold"]
+GROUP = ["method", "dataset", "model"]
+STATISTICS = ["n", "mean", "std", "min", "max", "ci_low", "ci_high"]
+STATE_VERSION = 3
 
-            for metrics in metrics_list:
-                for metric, value in metrics.items():
-                    averaged_metrics[metric] += value
 
-            for metric, value in averaged_metrics.items():
-                averaged_metrics[metric] = value / len(metrics_list)
+def summarize(folds, confidence=0.95):
+    """
+    Reduce per-fold metrics to summary statistics per method, dataset and model.
 
-            averaged_dict[dataset][model] = dict(averaged_metrics)
+    :param folds: DataFrame
+        One row per fold with the GROUP columns and one column per metric.
+    :param confidence: float, optional
+        Level of the t-distribution confidence interval of the mean
+        (default is 0.95).
+    :return: DataFrame
+        One row per (method, dataset, model, metric) with the STATISTICS.
+        The std and interval of a single fold are NaN.
+    """
+    long = folds.melt(id_vars=KEYS, var_name="metric").dropna(subset=["value"])
+    long["value"] = long["value"].astype(np.float64)
+    grouped = long.groupby(GROUP + ["metric"], sort=False)["value"]
+    summary = grouped.agg(["count", "mean", "std", "min", "max"])
+    summary = summary.rename(columns={"count": "n"})
 
-    return dict(averaged_dict)
+    n = summary["n"].to_numpy(dtype=np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = stats.t.ppf((1 + confidence) / 2, n - 1)
+        margin = t * summary["std"].to_numpy() / np.sqrt(n)
+    summary["ci_low"] = summary["mean"] - margin
+    summary["ci_high"] = summary["mean"] + margin
+    return summary[STATISTICS].reset_index()
 
 
-def process_directory(directory_path):
-    for filename in os.listdir(directory_path):
-        if filename.endswith(".json"):
-            with open(os.path.join(directory_path, filename), "r") as file:
-                data = json.load(file)
+class StreamingAggregator:
+    """
+    Incremental summaries of the per-fold records of a result store.
 
-            averaged_data = average_metrics(data)
+    Only the lines appended to the JSONL store since the previous update are
+    read, and only the (method, dataset, model) groups they touch are
+    summarized again. The state (read offset, latest record per fold and
+    summaries) is saved next to the outputs, so updating twice without new
+    records changes nothing. Outputs are never read back as inputs. As in
+    ResultStore.export, only the latest record of a fold counts, and only
+    if it was written with the current settings of its cell.
 
-            with open(os.path.join(directory_path, f"average_{filename}"), "w") as file:
-                json.dump(averaged_data, file, indent=4)
+    :param records_path: str
+        Path to the JSONL result store.
+    :param directory: str
+        Directory of the outputs and of the saved state.
+    :param confidence: float, optional
+        Level of the confidence intervals (default is 0.95).
+    :param runs: dict, optional
+        Dictionary {(method, model): hash} of the current settings of every
+        cell, see ResultStore (default is None, every record).
+    """
+
+    def __init__(self, records_path, directory, confidence=0.95, runs=None):
+        self.records_path = records_path
+        self.directory = directory
+        self.confidence = confidence
+        self.runs = runs
+        self.state_path = os.path.join(directory, "summary_state.pkl")
+        self.state = self._load_state()
+
+    def _empty_state(self):
+        return {
+            "version": STATE_VERSION,
+            "confidence": self.confidence,
+            "runs": self.runs,
+            "offset": 0,
+            "folds": pd.DataFrame(columns=KEYS + ["run"]),
+            "summary": pd.DataFrame(columns=GROUP + ["metric"] + STATISTICS),
+        }
+
+    def _load_state(self):
+        try:
+            state = load_pickle(self.state_path)
+        except (OSError, EOFError, ValueError):
+            return self._empty_state()
+        if (
+            not isinstance(state, dict)
+            or state.get("version") != STATE_VERSION
+            or state.get("confidence") != self.confidence
+            or state.get("runs") != self.runs
+        ):
+            return self._empty_state()
+        return state
+
+    def _read_new(self):
+        # The store was replaced or truncated, start over
+        size = os.path.getsize(self.records_path)
+        if size < self.state["offset"]:
+            self.state = self._empty_state()
+
+        with open(self.records_path, "rb") as f:
+            f.seek(self.state["offset"])
+            data = f.read()
+        # A line without its newline is still being written
+        end = data.rfind(b"\n") + 1
+        self.state["offset"] += end
+
+        rows = []
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+                keys = {k: record[k] for k in KEYS}
+                rows.append({**keys, "run": record.get("run"), **record["metrics"]})
+            except (ValueError, KeyError, TypeError):
+                continue
+        return pd.DataFrame(rows)
+
+    def update(self):
+        """
+        Fold the new records into the summaries.
+
+        :return: set of tuple
+            The (method, dataset, model) groups whose summaries changed.
+        """
+        if not os.path.exists(self.records_path):
+            return set()
+        new = self._read_new()
+        if new.empty:
+            self._save_state()
+            return set()
+
+        # The last record of a fold wins, as in ResultStore.records
+        folds = pd.concat([self.state["folds"], new], ignore_index=True)
+        folds = folds.drop_duplicates(KEYS, keep="last").reset_index(drop=True)
+        changed = set(new[GROUP].itertuples(index=False, name=None))
+
+        in_changed = pd.MultiIndex.from_frame(folds[GROUP]).isin(list(changed))
+        if self.runs is not None:
+            cells = zip(folds["method"], folds["model"])
+            expected = [self.runs.get(cell) for cell in cells]
+            in_changed &= (folds["run"].to_numpy() == expected) & folds["run"].notna()
+        summary = self.state["summary"]
+        kept = ~pd.MultiIndex.from_frame(summary[GROUP]).isin(list(changed))
+        current = folds[in_changed].drop(columns="run")
+        parts = [summary[kept], summarize(current, self.confidence)]
+        self.state["summary"] = pd.concat(
+            [part for part in parts if not part.empty], ignore_index=True
+        )
+        self.state["folds"] = folds
+        self._save_state()
+        return changed
+
+    def _save_state(self):
+        os.makedirs(self.directory, exist_ok=True)
+        save_pickle(self.state, self.state_path)
+
+    def averages(self, method):
+        """
+        Get the mean of every metric of a method.
+
+        :param method: str
+            The sampling method (or "raw_data" / "umce").
+        :return: dict
+            Dictionary {dataset: {model: {metric: mean}}}, the layout of the
+            average_<method>.json files.
+        """
+        summary = self.state["summary"]
+        summary = summary[summary["method"] == method]
+        # Folds arrive in completion order, datasets are listed by name
+        summary = summary.sort_values("dataset", kind="stable")
+        result = {}
+        for row in summary.itertuples(index=False):
+            models = result.setdefault(row.dataset, {})
+            models.setdefault(row.model, {})[row.metric] = float(row.mean)
+        return result
+
+    def write(self, methods=None):
+        """
+        Write the summaries to the output directory.
+
+        Every method gets an average_<method>.json with the means, and
+        summary.csv holds all statistics.
+
+        :param methods: iterable of str, optional
+            The methods whose average files are rewritten (default is every
+            summarized method).
+        """
+        summary = self.state["summary"]
+        if methods is None:
+            methods = summary["method"].unique()
+        for method in methods:
+            path = os.path.join(self.directory, f"average_{method}.json")
+            with atomic_write(path) as json_file:
+                json.dump(self.averages(method), json_file, indent=4)
+
+        path = os.path.join(self.directory, "summary.csv")
+        with atomic_write(path) as csv_file:
+            summary.to_csv(csv_file, index=False)
+
+
+def process_directory(directory_path, runs=None):
+    """
+    Update the summaries of the result store in a results directory.
+
+    :param directory_path: str
+        The results directory holding records.jsonl.
+    :param runs: dict, optional
+        Dictionary {(method, model): hash} of the current settings of every
+        cell, see ResultStore (default is None, every record).
+    :return: set of tuple
+        The (method, dataset, model) groups whose summaries changed.
+    """
+    aggregator = StreamingAggregator(
+        os.path.join(directory_path, "records.jsonl"), directory_path, runs=runs
+    )
+    changed = aggregator.update()
+    if changed:
+        aggregator.write({method for method, _, _ in changed})
+    return changed
 
 
 if __name__ == "__main__":
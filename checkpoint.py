@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import hashlib
+
+from handle_pickle import atomic_write
+
+
+def config_hash(config):
+    """
+    Hash the settings of a run that affect its results.
+
+    :param config: dict
+        JSON-serializable run settings.
+    :return: str
+        Short hex digest of the settings.
+    """
+    encoded = json.dumps(config, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+class RunManifest:
+    """
+    Checkpoint file describing an experiment run and its progress.
+
+    The manifest records the run configuration, the number of cells
+    (method, dataset, model, fold) in the grid and how many of them are
+    finished. It is rewritten atomically, so an interrupted run always
+    leaves a readable manifest behind.
+
+    :param path: str
+        Path to the manifest JSON file.
+    :param interval: float, optional
+        Minimum number of seconds between two checkpoints (default is 10).
+    """
+
+    def __init__(self, path, interval=10.0):
+        self.path = path
+        self.interval = interval
+        self.state = None
+        self._last_write = 0.0
+
+    def load(self):
+        """
+        Load the manifest of the previous run.
+
+        :return: dict or None
+            The manifest, or None if it is missing or unreadable.
+        """
+        try:
+            with open(self.path, "r") as json_file:
+                state = json.load(json_file)
+        except (OSError, ValueError):
+            return None
+        return state if isinstance(state, dict) else None
+
+    def _write(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with atomic_write(self.path) as json_file:
+            json.dump(self.state, json_file, indent=4)
+        self._last_write = time.monotonic()
+
+    def start(self, config, total, completed):
+        """
+        Start or resume a run.
+
+        A run is resumed when the previous manifest has the same
+        configuration and did not finish.
+
+        :param config: dict
+            The settings of the run that affect its results.
+        :param total: int
+            Number of cells in the grid.
+        :param completed: int
+            Number of cells already finished.
+        :return: bool
+            Whether an interrupted run with the same configuration is resumed.
+        """
+        run = config_hash(config)
+        previous = self.load()
+        resumed = (
+            previous is not None
+            and previous.get("run") == run
+            and previous.get("status") != "finished"
+        )
+
+        now = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.state = {
+            "run": run,
+            "config": config,
+            "status": "running",
+            "started": previous["started"] if resumed else now,
+            "updated": now,
+            "total": total,
+            "completed": completed,
+        }
+        self._write()
+        return resumed
+
+    def cell_runs(self):
+        """
+        Get the hashes of the cells of the latest run.
+
+        :return: dict or None
+            Dictionary {(method, model): hash}, or None if the manifest is
+            missing or predates per-cell hashes.
+        """
+        state = self.load()
+        cells = state.get("config", {}).get("cells") if state is not None else None
+        if not isinstance(cells, list):
+            return None
+        return {(method, model): run for method, model, run in cells}
+
+    def checkpoint(self, completed, force=False):
+        """
+        Record the progress of the run.
+
+        :param completed: int
+            Number of cells finished so far.
+        :param force: bool, optional
+            Whether to write even if the last checkpoint is recent
+            (default is False).
+        """
+        self.state["completed"] = completed
+        self.state["updated"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        if force or time.monotonic() - self._last_write >= self.interval:
+            self._write()
+
+    def finish(self, completed):
+        """
+        Mark the run as finished.
+
+        :param completed: int
+            Number of cells finished.
+        """
+        self.state["status"] = "finished"
+        self.checkpoint(completed, force=True)
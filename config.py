@@ -0,0 +1,106 @@
+import json
+import argparse
+
+# Settings of an experiment run, see MachineLearning for their meaning.
+# None selects everything (datasets, models, folds) or the default value.
+# grids maps a registered model to a parameter grid, e.g.
+# {"random_forest": {"n_estimators": [10, 50, 100]}}, see register_model.
+DEFAULT_CONFIG = {
+    "reload_data": False,
+    "perform_sampling": False,
+    "raw": False,
+    "sampled": True,
+    "umce": False,
+    "umce_vote": "hard",
+    "samplers": None,
+    "datasets": None,
+    "models": None,
+    "grids": None,
+    "folds": None,
+    "seed": 42,
+    "n_jobs": None,
+    "chunksize": None,
+    "resume": True,
+    "store_predictions": True,
+    "keep_estimators": False,
+    "store_dtype": "float64",
+    "compact": False,
+    "data_dir": "dataframes",
+    "results_dir": "results",
+    "predictions_dir": "predictions",
+    "profile": False,
+    "cprofile": None,
+    "py_spy": None,
+}
+
+
+def load_config(path):
+    """
+    Load an experiment configuration from a JSON file.
+
+    Settings missing from the file keep their default value.
+
+    :param path: str
+        Path to the JSON file.
+    :return: dict
+        The complete configuration.
+    """
+    with open(path, "r") as json_file:
+        config = json.load(json_file)
+
+    unknown = sorted(set(config) - set(DEFAULT_CONFIG))
+    if unknown:
+        raise ValueError(f"Unknown settings in {path}: {', '.join(unknown)}")
+    return {**DEFAULT_CONFIG, **config}
+
+
+def _flag(value):
+    if value.lower() in ("1", "true", "yes", "on"):
+        return True
+    if value.lower() in ("0", "false", "no", "off"):
+        return False
+    raise argparse.ArgumentTypeError(f"expected true or false, got {value!r}")
+
+
+def parse_args(argv=None):
+    """
+    Build the configuration of a run from the command line.
+
+    Options given on the command line override the settings of the
+    configuration file, which override the defaults.
+
+    :param argv: list of str, optional
+        The arguments (default is sys.argv[1:]).
+    :return: dict
+        The complete configuration.
+    """
+    parser = argparse.ArgumentParser(
+        description="Run the machine learning experiments."
+    )
+    parser.add_argument("--config", help="JSON file with the run settings.")
+    for name, default in DEFAULT_CONFIG.items():
+        option = "--" + name.replace("_", "-")
+        if isinstance(default, bool):
+            parser.add_argument(option, type=_flag, metavar="BOOL")
+        elif name in ("samplers", "datasets", "models"):
+            parser.add_argument(option, nargs="+", metavar="NAME")
+        elif name == "folds":
+            parser.add_argument(
+                option,
+                type=int,
+                nargs="+",
+                metavar="FOLD",
+                help="0-based fold positions, not KEEL fold numbers.",
+            )
+        elif name == "grids":
+            parser.add_argument(option, type=json.loads, metavar="JSON")
+        elif name in ("seed", "n_jobs", "chunksize"):
+            parser.add_argument(option, type=int)
+        else:
+            parser.add_argument(option)
+
+    args = vars(parser.parse_args(argv))
+    path = args.pop("config")
+    config = load_config(path) if path else dict(DEFAULT_CONFIG)
+    config.update({name: value for name, value in args.items() if value is not None})
+    return config
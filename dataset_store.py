@@ -0,0 +1,269 @@
+import os
+import json
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from load_data import encode_labels
+
+STORE_VERSION = 3
+SPLITS = ("train", "test")
+
+
+def write_store(
+    directory, data, dtype="float64", target_column="Class", meta=None, folds=None
+):
+    """
+    Write prepared datasets to a columnar on-disk store.
+
+    Every fold is saved as one feature matrix and one int8 label vector in
+    .npy format, next to a small JSON manifest. The store is first written
+    to a temporary directory and then moved into place.
+
+    :param directory: str
+        Directory of the store.
+    :param data: dict
+        Dictionary {group: {dataset: [train_dfs, test_dfs]}}, where a group
+        is "raw_data" or the name of a sampling method.
+    :param dtype: str, optional
+        The dtype of the feature matrices, "float32" or "float64"
+        (default is "float64").
+    :param target_column: str, optional
+        The name of the target column (default is "Class").
+    :param meta: dict, optional
+        JSON-serializable settings the data was prepared with, such as the
+        sampling seed (default is None).
+    :param folds: dict, optional
+        Fold index {dataset: [{"fold", "train", "test"}]} as returned by
+        load_data.load_folds, giving the KEEL fold number and file names of
+        every stored fold (default is None).
+    :return: DatasetStore
+        The written store. Its manifest lists the datasets every group must
+        hold: those of the fold index, or else those of "raw_data".
+    """
+    temp_directory = directory + ".tmp"
+    shutil.rmtree(temp_directory, ignore_errors=True)
+
+    groups = {}
+    for group, datasets in data.items():
+        groups[group] = {}
+        for dataset, splits in datasets.items():
+            first = splits[0][0]
+            targets = [df[target_column].to_numpy() for dfs in splits for df in dfs]
+            labels = np.unique(np.concatenate(targets)).tolist()
+            entry = {
+                "columns": [c for c in first.columns if c != target_column],
+                "labels": labels,
+            }
+            dataset_directory = os.path.join(temp_directory, group, dataset)
+            os.makedirs(dataset_directory)
+
+            for split, dfs in zip(SPLITS, splits):
+                entry[split] = []
+                for index, df in enumerate(dfs):
+                    X = df[entry["columns"]].to_numpy(dtype=dtype)
+                    y = pd.Categorical(df[target_column], categories=labels).codes
+                    prefix = os.path.join(dataset_directory, f"{split}{index}")
+                    np.save(prefix + ".X.npy", np.ascontiguousarray(X))
+                    np.save(prefix + ".y.npy", y.astype(np.int8))
+                    entry[split].append(len(df))
+            groups[group][dataset] = entry
+
+    manifest = {
+        "version": STORE_VERSION,
+        "dtype": dtype,
+        "target_column": target_column,
+        "meta": meta or {},
+        "folds": folds or {},
+        "datasets": list(folds or data.get("raw_data", {})),
+        "groups": groups,
+    }
+    with open(os.path.join(temp_directory, "manifest.json"), "w") as json_file:
+        json.dump(manifest, json_file, indent=4)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(temp_directory, directory)
+    return DatasetStore(directory)
+
+
+class DatasetStore:
+    """
+    Read access to a columnar dataset store created with write_store.
+
+    Fold arrays are memory-mapped, so a process only reads the folds it
+    uses and worker processes share the pages of the same files. Folds are
+    addressed by their 0-based position in the stored lists, as are the
+    fold ids of tasks and results; folds() maps a position to its KEEL fold
+    number.
+
+    :param directory: str
+        Directory of the store.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "manifest.json"), "r") as json_file:
+            self.manifest = json.load(json_file)
+        if self.manifest.get("version") != STORE_VERSION:
+            raise ValueError(f"Unsupported dataset store version in {directory}")
+
+    @property
+    def groups(self):
+        """
+        The names of the stored groups.
+        """
+        return list(self.manifest["groups"])
+
+    @property
+    def meta(self):
+        """
+        The settings the data was prepared with.
+        """
+        return self.manifest.get("meta", {})
+
+    def is_complete(self, groups):
+        """
+        Check that groups hold every dataset with all of its folds.
+
+        A sampler that failed on a dataset while the store was written
+        leaves that dataset out of its group, which makes the store
+        incomplete.
+
+        :param groups: list of str
+            The groups to check.
+        :return: bool
+            Whether every group is stored with exactly the expected datasets
+            and fold counts.
+        """
+        expected = self.manifest.get("datasets", [])
+        for group in groups:
+            stored = self.manifest["groups"].get(group)
+            if stored is None or set(stored) != set(expected):
+                return False
+            for dataset in expected:
+                n_folds = len(self.folds(dataset)) or len(stored[dataset]["train"])
+                if any(len(stored[dataset][split]) != n_folds for split in SPLITS):
+                    return False
+        return True
+
+    def folds(self, dataset):
+        """
+        Get the fold index of a dataset.
+
+        :param dataset: str
+            The name of the dataset.
+        :return: list of dict
+            One entry {"fold", "train", "test"} per stored fold, in order,
+            so entry i holds the KEEL fold number of position i.
+        """
+        return self.manifest["folds"].get(dataset, [])
+
+    def arrays(self, group, dataset, split, index):
+        """
+        Memory-map the arrays of a single fold.
+
+        :param group: str
+            The group, "raw_data" or the name of a sampling method.
+        :param dataset: str
+            The name of the dataset.
+        :param split: str
+            "train" or "test".
+        :param index: int
+            The index of the fold.
+        :return: tuple
+            Tuple (X, y) of read-only memory-mapped arrays.
+        """
+        prefix = os.path.join(self.directory, group, dataset, f"{split}{index}")
+        X = np.load(prefix + ".X.npy", mmap_mode="r")
+        y = np.load(prefix + ".y.npy", mmap_mode="r")
+        return X, y
+
+    def frame(self, group, dataset, split, index):
+        """
+        Rebuild the DataFrame of a single fold.
+
+        :param group: str
+            The group, "raw_data" or the name of a sampling method.
+        :param dataset: str
+            The name of the dataset.
+        :param split: str
+            "train" or "test".
+        :param index: int
+            The index of the fold.
+        :return: DataFrame
+            The fold with its original column names and class labels.
+        """
+        entry = self.manifest["groups"][group][dataset]
+        X, y = self.arrays(group, dataset, split, index)
+        df = pd.DataFrame(np.array(X), columns=entry["columns"])
+        labels = np.asarray(entry["labels"])
+        if labels.dtype.kind in "iu":
+            # Encoded labels of compact folds
+            labels = labels.astype(np.int8)
+        df[self.manifest["target_column"]] = labels[y]
+        return df
+
+    def data(self, groups=None):
+        """
+        Lazy view of the store in the layout used by the experiments.
+
+        :param groups: list of str, optional
+            The groups to include (default is every group).
+        :return: dict
+            Dictionary {group: {dataset: [train_frames, test_frames]}}, where
+            the frames are only read when indexed.
+        """
+        groups = self.groups if groups is None else groups
+        return {
+            group: {
+                dataset: [StoredFrames(self, group, dataset, s) for s in SPLITS]
+                for dataset in self.manifest["groups"][group]
+            }
+            for group in groups
+        }
+
+
+class StoredFrames:
+    """
+    Lazy list of the DataFrames of one split of a stored dataset.
+
+    :param store: DatasetStore
+        The store holding the data.
+    :param group: str
+        The group, "raw_data" or the name of a sampling method.
+    :param dataset: str
+        The name of the dataset.
+    :param split: str
+        "train" or "test".
+    """
+
+    def __init__(self, store, group, dataset, split):
+        self.store = store
+        self.group = group
+        self.dataset = dataset
+        self.split = split
+
+    def __len__(self):
+        return len(self.store.manifest["groups"][self.group][self.dataset][self.split])
+
+    def arrays(self, index):
+        """
+        Get the arrays of a fold without building a DataFrame.
+
+        :param index: int
+            The index of the fold.
+        :return: tuple
+            Tuple (X, y) of the read-only memory-mapped features and the
+            labels encoded as 0/1.
+        """
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        X, codes = self.store.arrays(self.group, self.dataset, self.split, index)
+        labels = self.store.manifest["groups"][self.group][self.dataset]["labels"]
+        return X, encode_labels(np.asarray(labels))[codes]
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.store.frame(self.group, self.dataset, self.split, index)
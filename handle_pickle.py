@@ -1,16 +1,49 @@
+import os
+import uuid
 import pickle
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_write(file_path, mode="w"):
+    """
+    Open a file for writing so that it is replaced only once fully written.
+
+    The data goes to a uniquely named temporary file in the same directory,
+    which is moved over file_path when the block exits without an error, so
+    readers never see a truncated file and concurrent writers never share a
+    temporary file.
+
+    :param file_path: str
+        Path to the file to write.
+    :param mode: str, optional
+        Mode of the temporary file, "w" or "wb" (default is "w").
+    :return: file object
+        The open temporary file.
+    """
+    temp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(temp_path, mode) as file:
+            yield file
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
 
 
 def save_pickle(obj, file_path):
     """
     Save an object to a file in pickle format.
 
+    The file is written atomically, see atomic_write.
+
     :param obj: object
         The object to be saved.
     :param file_path: str
         Path to the file where the object will be saved.
     """
-    with open(file_path, "wb") as file:
+    with atomic_write(file_path, "wb") as file:
         pickle.dump(obj, file)
 
 
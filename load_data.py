@@ -1,64 +1,190 @@
 import pandas as pd
+import numpy as np
 import os
-import arff
 import re
-import tempfile
 
+# Integers are read as float64, as the arff loader did, so a missing "?"
+# value becomes NaN instead of failing the int64 conversion
+NUMERIC_TYPES = {"real": np.float64, "numeric": np.float64, "integer": np.float64}
 
-def remove_range_specification(arff_file):
+# KEEL fold files end with the fold number and tra/tst, e.g. ecoli1-5-3tst.dat
+FOLD_FILE = re.compile(r"-(\d+)(tra|tst)\.dat$")
+SPLIT_NAMES = {"tra": "train", "tst": "test"}
+
+
+def encode_labels(y):
     """
-    Removes range specifications in an arff file.
+    Map the "positive"/"negative" class labels to 1/0.
 
-    :param arff_file: str
-        Path to the arff file.
-    :return: str
-        Path to the temporary file created.
+    :param y: array-like
+        The class labels, either as strings or already encoded.
+    :return: ndarray
+        The encoded labels.
     """
-    with open(arff_file, "r") as f:
-        lines = f.readlines()
+    values = np.asarray(y)
+    if values.dtype.kind in "OUS":
+        return (values == "positive").astype(np.int8)
+    return values.astype(np.int8)
+
 
-    new_lines = []
-    for line in lines:
-        if line.startswith("@attribute"):
-            line = re.sub(r"\[.*?\]", "", line)
-        new_lines.append(line)
+def compact_frame(df, target_column="Class"):
+    """
+    Convert a fold to compact dtypes.
+
+    :param df: DataFrame
+        The fold with numeric features.
+    :param target_column: str, optional
+        The name of the target column (default is "Class").
+    :return: DataFrame
+        The fold with the features as one float32 block and the labels
+        encoded as int8 (1 for "positive", 0 otherwise).
+    """
+    features = df.drop(target_column, axis=1)
+    compact = pd.DataFrame(
+        features.to_numpy(dtype=np.float32), columns=features.columns
+    )
+    compact[target_column] = encode_labels(df[target_column])
+    return compact
 
-    temp = tempfile.NamedTemporaryFile(delete=False)
-    with open(temp.name, "w") as f:
-        f.writelines(new_lines)
 
-    return temp.name
+def parse_attribute(line):
+    """
+    Parse an @attribute line of a KEEL file.
 
+    Range specifications such as [1.5, 2.5] are ignored.
 
-def load_files_into_dataframes(file_paths):
+    :param line: str
+        The @attribute line.
+    :return: tuple
+        Tuple (name, dtype), where dtype is a numpy type for numeric
+        attributes and object for nominal ones.
     """
-    Load arff files into pandas DataFrames.
+    body = re.sub(r"\[.*?\]", "", line.strip()[len("@attribute") :]).strip()
+    if "{" in body:
+        name = body[: body.index("{")].strip()
+        return name, object
 
-    :param file_paths: list
-        List of file paths to the arff files.
-    :return: dict
-        Dictionary where keys are relation names and values are lists of dataframes.
+    name, kind = body.rsplit(None, 1)
+    return name.strip(), NUMERIC_TYPES.get(kind.lower(), object)
+
+
+def read_keel(path):
     """
-    dataframes = {}
+    Read a KEEL .dat file into a pandas DataFrame in a single pass.
 
-    for dir_paths in file_paths:
-        dir_dataframes = []
+    The header is parsed line by line and the @data section is streamed
+    straight into typed columns, without rewriting the file.
 
-        for path in dir_paths:
-            temp_path = remove_range_specification(path)
-            with open(temp_path, "r") as f:
-                data_dict = arff.load(f)
+    :param path: str
+        Path to the KEEL file.
+    :return: tuple
+        Tuple (relation, DataFrame).
+    """
+    relation = None
+    attributes = []
+
+    with open(path, "r") as f:
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            keyword = line.strip().lower()
+            if keyword.startswith("@relation"):
+                relation = line.strip()[len("@relation") :].strip()
+            elif keyword.startswith("@attribute"):
+                attributes.append(parse_attribute(line))
+            elif keyword.startswith("@data"):
+                break
+
+        names = [name for name, _ in attributes]
+        df = pd.read_csv(
+            f,
+            header=None,
+            names=names,
+            dtype=dict(attributes),
+            skipinitialspace=True,
+            na_values="?",
+            comment="%",
+        )
+
+    return relation, df
+
+
+def parse_fold_file(path):
+    """
+    Parse the fold number and split from the name of a KEEL fold file.
 
-            df = pd.DataFrame(
-                data_dict["data"], columns=[i[0] for i in data_dict["attributes"]]
-            )
-            if "Class" not in df.columns:
-                # Rename the specific column
-                df = df.rename(columns={"class": "Class"})
-            dir_dataframes.append(df)
-        dataframes[data_dict["relation"]] = dir_dataframes
+    :param path: str
+        Path to the KEEL file, e.g. ".../ecoli1-5-3tst.dat".
+    :return: tuple
+        Tuple (fold, split), where split is "train" or "test".
+    """
+    match = FOLD_FILE.search(os.path.basename(path))
+    if match is None:
+        raise ValueError(f"Not a KEEL fold file: {path}")
+    return int(match.group(1)), SPLIT_NAMES[match.group(2)]
+
+
+def build_fold_index(dir_paths):
+    """
+    Pair the train and test files of a dataset by their fold number.
 
-    return dataframes
+    :param dir_paths: list of str
+        Paths to the KEEL files of one dataset.
+    :return: list of dict
+        One entry {"fold", "train", "test"} per fold, sorted by fold
+        number, with the paths of the train and test file.
+    """
+    folds = {}
+    for path in dir_paths:
+        fold, split = parse_fold_file(path)
+        if split in folds.setdefault(fold, {}):
+            raise ValueError(f"Duplicate {split} file for fold {fold}: {path}")
+        folds[fold][split] = path
+
+    index = []
+    for fold in sorted(folds):
+        missing = {"train", "test"} - set(folds[fold])
+        if missing:
+            raise ValueError(f"Fold {fold} has no {missing.pop()} file")
+        index.append({"fold": fold, **folds[fold]})
+    return index
+
+
+def load_folds(file_paths):
+    """
+    Load KEEL fold files as explicitly paired train and test folds.
+
+    :param file_paths: list
+        List of lists of file paths, one list per dataset, as returned by
+        get_paths.
+    :return: tuple
+        Tuple (data, folds), where data is a dictionary {relation: [train_dfs,
+        test_dfs]} with the folds in the order of their numbers, and folds is
+        a dictionary {relation: fold index} with the file names of the folds.
+    """
+    data, folds = {}, {}
+
+    for dir_paths in file_paths:
+        index = build_fold_index(dir_paths)
+        splits = {"train": [], "test": []}
+        for entry in index:
+            for split in splits:
+                relation, df = read_keel(entry[split])
+                if "Class" not in df.columns:
+                    df = df.rename(columns={"class": "Class"})
+                splits[split].append(df)
+        data[relation] = [splits["train"], splits["test"]]
+        folds[relation] = [
+            {
+                "fold": entry["fold"],
+                "train": os.path.basename(entry["train"]),
+                "test": os.path.basename(entry["test"]),
+            }
+            for entry in index
+        ]
+
+    return data, folds
 
 
 def get_paths():
@@ -72,14 +198,14 @@ def get_paths():
 
     dir_file_paths = []
 
-    for subdir in os.listdir(main_raw_path):
+    for subdir in sorted(os.listdir(main_raw_path)):
         subdir_path = os.path.join(main_raw_path, subdir)
 
         if os.path.isdir(subdir_path):
             subdir_file_paths = []
 
             for root, directories, files in os.walk(subdir_path):
-                for filename in files:
+                for filename in sorted(files):
                     filepath = os.path.join(root, filename)
                     subdir_file_paths.append(filepath)
 
@@ -1,116 +1,509 @@
 import os
 import json
-from load_data import get_paths, load_files_into_dataframes
-from sampling import (
-    random_undersampling,
-    random_oversampling,
-    perform_smote,
-    perform_adasyn,
-)
-from handle_pickle import save_pickle, load_pickle
-from models import random_forest, decision_tree, naive_bayes
+from contextlib import ExitStack
+from load_data import compact_frame, get_paths, load_folds
+from sampling import SAMPLERS
+from neighbours import SHARED_CACHE
+from config import DEFAULT_CONFIG, parse_args
+from handle_pickle import atomic_write, save_pickle, load_pickle
+from sample_cache import SampleCache
+from model_store import ModelStore, model_config, recompute_metrics
+from dataset_store import DatasetStore, write_store
+from models import ESTIMATORS, register_model
+from scheduler import build_tasks, run_tasks, skip_completed
+from result_store import ResultStore
+from checkpoint import RunManifest, config_hash
+from profiling import PROFILER, cprofile, py_spy, stage
 from umce import create_imbalanced_ensemble
+from calc_average import process_directory
 
 
 class MachineLearning:
     """
     Class for running Machine Learning experiments.
 
+    The settings can be given in a JSON configuration file, see
+    config.DEFAULT_CONFIG and from_config.
+
     :param reload_data: bool, optional
         Whether to reload data from the source files (default is False).
     :param perform_sampling: bool, optional
-        Whether to perform sampling on the datasets (default is False).
+        Whether to recompute every sampled dataset instead of reusing the
+        cached ones (default is False). Missing entries are always computed.
+    :param datasets: list of str, optional
+        Names of the datasets to run (default is None, every dataset).
+    :param models: list of str, optional
+        Names of the models to run (default is None, every registered model,
+        including the variants registered from the grids of the
+        configuration).
+    :param folds: list of int, optional
+        0-based positions of the folds to run, not KEEL fold numbers
+        (default is None, every fold).
+    :param seed: int, optional
+        Seed passed to the sampling methods (default is 42).
+    :param n_jobs: int, optional
+        Number of worker processes for the experiments (default is the
+        number of CPUs).
+    :param chunksize: int, optional
+        Number of tasks sent to a worker at once (default is chosen
+        automatically).
+    :param store_predictions: bool, optional
+        Whether to store the per-fold predictions, so finished folds are
+        not retrained and metrics can be recomputed (default is True).
+    :param keep_estimators: bool, optional
+        Whether to also store the fitted models (default is False).
+    :param resume: bool, optional
+        Whether to skip the cells already in the result store for the same
+        run configuration (default is True).
+    :param umce_vote: str, optional
+        Voting rule of the UMCE ensembles, "hard", "soft" or "weighted"
+        (default is "hard").
+    :param store_dtype: str, optional
+        The dtype of the features in the dataset store (default is "float64").
+    :param compact: bool, optional
+        Whether to keep the features as float32 and the labels as int8 from
+        loading onwards, for the samplers, the store and the models. This
+        roughly halves the memory used (default is False).
+    :param data_dir: str, optional
+        Directory of the datasets, the sample cache and the dataset store
+        (default is "dataframes").
+    :param results_dir: str, optional
+        Directory of the results (default is "results").
+    :param predictions_dir: str, optional
+        Directory of the stored predictions (default is "predictions").
+    :param profile: bool, optional
+        Whether to print a summary of the time and memory used per stage
+        and save the stage records to results/profile.json (default is
+        False).
+    :param cprofile: str, optional
+        Path of a cProfile statistics file for the whole run (default is
+        None, no cProfile).
+    :param py_spy: str, optional
+        Path of a py-spy flame graph for the run and its workers (default
+        is None, no py-spy).
     """
 
     def __init__(self):
         self.reload_data = False
         self.perform_sampling = False
         self.umce = False
+        self.umce_vote = "hard"
         self.raw = False
         self.sampled = True
-        self.functions = [
-            random_undersampling,
-            random_oversampling,
-            perform_smote,
-            perform_adasyn,
-        ]
+        self.resume = True
+        self.datasets = None
+        self.models = None
+        self.folds = None
+        self.seed = 42
+        self.n_jobs = os.cpu_count()
+        self.chunksize = None
+        self.store_predictions = True
+        self.keep_estimators = False
+        self.store_dtype = "float64"
+        self.compact = False
+        self.profile = False
+        self.cprofile = None
+        self.py_spy = None
+        self.data_dir = "dataframes"
+        self.results_dir = "results"
+        self.predictions_dir = "predictions"
+        self.functions = list(SAMPLERS.values())
         self.function_names = [func.__name__ for func in self.functions]
 
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create an experiment from a configuration.
+
+        :param config: dict
+            The settings of the run, see config.DEFAULT_CONFIG. Missing
+            settings keep their default value.
+        :return: MachineLearning
+            The configured experiment.
+        """
+        config = {**DEFAULT_CONFIG, **config}
+        unknown = sorted(set(config) - set(DEFAULT_CONFIG))
+        if unknown:
+            raise ValueError(f"Unknown settings: {', '.join(unknown)}")
+        for name, grid in (config.pop("grids") or {}).items():
+            if name not in ESTIMATORS:
+                raise ValueError(f"Unknown models: {name}")
+            register_model(name, ESTIMATORS[name], grid)
+        for name, registry in (("samplers", SAMPLERS), ("models", ESTIMATORS)):
+            missing = [item for item in config[name] or [] if item not in registry]
+            if missing:
+                raise ValueError(f"Unknown {name}: {', '.join(missing)}")
+
+        obj = cls()
+        samplers = config.pop("samplers") or list(SAMPLERS)
+        obj.functions = [SAMPLERS[name] for name in samplers]
+        obj.function_names = list(samplers)
+        obj.n_jobs = config.pop("n_jobs") or obj.n_jobs
+        for name, value in config.items():
+            setattr(obj, name, value)
+        return obj
+
+    def select(self, datasets):
+        """
+        Keep only the selected datasets of a group.
+
+        :param datasets: dict
+            Dictionary {dataset: [train_dfs, test_dfs]}.
+        :return: dict
+            The selected datasets, in their original order.
+        """
+        if self.datasets is None:
+            return datasets
+        missing = sorted(set(self.datasets) - set(datasets))
+        if missing:
+            raise ValueError(f"Unknown datasets: {', '.join(missing)}")
+        return {name: dfs for name, dfs in datasets.items() if name in self.datasets}
+
+    def grid(self, dfs, sampled_dfs):
+        """
+        Collect the datasets of the enabled raw and sampled methods.
+
+        :param dfs: dict
+            The raw datasets.
+        :param sampled_dfs: list of dict
+            The sampled datasets, one dictionary per sampler.
+        :return: dict
+            Dictionary {method: {dataset: [train_dfs, test_dfs]}}.
+        """
+        grid = {}
+        if self.raw:
+            grid["raw_data"] = dfs
+        if self.sampled:
+            grid.update(zip(self.function_names, sampled_dfs))
+        return grid
+
+    def cells(self, tasks, dfs, models, folds=None):
+        """
+        Collect the cells evaluated by tasks and by UMCE, if enabled.
+
+        :param tasks: list of Task
+            The tasks of the raw and sampled methods.
+        :param dfs: dict
+            The raw datasets UMCE is evaluated on.
+        :param models: list of str
+            Names of the models UMCE uses.
+        :param folds: list of int, optional
+            Indices of the UMCE folds (default is every fold).
+        :return: set of tuple
+            Set of (method, dataset, model, fold).
+        """
+        cells = {
+            (task.method, task.dataset, model, task.fold)
+            for task in tasks
+            for model in task.models
+        }
+        if self.umce:
+            cells.update(
+                ("umce", dataset, model, fold)
+                for dataset, train_test in dfs.items()
+                for model in models
+                for fold in range(len(train_test[0]))
+                if folds is None or fold in folds
+            )
+        return cells
+
+    def fold_indices(self, n_folds):
+        """
+        Get the indices of the selected folds of a dataset.
+
+        :param n_folds: int
+            The number of folds of the dataset.
+        :return: list of int
+            The selected fold indices.
+        """
+        return [f for f in range(n_folds) if self.folds is None or f in self.folds]
+
     def main(self):
         """
         Main function to run the machine learning experiments.
+
+        The run is wrapped in the profiling hooks that are enabled.
+        """
+        with ExitStack() as hooks:
+            if self.cprofile:
+                hooks.enter_context(cprofile(self.cprofile))
+            if self.py_spy:
+                hooks.enter_context(py_spy(self.py_spy))
+            self.experiments()
+
+        if self.profile:
+            PROFILER.report(self.results_path("profile.json"))
+
+    def experiments(self):
+        """
+        Run the experiments of every enabled method.
+
+        Progress is checkpointed in results/run_manifest.json. When resume is
+        set, a restarted run only evaluates the cells (method, dataset, model,
+        fold) that are missing or invalid in the result store. The summaries
+        are updated at the end, once the store holds every cell of the full
+        grid for this configuration, so a run restricted to some datasets,
+        models or folds does not replace the averages with its subset.
         """
-        dfs, sampled_dfs = self.load()
-        dfs, sampled_dfs = self.prep_data(dfs, sampled_dfs)
+        with stage("load_store"):
+            all_dfs, all_sampled_dfs = self.load_store()
+        dfs = self.select(all_dfs)
+        sampled_dfs = [self.select(datasets) for datasets in all_sampled_dfs]
+        models = list(ESTIMATORS) if self.models is None else list(self.models)
+        runs = self.cell_runs()
+        config = self.run_config(runs)
+        results = ResultStore(self.results_path("records.jsonl"), runs)
+        manifest = RunManifest(self.results_path("run_manifest.json"))
+
+        grid = self.grid(dfs, sampled_dfs)
+        tasks = build_tasks(grid, models, self.folds)
+        cells = self.cells(tasks, dfs, models, self.folds)
+        full_grid = self.grid(all_dfs, all_sampled_dfs)
+        full_cells = self.cells(build_tasks(full_grid), all_dfs, list(ESTIMATORS))
+
+        completed = results.completed() & cells if self.resume else set()
+        if manifest.start(config, len(cells), len(completed)):
+            print(f"Resuming run: {len(completed)}/{len(cells)} cells done")
+
+        def checkpoint(keys):
+            completed.update(keys)
+            manifest.checkpoint(len(completed))
 
         # umce
         if self.umce:
-            results_umce = {}
             for dataset_name, train_test in dfs.items():
-                metrics_rf, metrics_dt, metrics_nb = create_imbalanced_ensemble(
-                    train_test[0], train_test[1]
+                keys = [cell for cell in cells if cell[:2] == ("umce", dataset_name)]
+                if all(key in completed for key in keys):
+                    continue
+                folds = self.fold_indices(len(train_test[0]))
+                with stage("umce", dataset=dataset_name):
+                    metrics, times = create_imbalanced_ensemble(
+                        train_test[0],
+                        train_test[1],
+                        vote=self.umce_vote,
+                        models=models,
+                        n_jobs=self.n_jobs,
+                        folds=folds,
+                        random_state=self.seed,
+                        store=self.model_store(),
+                    )
+                results.append(
+                    [
+                        {
+                            "method": "umce",
+                            "dataset": dataset_name,
+                            "model": model,
+                            "fold": fold,
+                            "metrics": fold_metrics,
+                            "timings": fold_times,
+                        }
+                        for model, model_metrics, model_times in zip(
+                            models, metrics, times
+                        )
+                        for fold, fold_metrics, fold_times in zip(
+                            folds, model_metrics, model_times
+                        )
+                    ]
                 )
-                dict_temp = {
-                    "random_forest": metrics_rf,
-                    "decision_tree": metrics_dt,
-                    "naive_bayes": metrics_nb,
-                }
-                results_umce[dataset_name] = dict_temp
-                self.save_json_results("umce", results_umce)
+                checkpoint(keys)
+            self.export_results(results, "umce", dfs)
 
-        # raw data
-        if self.raw:
-            results_raw = {}
-            for dataset_name, train_test in dfs.items():
-                dict_temp = {
-                    "random_forest": random_forest(train_test[0], train_test[1]),
-                    "decision_tree": decision_tree(train_test[0], train_test[1]),
-                    "naive_bayes": naive_bayes(train_test[0], train_test[1]),
+        # raw data and sampled [{dataset1: [[train_dfs], [test_dfs]]}, {}, {}, {}]
+        if grid:
+            self.run(grid, results, tasks, completed, checkpoint)
+            for method, datasets in grid.items():
+                self.export_results(results, method, datasets)
+
+        if full_cells <= results.completed():
+            with stage("aggregate"):
+                process_directory(
+                    os.path.join(os.getcwd(), self.results_dir), runs=results.runs
+                )
+        else:
+            print("Averages not updated: the full grid of this run is incomplete")
+        manifest.finish(len(completed))
+
+    def run(self, data, results, tasks=None, completed=None, checkpoint=None):
+        """
+        Run every model on every fold of the given datasets in parallel.
+
+        Cells already completed are skipped, and every finished fold is
+        appended to the result store right away.
+
+        :param data: dict
+            Dictionary {method: {dataset: [train_dfs, test_dfs]}}.
+        :param results: ResultStore
+            The store the results are written to.
+        :param tasks: list of Task, optional
+            The tasks to run (default is the whole grid of data).
+        :param completed: set of tuple, optional
+            Cells (method, dataset, model, fold) to skip (default is none).
+        :param checkpoint: callable, optional
+            Called with the keys of the cells of every finished task.
+        :return: dict
+            Dictionary {method: {dataset: {model: [fold metrics]}}} for the
+            folds run in this call.
+        """
+        tasks = build_tasks(data) if tasks is None else tasks
+        tasks = skip_completed(tasks, completed or set())
+
+        def callback(task, fold_metrics, fold_timings):
+            results.append_task(task, fold_metrics, fold_timings)
+            if checkpoint is not None:
+                checkpoint(
+                    [(task.method, task.dataset, m, task.fold) for m in fold_metrics]
+                )
+
+        print(f"Running {len(tasks)} tasks on {self.n_jobs} workers")
+        return run_tasks(
+            tasks,
+            data,
+            n_jobs=self.n_jobs,
+            chunksize=self.chunksize,
+            seed=self.seed,
+            store=self.model_store(),
+            callback=callback,
+        )
+
+    def cell_runs(self):
+        """
+        Hash the settings every (method, model) cell depends on.
+
+        A cell depends on the seed and the data settings, on the method and
+        the configuration of its own model, and on the vote rule only for
+        UMCE. Changing a setting therefore only reruns the cells it affects.
+
+        :return: dict
+            Dictionary {(method, model): hash}.
+        """
+        shared = {
+            "seed": self.seed,
+            "store_dtype": self.store_dtype,
+            "compact": self.compact,
+        }
+        runs = {}
+        for method in ["raw_data", *self.function_names, "umce"]:
+            for name, estimator in ESTIMATORS.items():
+                settings = {
+                    **shared,
+                    "method": method,
+                    "model": model_config(estimator()),
                 }
-                results_raw[dataset_name] = dict_temp
-            self.save_json_results("raw_data", results_raw)
+                if method == "umce":
+                    settings["umce_vote"] = self.umce_vote
+                runs[(method, name)] = config_hash(settings)
+        return runs
 
-        # sampled [{dataset1: [[train_dfs], [test_dfs]]}, {}, {}, {}]
-        if self.sampled:
-            results = {
-                "random_undersampling": {},
-                "random_oversampling": {},
-                "perform_smote": {},
-                "perform_adasyn": {},
-            }
+    def run_config(self, runs=None):
+        """
+        Collect the settings that affect the results of a run.
 
-            for sampling_method, data in zip(self.function_names, sampled_dfs):
-                print(sampling_method)
-                for dataset, values in data.items():
-                    train_dfs = values[0]
-                    test_dfs = values[1]
-                    dict_temp = {
-                        "random_forest": random_forest(train_dfs, test_dfs),
-                        "decision_tree": decision_tree(train_dfs, test_dfs),
-                        "naive_bayes": naive_bayes(train_dfs, test_dfs),
-                    }
-                    results[sampling_method][dataset] = dict_temp
-            for method, result in results.items():
-                self.save_json_results(f"{method}", result)
+        :param runs: dict, optional
+            The hashes of the cells, see cell_runs (default is to compute
+            them).
+        :return: dict
+            The seed, UMCE vote, store dtype, model configurations and the
+            hash of every cell as [method, model, hash].
+        """
+        runs = self.cell_runs() if runs is None else runs
+        return {
+            "seed": self.seed,
+            "umce_vote": self.umce_vote,
+            "store_dtype": self.store_dtype,
+            "compact": self.compact,
+            "models": {name: model_config(est()) for name, est in ESTIMATORS.items()},
+            "cells": [[method, model, run] for (method, model), run in runs.items()],
+        }
 
-    def prep_data(self, dfs, sampled_dfs):
+    def results_path(self, filename):
         """
-        Prepare the datasets for the machine learning experiments.
+        Get the path of a file in the results directory.
+
+        :param filename: str
+            The name of the file.
+        :return: str
+            The path of the file.
+        """
+        return os.path.join(os.getcwd(), self.results_dir, filename)
+
+    def export_results(self, results, method, datasets):
+        """
+        Export the stored results of a method to results/<method>.json.
+
+        :param results: ResultStore
+            The store holding the results.
+        :param method: str
+            The sampling method (or "raw_data" / "umce").
+        :param datasets: dict
+            The datasets of the method, used to order the output.
+        """
+        with stage("export", method=method):
+            result = results.export(
+                method, datasets=list(datasets), models=list(ESTIMATORS)
+            )
+            self.save_json_results(method, result)
+
+    def model_store(self):
+        """
+        Open the store of the per-fold predictions.
+
+        :return: ModelStore or None
+            The store, or None if storing predictions is disabled.
+        """
+        if not self.store_predictions:
+            return None
+        return ModelStore(
+            os.path.join(os.getcwd(), self.predictions_dir),
+            keep_estimators=self.keep_estimators,
+        )
+
+    def recompute_results(self):
+        """
+        Rewrite the JSON results from the stored predictions without retraining.
+        """
+        store = ModelStore(os.path.join(os.getcwd(), self.predictions_dir))
+        results = recompute_metrics(store, models=list(ESTIMATORS))
+        for method, result in results.items():
+            self.save_json_results(method, result)
+
+    def load_store(self):
+        """
+        Load the prepared datasets from the columnar dataset store.
+
+        The store is rebuilt from the raw and sampled datasets when it is
+        missing, prepared with another seed or dtype, when a group lacks a
+        dataset or fold, or when reloading or resampling is requested.
 
-        :param dfs: dict
-            Dictionary containing the raw datasets.
-        :param sampled_dfs: list
-            List of dictionaries containing the sampled datasets.
         :return: tuple
-            Tuple containing the prepared raw and sampled datasets.
+            Tuple containing the prepared raw and sampled datasets, as lazy
+            views on the memory-mapped store.
         """
-        new_d = {k: [v[i::2] for i in range(2)] for k, v in dfs.items()}
-        new_sampled = []
-        for item in sampled_dfs:
-            temp = {k: [v[i::2] for i in range(2)] for k, v in item.items()}
-            new_sampled.append(temp)
+        store_path = os.path.join(os.getcwd(), self.data_dir, "store")
+        groups = ["raw_data"] + self.function_names
+        meta = {"seed": self.seed, "compact": self.compact}
+        dtype = "float32" if self.compact else self.store_dtype
+
+        store = None
+        if not (self.reload_data or self.perform_sampling):
+            try:
+                store = DatasetStore(store_path)
+            except (OSError, ValueError):
+                store = None
+        if (
+            store is None
+            or not store.is_complete(groups)
+            or store.meta != meta
+            or store.manifest["dtype"] != dtype
+        ):
+            dfs, sampled_dfs, folds = self.load()
+            data = {"raw_data": dfs, **dict(zip(self.function_names, sampled_dfs))}
+            with stage("write_store"):
+                store = write_store(
+                    store_path, data, dtype=dtype, meta=meta, folds=folds
+                )
 
-        return new_d, new_sampled
+        data = store.data(groups)
+        return data["raw_data"], [data[name] for name in self.function_names]
 
     def save_json_results(self, filename, data):
         """
@@ -121,59 +514,83 @@ class MachineLearning:
         :param data: dict
             The results data to be saved.
         """
-        result_path = os.path.join(os.getcwd(), "results")
-        path = os.path.join(result_path, filename + ".json")
+        path = self.results_path(filename + ".json")
 
-        with open(path, "w") as json_file:
+        # An interrupted run never leaves a truncated JSON file behind
+        with atomic_write(path) as json_file:
             json.dump(data, json_file, indent=4)
 
     def load(self):
         """
-        Load raw and sampled datasets.
+        Load raw datasets and sample them through the sample cache.
+
+        The train and test files are paired by the fold number in their
+        names. The paired folds and the fold index are saved together in
+        folds.pkl and only read from the KEEL files again when reloading.
 
         :return: tuple
-            Tuple containing raw and sampled datasets.
+            Tuple containing the raw datasets, the sampled datasets and the
+            fold index, with datasets as {dataset: [train_dfs, test_dfs]}.
         """
         cwd = os.getcwd()
-        df_path = os.path.join(cwd, "dataframes")
-        data_path = os.path.join(df_path, "data.pkl")
-        pre_sample, post_sample = "data_", ".pkl"
+        df_path = os.path.join(cwd, self.data_dir)
+        data_path = os.path.join(df_path, "folds.pkl")
 
-        if self.reload_data:
+        if self.reload_data or not os.path.exists(data_path):
             raw_file_paths = get_paths()
-            dfs = load_files_into_dataframes(raw_file_paths)
-            save_pickle(dfs, data_path)
+            with stage("load_files"):
+                dfs, folds = load_folds(raw_file_paths)
+            os.makedirs(df_path, exist_ok=True)
+            save_pickle({"data": dfs, "folds": folds}, data_path)
         else:
-            dfs = load_pickle(data_path)
-
-        if self.perform_sampling:
-            sampled_dfs = []
-            for func in self.functions:
-                updated_structure = {}
-                for name, dataframes in dfs.items():
-                    try:
-                        updated_dataframes = [func(df, "Class") for df in dataframes]
-                        updated_structure[name] = updated_dataframes
-                    except Exception as err:
-                        print(err)
-                        print(name, func)
-                sampled_dfs.append(updated_structure)
-            for f_name, data in zip(self.function_names, sampled_dfs):
-                save_pickle(
-                    data, os.path.join(df_path, pre_sample + f_name + post_sample)
-                )
-        else:
-            sampled_dfs = []
-            for f_name in self.function_names:
-                sampled_dfs.append(
-                    load_pickle(
-                        os.path.join(df_path, pre_sample + f_name + post_sample)
-                    )
-                )
+            stored = load_pickle(data_path)
+            dfs, folds = stored["data"], stored["folds"]
+        if self.compact:
+            dfs = {
+                name: [[compact_frame(df) for df in split] for split in splits]
+                for name, splits in dfs.items()
+            }
+
+        cache = SampleCache(os.path.join(df_path, "cache"))
+        SHARED_CACHE.clear()
+        sampled_dfs = [{} for _ in self.functions]
+        for name, splits in dfs.items():
+            sampled = [[[], []] for _ in self.functions]
+            # Every sampler runs on a fold before the next fold is sampled,
+            # so the neighbour graphs of SMOTE are still cached for ADASYN
+            for entry, fold_dfs in zip(folds[name], zip(*splits)):
+                for i, (split, df) in enumerate(zip(("train", "test"), fold_dfs)):
+                    for func, outputs in zip(self.functions, sampled):
+                        try:
+                            with stage("sampling", method=func.__name__, dataset=name):
+                                # The file name identifies the fold in the cache
+                                outputs[i].append(
+                                    cache.get_or_compute(
+                                        df,
+                                        name,
+                                        entry[split],
+                                        func,
+                                        "Class",
+                                        refresh=self.perform_sampling,
+                                        random_state=self.seed,
+                                    )
+                                )
+                        except Exception as err:
+                            # A skipped dataset would silently drop out of every run
+                            raise RuntimeError(
+                                f"{func.__name__} failed on dataset {name}"
+                            ) from err
+            for structure, outputs in zip(sampled_dfs, sampled):
+                structure[name] = outputs
 
-        return dfs, sampled_dfs
+        if SHARED_CACHE.misses:
+            print(
+                f"Neighbour graphs: {SHARED_CACHE.misses} fitted, "
+                f"{SHARED_CACHE.hits} reused"
+            )
+        return dfs, sampled_dfs, folds
 
 
 if __name__ == "__main__":
-    obj = MachineLearning()
+    obj = MachineLearning.from_config(parse_args())
     obj.main()
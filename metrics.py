@@ -0,0 +1,197 @@
+import numpy as np
+
+METRIC_NAMES = (
+    "accuracy",
+    "balanced_accuracy",
+    "precision",
+    "recall",
+    "f1_score",
+    "classification_error",
+    "auc_roc",
+    "pr_auc",
+)
+
+
+def _ratio(numerator, denominator):
+    # Same convention as zero_division=0 in sklearn, elementwise for batches
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    out = np.zeros(np.broadcast(numerator, denominator).shape)
+    return np.divide(numerator, denominator, out=out, where=denominator != 0)
+
+
+def metrics_from_confusion(tn, fp, fn, tp, auc_roc=None, pr_auc=None):
+    """
+    Derive the evaluation metrics from binary confusion matrices.
+
+    All arguments may be scalars or arrays holding one value per group.
+    Without the areas, they are those of the hard predictions: the ROC
+    curve has a single threshold, so its area equals the balanced accuracy,
+    and the average precision is precision * recall + (1 - recall) * the
+    share of positives.
+
+    :param tn: int or ndarray
+        Number of true negatives.
+    :param fp: int or ndarray
+        Number of false positives.
+    :param fn: int or ndarray
+        Number of false negatives.
+    :param tp: int or ndarray
+        Number of true positives.
+    :param auc_roc: float or ndarray, optional
+        Area under the ROC curve of the scores (default is None).
+    :param pr_auc: float or ndarray, optional
+        Average precision of the scores (default is None).
+    :return: dict
+        The evaluation metrics.
+    """
+    accuracy = _ratio(tp + tn, tn + fp + fn + tp)
+    precision = _ratio(tp, tp + fp)
+    recall = _ratio(tp, tp + fn)
+    specificity = _ratio(tn, tn + fp)
+    balanced_accuracy = (recall + specificity) / 2
+    if auc_roc is None:
+        auc_roc = balanced_accuracy
+    if pr_auc is None:
+        prevalence = _ratio(tp + fn, tn + fp + fn + tp)
+        pr_auc = precision * recall + (1 - recall) * prevalence
+
+    return {
+        "accuracy": accuracy,
+        "balanced_accuracy": balanced_accuracy,
+        "precision": precision,
+        "recall": recall,
+        "f1_score": _ratio(2 * tp, 2 * tp + fp + fn),
+        "classification_error": 1 - accuracy,
+        "auc_roc": auc_roc,
+        "pr_auc": pr_auc,
+    }
+
+
+def ranking_metrics(y_true, y_score, groups, n_groups):
+    """
+    Compute ROC-AUC and average precision of many groups from one sort.
+
+    The samples are sorted by group and decreasing score once. Cumulative
+    true and false positives at the end of every block of tied scores give
+    both areas, with ties handled as in sklearn's roc_auc_score and
+    average_precision_score. Groups without positives or without negatives
+    get an area of 0.
+
+    :param y_true: ndarray
+        The true labels (0 or 1).
+    :param y_score: ndarray
+        The scores of the positive class.
+    :param groups: ndarray
+        The group (e.g. fold and model) of every sample, from 0 to n_groups-1.
+    :param n_groups: int
+        The number of groups.
+    :return: tuple
+        Tuple (auc_roc, pr_auc) of arrays with one value per group.
+    """
+    order = np.lexsort((-y_score, groups))
+    y, score, group = y_true[order], y_score[order], groups[order]
+
+    positives = np.bincount(groups, weights=y_true, minlength=n_groups)
+    negatives = np.bincount(groups, minlength=n_groups) - positives
+    # Cumulative counts restart at the first sample of every group
+    tp = np.cumsum(y) - np.concatenate(([0], np.cumsum(positives)[:-1]))[group]
+    fp = np.cumsum(1 - y) - np.concatenate(([0], np.cumsum(negatives)[:-1]))[group]
+
+    # Last sample of every block of equal scores within a group
+    last = np.ones(len(y), dtype=bool)
+    last[:-1] = (group[1:] != group[:-1]) | (score[1:] != score[:-1])
+    tp, fp, group = tp[last], fp[last], group[last]
+    first = np.ones(len(group), dtype=bool)
+    first[1:] = group[1:] != group[:-1]
+    block_tp = np.where(first, tp, tp - np.roll(tp, 1))
+    block_fp = np.where(first, fp, fp - np.roll(fp, 1))
+
+    # Negatives of a block rank below the earlier positives, ties count half
+    auc = np.bincount(group, weights=block_fp * (tp - block_tp / 2), minlength=n_groups)
+    precision = tp / (tp + fp)
+    ap = np.bincount(group, weights=block_tp * precision, minlength=n_groups)
+    return _ratio(auc, positives * negatives), _ratio(ap, positives)
+
+
+def batch_metrics(y_true, y_pred, y_score=None, groups=None, n_groups=None):
+    """
+    Compute all evaluation metrics of many groups in one pass.
+
+    :param y_true: array-like
+        The true labels (0 or 1).
+    :param y_pred: array-like
+        The predicted labels (0 or 1).
+    :param y_score: array-like, optional
+        The scores of the positive class, used for ROC-AUC and PR-AUC
+        (default is None, the areas of the hard predictions).
+    :param groups: array-like, optional
+        The group of every sample, from 0 to n_groups-1 (default is None,
+        a single group).
+    :param n_groups: int, optional
+        The number of groups (default is the largest group + 1).
+    :return: dict
+        Dictionary {metric: array with one value per group}.
+    """
+    y_true = np.asarray(y_true, dtype=np.int64)
+    y_pred = np.asarray(y_pred, dtype=np.int64)
+    if groups is None:
+        groups = np.zeros(len(y_true), dtype=np.int64)
+    groups = np.asarray(groups, dtype=np.int64)
+    if n_groups is None:
+        n_groups = int(groups.max()) + 1 if len(groups) else 0
+
+    counts = np.bincount(4 * groups + 2 * y_true + y_pred, minlength=4 * n_groups)
+    tn, fp, fn, tp = counts.reshape(n_groups, 4).T
+    areas = {}
+    if y_score is not None:
+        y_score = np.asarray(y_score, dtype=np.float64)
+        areas["auc_roc"], areas["pr_auc"] = ranking_metrics(
+            y_true, y_score, groups, n_groups
+        )
+    return metrics_from_confusion(tn, fp, fn, tp, **areas)
+
+
+def evaluate_many(evaluations):
+    """
+    Compute the metrics of many predictions with a single batch.
+
+    :param evaluations: list of tuple
+        Tuples (y_true, y_pred, y_score), e.g. one per fold and model, where
+        y_score may be None.
+    :return: list of dict
+        The evaluation metrics of every tuple, in order.
+    """
+    if not evaluations:
+        return []
+    y_true = np.concatenate([np.asarray(e[0]) for e in evaluations])
+    y_pred = np.concatenate([np.asarray(e[1]) for e in evaluations])
+    # Hard predictions stand in for missing scores
+    y_score = np.concatenate(
+        [np.asarray(e[1] if e[2] is None else e[2], np.float64) for e in evaluations]
+    )
+    sizes = [len(e[0]) for e in evaluations]
+    groups = np.repeat(np.arange(len(evaluations)), sizes)
+
+    batch = batch_metrics(y_true, y_pred, y_score, groups, len(evaluations))
+    return [
+        {name: float(values[i]) for name, values in batch.items()}
+        for i in range(len(evaluations))
+    ]
+
+
+def binary_metrics(y_true, y_pred, y_score=None):
+    """
+    Compute all evaluation metrics for binary predictions.
+
+    :param y_true: array-like
+        The true labels (0 or 1).
+    :param y_pred: array-like
+        The predicted labels (0 or 1).
+    :param y_score: array-like, optional
+        The scores of the positive class, used for ROC-AUC and PR-AUC
+        (default is None, the areas of the hard predictions).
+    :return: dict
+        The evaluation metrics.
+    """
+    return evaluate_many([(y_true, y_pred, y_score)])[0]
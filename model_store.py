@@ -0,0 +1,242 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from handle_pickle import atomic_write, load_pickle, save_pickle
+from metrics import evaluate_many
+from neighbours import fingerprint
+
+# Bump to invalidate every stored fold, e.g. after changing how models are seeded
+STORE_VERSION = 2
+
+
+def model_config(estimator):
+    """
+    Describe an estimator by its class and hyperparameters.
+
+    :param estimator: object
+        An sklearn estimator.
+    :return: dict
+        The class name and the parameters of the estimator.
+    """
+    params = {name: repr(value) for name, value in estimator.get_params().items()}
+    return {"class": type(estimator).__name__, "params": params}
+
+
+def fold_fingerprint(X_train, y_train, X_test, y_test):
+    """
+    Compute a content hash of the arrays of a fold.
+
+    :return: str
+        Hex digest of the training and testing features and labels.
+    """
+    digest = hashlib.sha256()
+    for array in (X_train, y_train, X_test, y_test):
+        digest.update(fingerprint(array).encode())
+    return digest.hexdigest()
+
+
+def store_key(method, dataset, fold, model, config, data=None, seed=None):
+    """
+    Build the key of a stored fold.
+
+    The key covers the content of the fold and the training seed, so a
+    rebuilt dataset store (another sampling seed, compact mode or changed
+    raw data) or another run seed never gets the predictions of a
+    different run.
+
+    :param method: str
+        The name of the sampling method (or "raw_data").
+    :param dataset: str
+        The name of the dataset.
+    :param fold: int
+        The index of the fold in the dataset.
+    :param model: str
+        The name of the model.
+    :param config: dict
+        The model configuration, see model_config.
+    :param data: str, optional
+        Fingerprint of the fold arrays, see fold_fingerprint.
+    :param seed: int, optional
+        The seed the model is trained with.
+    :return: str
+        The key of the stored fold.
+    """
+    payload = {
+        "version": STORE_VERSION,
+        "method": method,
+        "dataset": dataset,
+        "fold": fold,
+        "model": model,
+        "config": config,
+        "data": data,
+        "seed": seed,
+    }
+    encoded = json.dumps(payload, sort_keys=True).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class ModelStore:
+    """
+    On-disk store of per-fold predictions and, optionally, fitted models.
+
+    Each entry holds the true labels, the predicted labels and the predicted
+    probabilities of the positive class, so metrics can be recomputed
+    without retraining.
+
+    :param directory: str
+        Directory where the entries are stored.
+    :param keep_estimators: bool, optional
+        Whether to also pickle the fitted estimators (default is False).
+    """
+
+    def __init__(self, directory, keep_estimators=False):
+        self.directory = directory
+        self.keep_estimators = keep_estimators
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key, extension=".npz"):
+        """
+        Get the path of an entry.
+
+        :param key: str
+            The key of the entry.
+        :param extension: str, optional
+            ".npz" for the predictions or ".pkl" for the estimator.
+        :return: str
+            Path to the file of the entry.
+        """
+        return os.path.join(self.directory, key[:2], key + extension)
+
+    def save(self, key, meta, y_true, y_pred, y_score=None, estimator=None):
+        """
+        Save the predictions of a fitted model atomically.
+
+        :param key: str
+            The key of the entry, see store_key.
+        :param meta: dict
+            The method, dataset, fold, model and config of the entry.
+        :param y_true: ndarray
+            The true labels.
+        :param y_pred: ndarray
+            The predicted labels.
+        :param y_score: ndarray, optional
+            The predicted probabilities of the positive class.
+        :param estimator: object, optional
+            The fitted estimator, saved only if keep_estimators is set.
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        if self.keep_estimators and estimator is not None:
+            estimator_path = self.path(key, ".pkl")
+            save_pickle(estimator, estimator_path)
+
+        arrays = {"y_true": y_true, "y_pred": y_pred}
+        if y_score is not None:
+            arrays["y_score"] = y_score
+        with atomic_write(path, "wb") as npz_file:
+            np.savez(npz_file, meta=np.array(json.dumps(meta)), **arrays)
+
+    def load(self, key):
+        """
+        Load the predictions of an entry.
+
+        :param key: str
+            The key of the entry.
+        :return: dict or None
+            Dictionary with "meta", "y_true", "y_pred" and "y_score" (None
+            if not stored), or None if the entry is missing or invalid.
+        """
+        try:
+            with np.load(self.path(key)) as entry:
+                return {
+                    "meta": json.loads(entry["meta"].item()),
+                    "y_true": entry["y_true"],
+                    "y_pred": entry["y_pred"],
+                    "y_score": entry["y_score"] if "y_score" in entry else None,
+                }
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def load_estimator(self, key):
+        """
+        Load the fitted estimator of an entry.
+
+        :param key: str
+            The key of the entry.
+        :return: object or None
+            The fitted estimator, or None if it was not stored.
+        """
+        try:
+            return load_pickle(self.path(key, ".pkl"))
+        except OSError:
+            return None
+
+    def keys(self):
+        """
+        List the keys of all stored entries.
+
+        :return: list of str
+            The keys, sorted.
+        """
+        keys = []
+        for _, _, files in os.walk(self.directory):
+            for filename in files:
+                if filename.endswith(".npz") and ".tmp" not in filename:
+                    keys.append(filename[: -len(".npz")])
+        return sorted(keys)
+
+
+def recompute_metrics(store, models=None, metric_func=None):
+    """
+    Recompute the metrics of every stored fold without retraining.
+
+    :param store: ModelStore
+        The store holding the predictions.
+    :param models: list of str, optional
+        Names of the models to include, in the order they should appear in
+        the results (default is every stored model, sorted by name).
+    :param metric_func: callable, optional
+        Called as metric_func(y_true, y_pred) and returning a dict of
+        metrics (default is None, all folds are evaluated in one batch with
+        metrics.evaluate_many, using the stored scores).
+    :return: dict
+        Dictionary {method: {dataset: {model: [fold metrics]}}}.
+    """
+    entries = [store.load(key) for key in store.keys()]
+    # The UMCE subset entries hold one row of predictions per subset
+    entries = [
+        entry
+        for entry in entries
+        if entry is not None and entry["meta"].get("kind") != "subsets"
+    ]
+    if models is None:
+        models = sorted({entry["meta"]["model"] for entry in entries})
+    order = {name: rank for rank, name in enumerate(models)}
+    entries = [entry for entry in entries if entry["meta"]["model"] in order]
+    entries.sort(
+        key=lambda e: (
+            e["meta"]["method"],
+            e["meta"]["dataset"],
+            order[e["meta"]["model"]],
+            e["meta"]["fold"],
+        )
+    )
+
+    if metric_func is None:
+        all_metrics = evaluate_many(
+            [(e["y_true"], e["y_pred"], e["y_score"]) for e in entries]
+        )
+    else:
+        all_metrics = [metric_func(e["y_true"], e["y_pred"]) for e in entries]
+
+    results = {}
+    for entry, metrics in zip(entries, all_metrics):
+        meta = entry["meta"]
+        datasets = results.setdefault(meta["method"], {})
+        folds = datasets.setdefault(meta["dataset"], {}).setdefault(meta["model"], [])
+        folds.append(metrics)
+    return results
@@ -1,16 +1,361 @@
+import zlib
+from functools import partial
+
+import numpy as np
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.naive_bayes import GaussianNB
-from sklearn.metrics import (
-    accuracy_score,
-    precision_score,
-    recall_score,
-    f1_score,
-    roc_auc_score,
-    balanced_accuracy_score,
-)
+from sklearn.model_selection import ParameterGrid
 from sklearn.preprocessing import StandardScaler
 
+from metrics import evaluate_many
+from load_data import encode_labels
+from model_store import fold_fingerprint, model_config, store_key
+from profiling import stage, timings
+
+ESTIMATORS = {
+    "random_forest": RandomForestClassifier,
+    "decision_tree": DecisionTreeClassifier,
+    "naive_bayes": GaussianNB,
+}
+
+# Base model and parameters of every model registered from a grid
+VARIANTS = {}
+
+
+def variant_name(name, params):
+    """
+    Build the name of a model with specific parameters.
+
+    :param name: str
+        The name of the base model.
+    :param params: dict
+        The parameters of the variant.
+    :return: str
+        Name such as "random_forest[max_depth=5,n_estimators=50]", or the
+        base name if there are no parameters.
+    """
+    if not params:
+        return name
+    values = ",".join(f"{key}={value}" for key, value in sorted(params.items()))
+    return f"{name}[{values}]"
+
+
+def register_model(name, estimator, grid=None):
+    """
+    Register an estimator so it is evaluated alongside the default models.
+
+    :param name: str
+        The name used for the model in the results.
+    :param estimator: callable
+        Callable returning a new unfitted sklearn estimator.
+    :param grid: dict or list of dict, optional
+        Parameter grid {param: [values]} in the format of sklearn's
+        ParameterGrid. Every combination is registered as its own model,
+        named with variant_name (default is None, a single model).
+    :return: list of str
+        The names of the registered models.
+    """
+    if not grid:
+        ESTIMATORS[name] = estimator
+        return [name]
+
+    names = []
+    for params in ParameterGrid(grid):
+        variant = variant_name(name, params)
+        ESTIMATORS[variant] = partial(estimator, **params)
+        VARIANTS[variant] = (name, params)
+        names.append(variant)
+    return names
+
+
+def sweep_groups(models):
+    """
+    Group the models that can share one incrementally grown ensemble.
+
+    Variants of an estimator with warm_start that only differ in
+    n_estimators form one group, ordered by n_estimators. Every other model
+    is a group of its own.
+
+    :param models: list of str
+        Names of the models.
+    :return: list of tuple
+        Tuples (seed_name, names), where seed_name is the name all models
+        of the group derive their random seed from.
+    """
+    groups = {}
+    for name in models:
+        base, params = VARIANTS.get(name, (name, {}))
+        key = name
+        if "n_estimators" in params and "warm_start" in ESTIMATORS[name]().get_params():
+            rest = {k: v for k, v in params.items() if k != "n_estimators"}
+            key = variant_name(base, rest)
+        groups.setdefault(key, []).append(name)
+
+    def size(name):
+        return VARIANTS.get(name, (name, {}))[1].get("n_estimators", 0)
+
+    return [(key, sorted(names, key=size)) for key, names in groups.items()]
+
+
+def feature_dtype(df, target_column="Class"):
+    """
+    Pick the dtype of the feature arrays of a fold.
+
+    :param df: DataFrame
+        The fold.
+    :param target_column: str, optional
+        The name of the target column (default is "Class").
+    :return: type
+        np.float32 if every feature is already float32 (compact mode),
+        np.float64 otherwise.
+    """
+    dtypes = df.dtypes.drop(target_column)
+    return np.float32 if (dtypes == np.float32).all() else np.float64
+
+
+def fold_arrays(data, target_column="Class"):
+    """
+    Get the features and encoded labels of one side of a fold.
+
+    Neither input is modified. Arrays are only copied when their dtype has
+    to change, so memory-mapped store arrays are read without a copy.
+
+    :param data: DataFrame or tuple
+        A DataFrame, or a tuple (X, y) of arrays such as the one returned by
+        StoredFrames.arrays.
+    :param target_column: str, optional
+        The name of the target column of a DataFrame (default is "Class").
+    :return: tuple
+        Tuple (X, y), with float32 (compact) or float64 features and the
+        labels encoded as 0/1.
+    """
+    if isinstance(data, tuple):
+        X, y = data
+        dtype = np.float32 if X.dtype == np.float32 else np.float64
+        return np.asarray(X, dtype=dtype), encode_labels(y)
+    X = data.drop(target_column, axis=1).to_numpy(
+        dtype=feature_dtype(data, target_column)
+    )
+    return X, encode_labels(data[target_column])
+
+
+def fold_input(frames, index):
+    """
+    Get one fold of a list of folds in the cheapest available form.
+
+    :param frames: list of DataFrame or StoredFrames
+        The folds of one split of a dataset.
+    :param index: int
+        The index of the fold.
+    :return: DataFrame or tuple
+        The memory-mapped arrays (X, y) of a stored fold, or the DataFrame.
+    """
+    if hasattr(frames, "arrays"):
+        return frames.arrays(index)
+    return frames[index]
+
+
+def iter_folds(train_dfs, test_dfs, folds=None):
+    """
+    Lazily yield the folds of a dataset, one at a time.
+
+    Only the fold being processed is held in memory, and the fold lists are
+    not modified.
+
+    :param train_dfs: list of DataFrame or StoredFrames
+        The training folds.
+    :param test_dfs: list of DataFrame or StoredFrames
+        The testing folds.
+    :param folds: list of int, optional
+        Indices of the folds to yield (default is every fold).
+    :return: generator
+        Tuples (train, test) as returned by fold_input.
+    """
+    if folds is None:
+        folds = range(min(len(train_dfs), len(test_dfs)))
+    for index in folds:
+        yield fold_input(train_dfs, index), fold_input(test_dfs, index)
+
+
+def prepare_fold(train_df, test_df, target_column="Class"):
+    """
+    Split a fold into standardized features and encoded labels.
+
+    :param train_df: DataFrame or tuple
+        The training dataset, or its arrays (X, y).
+    :param test_df: DataFrame or tuple
+        The testing dataset, or its arrays (X, y).
+    :param target_column: str, optional
+        The name of the target column (default is "Class").
+    :return: tuple
+        Tuple (X_train, y_train, X_test, y_test) of arrays. Compact folds
+        keep their float32 features, others are converted to float64.
+    """
+    X_train, y_train = fold_arrays(train_df, target_column)
+    X_test, y_test = fold_arrays(test_df, target_column)
+    X_test = X_test.astype(X_train.dtype, copy=False)
+
+    # Standardize the features
+    sc = StandardScaler()
+    X_train = sc.fit_transform(X_train)
+    X_test = sc.transform(X_test)
+
+    return X_train, y_train, X_test, y_test
+
+
+def predict_scores(model, X_test):
+    """
+    Predict the probability of the positive class, if the model supports it.
+
+    :param model: object
+        A fitted sklearn estimator.
+    :param X_test: ndarray
+        The testing features.
+    :return: ndarray or None
+        The predicted probabilities of the positive class.
+    """
+    if not hasattr(model, "predict_proba"):
+        return None
+    proba = model.predict_proba(X_test)
+    classes = list(model.classes_)
+    if 1 not in classes:
+        return np.zeros(len(X_test))
+    return proba[:, classes.index(1)]
+
+
+def evaluate_fold(
+    train_df,
+    test_df,
+    models=None,
+    target_column="Class",
+    store=None,
+    context=None,
+    seed=None,
+):
+    """
+    Train and evaluate several models on a single fold.
+
+    The fold is prepared once and shared by all models. Variants of an
+    ensemble that only differ in n_estimators are grown with warm_start from
+    the smallest to the largest, and their fit_time is the time to grow from
+    the previous size. With a model store, models whose predictions are
+    already stored are not retrained, and newly fitted ones are added to the
+    store.
+
+    :param train_df: DataFrame or tuple
+        The training dataset, or its arrays (X, y).
+    :param test_df: DataFrame or tuple
+        The testing dataset, or its arrays (X, y).
+    :param models: list of str, optional
+        Names of the models to evaluate (default is every registered model).
+    :param target_column: str, optional
+        The name of the target column (default is "Class").
+    :param store: ModelStore, optional
+        Store of the per-fold predictions (default is None).
+    :param context: tuple, optional
+        Tuple (method, dataset, fold) identifying the fold in the store.
+    :param seed: int, optional
+        Base seed of the random_state of every estimator that has one,
+        derived from the model name, so a model's result does not depend on
+        the other models of the call. The variants of a sweep share their
+        seed, so growing a forest gives the same trees as fitting it at its
+        final size.
+    :return: tuple
+        Tuple (metrics, timings) of dictionaries {model: metrics} and
+        {model: timings}, where the timings hold the "fit_time" and
+        "predict_time" of the model in seconds. They are kept apart from
+        the metrics, so they never reach the exported results.
+    """
+    models = list(ESTIMATORS) if models is None else models
+    arrays = prepared = data_hash = None
+
+    evaluations, results = {}, {}
+    for seed_name, group in sweep_groups(models):
+        grown = None
+        for name in group:
+            model = ESTIMATORS[name]()
+            if store is not None:
+                if data_hash is None:
+                    arrays = (
+                        fold_arrays(train_df, target_column),
+                        fold_arrays(test_df, target_column),
+                    )
+                    data_hash = fold_fingerprint(*arrays[0], *arrays[1])
+                config = model_config(model)
+                key = store_key(*context, name, config, data_hash, seed)
+                entry = store.load(key)
+                if entry is not None:
+                    evaluations[name] = (
+                        entry["y_true"],
+                        entry["y_pred"],
+                        entry["y_score"],
+                    )
+                    results[name] = timings(entry["meta"])
+                    continue
+
+            if prepared is None:
+                with stage("prepare_fold"):
+                    train, test = arrays or (train_df, test_df)
+                    prepared = prepare_fold(train, test, target_column)
+            X_train, y_train, X_test, y_test = prepared
+
+            if len(group) > 1:
+                # Add trees to the forest of the previous variant
+                if grown is None:
+                    grown = model.set_params(warm_start=True)
+                else:
+                    grown.set_params(n_estimators=model.n_estimators)
+                model = grown
+            if seed is not None and "random_state" in model.get_params():
+                # Seed the estimator itself, the global numpy state is left alone
+                seed_value = seed + zlib.crc32(seed_name.encode())
+                model.set_params(random_state=seed_value & 0xFFFFFFFF)
+            with stage("fit", model=name) as fit:
+                model.fit(X_train, y_train)
+            with stage("predict", model=name) as predict:
+                predictions = model.predict(X_test)
+                scores = predict_scores(model, X_test)
+            evaluations[name] = (y_test, predictions, scores)
+            results[name] = {"fit_time": fit["wall"], "predict_time": predict["wall"]}
+
+            if store is not None:
+                meta = dict(zip(("method", "dataset", "fold"), context))
+                meta.update(model=name, config=config, data=data_hash, seed=seed)
+                meta.update(results[name])
+                store.save(key, meta, y_test, predictions, scores, model)
+
+    # The metrics of all models of the fold are computed in one batch
+    with stage("metrics"):
+        metrics = evaluate_many([evaluations[name] for name in models])
+    return dict(zip(models, metrics)), {name: results[name] for name in models}
+
+
+def evaluate(train_dfs, test_dfs, models=None, target_column="Class"):
+    """
+    Train and evaluate several models on multiple datasets.
+
+    :param train_dfs: list of DataFrame
+        The list of training datasets.
+    :param test_dfs: list of DataFrame
+        The list of testing datasets.
+    :param models: list of str, optional
+        Names of the models to evaluate (default is every registered model).
+    :param target_column: str, optional
+        The name of the target column (default is "Class").
+    :return: dict
+        Dictionary {model: list of metrics for each dataset}.
+    """
+    models = list(ESTIMATORS) if models is None else models
+    results = {name: [] for name in models}
+
+    for train, test in iter_folds(train_dfs, test_dfs):
+        fold_results, _ = evaluate_fold(train, test, models, target_column)
+        for name, metrics in fold_results.items():
+            results[name].append(metrics)
+
+    return results
+
 
 def random_forest(train_dfs, test_dfs, target_column="Class"):
     """
@@ -25,60 +370,10 @@ def random_forest(train_dfs, test_dfs, target_column="Class"):
     :return: list of dict
         The list of evaluation metrics for each dataset.
     """
-    # Separate the features and the targets
-    X_train_dfs = [df.drop(target_column, axis=1) for df in train_dfs]
-    y_train_dfs = [
-        df[target_column].replace({"positive": 1, "negative": 0}) for df in train_dfs
+    return evaluate(train_dfs, test_dfs, ["random_forest"], target_column)[
+        "random_forest"
     ]
 
-    X_test_dfs = [df.drop(target_column, axis=1) for df in test_dfs]
-    y_test_dfs = [
-        df[target_column].replace({"positive": 1, "negative": 0}) for df in test_dfs
-    ]
-
-    results = []
-
-    for X_train, y_train, X_test, y_test in zip(
-        X_train_dfs, y_train_dfs, X_test_dfs, y_test_dfs
-    ):
-        # Standardize the features
-        sc = StandardScaler()
-        X_train = sc.fit_transform(X_train)
-        X_test = sc.transform(X_test)
-
-        # Train the model
-        model = RandomForestClassifier()
-        model.fit(X_train, y_train)
-
-        # Evaluate the model
-        predictions = model.predict(X_test)
-
-        accuracy = accuracy_score(y_test, predictions)
-        balanced_accuracy = balanced_accuracy_score(y_test, predictions)
-        precision = precision_score(
-            y_test, predictions, zero_division=0
-        )  # Set zero_division parameter
-        recall = recall_score(
-            y_test, predictions, zero_division=0
-        )  # Do the same for recall
-        f1 = f1_score(y_test, predictions, zero_division=0)  # And for f1 score
-        classification_error = 1 - accuracy
-        auc_roc = roc_auc_score(y_test, predictions)
-
-        results.append(
-            {
-                "accuracy": accuracy,
-                "balanced_accuracy": balanced_accuracy,
-                "precision": precision,
-                "recall": recall,
-                "f1_score": f1,
-                "classification_error": classification_error,
-                "auc_roc": auc_roc,
-            }
-        )
-
-    return results
-
 
 def decision_tree(train_dfs, test_dfs, target_column="Class"):
     """
@@ -93,56 +388,10 @@ def decision_tree(train_dfs, test_dfs, target_column="Class"):
     :return: list of dict
         The list of evaluation metrics for each dataset.
     """
-    # Separate the features and the targets
-    X_train_dfs = [df.drop(target_column, axis=1) for df in train_dfs]
-    y_train_dfs = [
-        df[target_column].replace({"positive": 1, "negative": 0}) for df in train_dfs
+    return evaluate(train_dfs, test_dfs, ["decision_tree"], target_column)[
+        "decision_tree"
     ]
 
-    X_test_dfs = [df.drop(target_column, axis=1) for df in test_dfs]
-    y_test_dfs = [
-        df[target_column].replace({"positive": 1, "negative": 0}) for df in test_dfs
-    ]
-
-    results = []
-
-    for X_train, y_train, X_test, y_test in zip(
-        X_train_dfs, y_train_dfs, X_test_dfs, y_test_dfs
-    ):
-        # Standardize the features
-        sc = StandardScaler()
-        X_train = sc.fit_transform(X_train)
-        X_test = sc.transform(X_test)
-
-        # Train the model
-        model = DecisionTreeClassifier()
-        model.fit(X_train, y_train)
-
-        # Evaluate the model
-        predictions = model.predict(X_test)
-
-        accuracy = accuracy_score(y_test, predictions)
-        balanced_accuracy = balanced_accuracy_score(y_test, predictions)
-        precision = precision_score(y_test, predictions, zero_division=0)
-        recall = recall_score(y_test, predictions, zero_division=0)
-        f1 = f1_score(y_test, predictions, zero_division=0)
-        classification_error = 1 - accuracy
-        auc_roc = roc_auc_score(y_test, predictions)
-
-        results.append(
-            {
-                "accuracy": accuracy,
-                "balanced_accuracy": balanced_accuracy,
-                "precision": precision,
-                "recall": recall,
-                "f1_score": f1,
-                "classification_error": classification_error,
-                "auc_roc": auc_roc,
-            }
-        )
-
-    return results
-
 
 def naive_bayes(train_dfs, test_dfs, target_column="Class"):
     """
@@ -157,52 +406,4 @@ def naive_bayes(train_dfs, test_dfs, target_column="Class"):
     :return: list of dict
         The list of evaluation metrics for each dataset.
     """
-    # Separate the features and the targets
-    X_train_dfs = [df.drop(target_column, axis=1) for df in train_dfs]
-    y_train_dfs = [
-        df[target_column].replace({"positive": 1, "negative": 0}) for df in train_dfs
-    ]
-
-    X_test_dfs = [df.drop(target_column, axis=1) for df in test_dfs]
-    y_test_dfs = [
-        df[target_column].replace({"positive": 1, "negative": 0}) for df in test_dfs
-    ]
-
-    results = []
-
-    for X_train, y_train, X_test, y_test in zip(
-        X_train_dfs, y_train_dfs, X_test_dfs, y_test_dfs
-    ):
-        # Standardize the features
-        sc = StandardScaler()
-        X_train = sc.fit_transform(X_train)
-        X_test = sc.transform(X_test)
-
-        # Train the model
-        model = GaussianNB()
-        model.fit(X_train, y_train)
-
-        # Evaluate the model
-        predictions = model.predict(X_test)
-
-        accuracy = accuracy_score(y_test, predictions)
-        balanced_accuracy = balanced_accuracy_score(y_test, predictions)
-        precision = precision_score(y_test, predictions, zero_division=0)
-        recall = recall_score(y_test, predictions, zero_division=0)
-        f1 = f1_score(y_test, predictions, zero_division=0)
-        classification_error = 1 - accuracy
-        auc_roc = roc_auc_score(y_test, predictions)
-
-        results.append(
-            {
-                "accuracy": accuracy,
-                "balanced_accuracy": balanced_accuracy,
-                "precision": precision,
-                "recall": recall,
-                "f1_score": f1,
-                "classification_error": classification_error,
-                "auc_roc": auc_roc,
-            }
-        )
-
-    return results
+    return evaluate(train_dfs, test_dfs, ["naive_bayes"], target_column)["naive_bayes"]
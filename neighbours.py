@@ -0,0 +1,135 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.base import BaseEstimator
+from sklearn.neighbors import NearestNeighbors
+
+
+def fingerprint(X):
+    """
+    Compute a content hash of a feature matrix.
+
+    :param X: ndarray
+        The feature matrix.
+    :return: str
+        Hex digest of the shape, dtype and values of the matrix.
+    """
+    X = np.ascontiguousarray(X)
+    digest = hashlib.sha1(repr((X.shape, str(X.dtype))).encode())
+    digest.update(X.data)
+    return digest.hexdigest()
+
+
+class NeighbourCache:
+    """
+    Cache of k-nearest-neighbour graphs shared by the SMOTE family.
+
+    Graphs are keyed by the content of the fitted and the queried samples,
+    so SMOTE and ADASYN running on the same fold reuse each other's
+    neighbours. Every graph is computed at max_neighbors or more and
+    sliced for smaller k. Neighbours at exactly the same distance may then
+    come in a different order than from a query at the smaller k. The
+    number of graphs fitted and reused is counted in misses and hits.
+
+    :param max_neighbors: int, optional
+        Minimum number of neighbours computed per query (default is 1).
+    :param max_entries: int, optional
+        Number of graphs kept, least recently used first out (default is 32).
+    """
+
+    def __init__(self, max_neighbors=1, max_entries=32):
+        self.max_neighbors = max_neighbors
+        self.max_entries = max_entries
+        self._graphs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __deepcopy__(self, memo):
+        # sklearn.clone deep-copies parameters, the cache must stay shared
+        return self
+
+    def clear(self):
+        """
+        Remove every cached graph and reset the counters.
+        """
+        self._graphs.clear()
+        self.hits = self.misses = 0
+
+    def kneighbors(self, X_fit, X_query, n_neighbors):
+        """
+        Get the nearest neighbours of X_query among X_fit.
+
+        :param X_fit: ndarray
+            The samples to search in.
+        :param X_query: ndarray
+            The samples to find neighbours for.
+        :param n_neighbors: int
+            Number of neighbours, including the sample itself when X_query
+            is part of X_fit.
+        :return: tuple
+            Tuple (distances, indices), each of shape (len(X_query), n_neighbors).
+        """
+        key = (fingerprint(X_fit), fingerprint(X_query))
+        graph = self._graphs.get(key)
+
+        if graph is None or graph[1].shape[1] < n_neighbors:
+            k = max(n_neighbors, min(self.max_neighbors, len(X_fit)))
+            nn = NearestNeighbors(n_neighbors=k).fit(X_fit)
+            graph = nn.kneighbors(X_query)
+            self._graphs[key] = graph
+            self.misses += 1
+            while len(self._graphs) > self.max_entries:
+                self._graphs.popitem(last=False)
+        else:
+            self.hits += 1
+        self._graphs.move_to_end(key)
+
+        distances, indices = graph
+        return distances[:, :n_neighbors], indices[:, :n_neighbors]
+
+
+# Cache shared by every sampler in the process
+SHARED_CACHE = NeighbourCache()
+
+
+class CachedNeighbours(BaseEstimator):
+    """
+    Nearest-neighbours estimator answering queries from a NeighbourCache.
+
+    It can be passed as k_neighbors/n_neighbors to the imblearn samplers.
+
+    :param n_neighbors: int, optional
+        Number of neighbours, including the sample itself (default is 6).
+    :param cache: NeighbourCache, optional
+        The cache to use (default is the process-wide SHARED_CACHE).
+    """
+
+    def __init__(self, n_neighbors=6, cache=None):
+        self.n_neighbors = n_neighbors
+        self.cache = cache
+
+    def fit(self, X, y=None):
+        self._fit_X = np.asarray(X)
+        return self
+
+    def kneighbors(self, X=None, n_neighbors=None, return_distance=True):
+        X_query = self._fit_X if X is None else np.asarray(X)
+        n_neighbors = self.n_neighbors if n_neighbors is None else n_neighbors
+        cache = SHARED_CACHE if self.cache is None else self.cache
+
+        distances, indices = cache.kneighbors(self._fit_X, X_query, n_neighbors)
+        return (distances, indices) if return_distance else indices
+
+    def kneighbors_graph(self, X=None, n_neighbors=None, mode="connectivity"):
+        indices = self.kneighbors(X, n_neighbors, return_distance=False)
+        n_queries, k = indices.shape
+        return csr_matrix(
+            (
+                np.ones(n_queries * k),
+                indices.ravel(),
+                np.arange(0, n_queries * k + 1, k),
+            ),
+            shape=(n_queries, len(self._fit_X)),
+        )
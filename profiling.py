@@ -0,0 +1,219 @@
+import os
+import sys
+import json
+import time
+import shutil
+import cProfile
+import subprocess
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Timings added to the metrics of every evaluated model, in seconds
+TIMING_NAMES = ("fit_time", "predict_time")
+
+
+def peak_rss():
+    """
+    Get the peak resident set size of the current process.
+
+    This is the high-water mark since the process started, it never goes
+    down, so it cannot tell how much memory a single stage used.
+
+    :return: float or None
+        Peak RSS in megabytes, or None if it cannot be measured.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def current_rss():
+    """
+    Get the current resident set size of the current process.
+
+    :return: float or None
+        RSS in megabytes, or None if it cannot be measured (only Linux
+        exposes /proc/self/statm).
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1024**2
+
+
+class Profiler:
+    """
+    Records wall time, CPU time and memory of named pipeline stages.
+
+    Every record holds the stage name, the measurements, the process id and
+    any tags passed to stage(), such as the dataset or the model. The memory
+    of a stage is the RSS when it ends ("rss") and its change over the stage
+    ("rss_delta"), "max_rss" is the high-water mark of the whole process.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    @contextmanager
+    def stage(self, name, **tags):
+        """
+        Measure a block of code.
+
+        :param name: str
+            The name of the stage, e.g. "fit" or "sampling".
+        :return: dict
+            The record of the stage, filled in when the block exits.
+        """
+        record = {"stage": name, **tags}
+        start_rss = current_rss()
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record["wall"] = time.perf_counter() - start_wall
+            record["cpu"] = time.process_time() - start_cpu
+            record["rss"] = current_rss()
+            record["rss_delta"] = (
+                None if start_rss is None else record["rss"] - start_rss
+            )
+            record["max_rss"] = peak_rss()
+            record["pid"] = os.getpid()
+            self.records.append(record)
+
+    def drain(self, start=0):
+        """
+        Remove and return records, e.g. to send them from a worker.
+
+        :param start: int, optional
+            Number of older records to keep (default is 0, drain all).
+        :return: list of dict
+            The records from position start onwards.
+        """
+        records = self.records[start:]
+        del self.records[start:]
+        return records
+
+    def extend(self, records):
+        """
+        Add records collected by another process.
+
+        :param records: list of dict
+            The records.
+        """
+        self.records.extend(records)
+
+    def summary(self):
+        """
+        Summarize the records per stage.
+
+        :return: DataFrame
+            Number of calls, total and mean wall time, total CPU time, the
+            largest RSS growth of a call and the process high-water mark
+            per stage, slowest stage first.
+        """
+        if not self.records:
+            return pd.DataFrame()
+        df = pd.DataFrame(self.records)
+        summary = df.groupby("stage").agg(
+            calls=("wall", "size"),
+            wall_total=("wall", "sum"),
+            wall_mean=("wall", "mean"),
+            cpu_total=("cpu", "sum"),
+            rss_delta_mb=("rss_delta", "max"),
+            max_rss_mb=("max_rss", "max"),
+        )
+        return summary.sort_values("wall_total", ascending=False)
+
+    def report(self, path=None):
+        """
+        Print the summary and optionally save the raw records.
+
+        :param path: str, optional
+            Path of a JSON file for the raw records (default is None).
+        """
+        print(self.summary().to_string())
+        if path is not None:
+            with open(path, "w") as json_file:
+                json.dump(self.records, json_file, indent=4)
+
+
+def timings(record):
+    """
+    Select the fit and predict times of a result or store entry.
+
+    :param record: dict
+        The metrics of a model, or the metadata of a stored fold.
+    :return: dict
+        Dictionary with the "fit_time" and "predict_time" found in record.
+    """
+    return {name: record[name] for name in TIMING_NAMES if name in record}
+
+
+# Profiler of the current process
+PROFILER = Profiler()
+
+
+def stage(name, **tags):
+    """
+    Measure a block of code with the profiler of the current process.
+
+    :param name: str
+        The name of the stage.
+    :return: contextmanager
+        Context manager yielding the record of the stage.
+    """
+    return PROFILER.stage(name, **tags)
+
+
+@contextmanager
+def cprofile(path):
+    """
+    Run a block of code under cProfile and dump the statistics.
+
+    :param path: str
+        Path of the .prof file, readable with pstats or snakeviz.
+    """
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+
+
+@contextmanager
+def py_spy(path, rate=100):
+    """
+    Sample the current process and its workers with py-spy, if installed.
+
+    :param path: str
+        Path of the flame graph SVG written by py-spy.
+    :param rate: int, optional
+        Number of samples per second (default is 100).
+    """
+    executable = shutil.which("py-spy")
+    if executable is None:
+        print("py-spy is not installed, skipping sampling")
+        yield None
+        return
+
+    command = [executable, "record", "--subprocesses", "--rate", str(rate)]
+    command += ["--output", path, "--pid", str(os.getpid())]
+    process = subprocess.Popen(command)
+    try:
+        yield process
+    finally:
+        # py-spy writes the output when interrupted
+        process.send_signal(subprocess.signal.SIGINT)
+        process.wait()
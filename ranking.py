@@ -1,51 +1,300 @@
-import json
-import glob
+import os
+import argparse
+
+import numpy as np
 import pandas as pd
+from scipy import stats
+
+from results import load_data
+from statistic import holm
+
+# Metrics where a lower value is better, every other metric is maximized
+LOWER_IS_BETTER = {"classification_error"}
+# What the ranks compare, the remaining factors are the blocks
+COMPARISONS = ("method", "model", "pair")
+
+
+def score_tensor(df, metric):
+    """
+    Arrange the scores of a metric in a (dataset x method x model) tensor.
+
+    :param df: pandas.DataFrame
+        Long table as returned by results.load_data.
+    :param metric: str
+        The metric to arrange.
+    :return: tuple
+        The tensor, NaN where a combination was not evaluated, and the
+        dataset, method and model labels of its axes.
+    """
+    df = df[df["metric"] == metric]
+    axes = []
+    for column in ("dataset", "method", "model"):
+        values = df[column].astype("category").cat.remove_unused_categories()
+        axes.append((values.cat.codes.to_numpy(), list(values.cat.categories)))
+
+    tensor = np.full(tuple(len(labels) for _, labels in axes), np.nan)
+    tensor[tuple(codes for codes, _ in axes)] = df["value"].to_numpy()
+    return (tensor,) + tuple(labels for _, labels in axes)
+
+
+def rank_tensor(scores, metric=None):
+    """
+    Rank the competitors of every block, 1 being the best.
+
+    :param scores: ndarray
+        Scores with the competitors along the last axis.
+    :param metric: str, optional
+        The metric of the scores, to know if lower is better (default is
+        None, higher is better).
+    :return: ndarray
+        The ranks, ties get the average rank.
+    """
+    sign = 1 if metric in LOWER_IS_BETTER else -1
+    return stats.rankdata(sign * scores, axis=-1)
+
+
+def blocks(df, metric, by="method"):
+    """
+    Get the scores of a metric as blocks of competitors.
+
+    :param df: pandas.DataFrame
+        Long table as returned by results.load_data.
+    :param metric: str
+        The metric compared.
+    :param by: str, optional
+        The competitors: "method" (blocks are dataset/model pairs), "model"
+        (blocks are dataset/method pairs) or "pair" (every method/model
+        pair, blocks are datasets) (default is "method").
+    :return: tuple
+        Matrix (blocks x competitors) and the competitor labels. Blocks
+        where a competitor is missing are dropped.
+    """
+    if by not in COMPARISONS:
+        raise ValueError(f"by must be one of {COMPARISONS}, got {by!r}")
+    tensor, _, methods, models = score_tensor(df, metric)
+
+    if by == "method":
+        scores = tensor.transpose(0, 2, 1).reshape(-1, len(methods))
+        labels = methods
+    elif by == "model":
+        scores = tensor.reshape(-1, len(models))
+        labels = models
+    else:
+        scores = tensor.reshape(len(tensor), -1)
+        labels = [f"{method}/{model}" for method in methods for model in models]
+    return scores[~np.isnan(scores).any(axis=1)], labels
+
+
+def friedman_test(ranks):
+    """
+    Run the Friedman test on ranks, with the Iman-Davenport correction.
+
+    :param ranks: ndarray
+        Ranks of shape (blocks x competitors).
+    :return: dict
+        The chi-square statistic and p-value, and the F statistic and
+        p-value of Iman and Davenport.
+    """
+    n, k = ranks.shape
+    rank_sums = ranks.sum(axis=0)
+    chi2 = 12.0 / (n * k * (k + 1)) * (rank_sums**2).sum() - 3.0 * n * (k + 1)
+
+    # Ties get the same correction as scipy.stats.friedmanchisquare
+    ties = 0.0
+    for row in np.sort(ranks, axis=1):
+        _, counts = np.unique(row, return_counts=True)
+        ties += (counts**3 - counts).sum()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        chi2 /= 1.0 - ties / (n * k * (k * k - 1.0))
+        f = (n - 1) * chi2 / (n * (k - 1) - chi2)
+
+    return {
+        "chi2": chi2,
+        "p_value": stats.chi2.sf(chi2, k - 1),
+        "iman_davenport": f,
+        "iman_davenport_p_value": stats.f.sf(f, k - 1, (k - 1) * (n - 1)),
+    }
+
+
+def rank_z(average_ranks, n_blocks):
+    """
+    Compute the pairwise z statistics of the average ranks.
+
+    :param average_ranks: ndarray
+        Average rank of every competitor.
+    :param n_blocks: int
+        The number of blocks the ranks were averaged over.
+    :return: ndarray
+        Matrix of |R_i - R_j| / SE.
+    """
+    k = len(average_ranks)
+    se = np.sqrt(k * (k + 1) / (6.0 * n_blocks))
+    return np.abs(average_ranks[:, None] - average_ranks[None, :]) / se
+
+
+def nemenyi_test(average_ranks, n_blocks):
+    """
+    Run the Nemenyi test of every pair of competitors.
+
+    :param average_ranks: ndarray
+        Average rank of every competitor.
+    :param n_blocks: int
+        The number of blocks the ranks were averaged over.
+    :return: ndarray
+        Matrix of p-values.
+    """
+    z = rank_z(average_ranks, n_blocks)
+    p = stats.studentized_range.sf(z * np.sqrt(2), len(average_ranks), np.inf)
+    np.fill_diagonal(p, 1.0)
+    return np.minimum(p, 1.0)
+
+
+def holm_test(average_ranks, n_blocks):
+    """
+    Run z tests of every pair of competitors with Holm's correction.
+
+    :param average_ranks: ndarray
+        Average rank of every competitor.
+    :param n_blocks: int
+        The number of blocks the ranks were averaged over.
+    :return: ndarray
+        Matrix of adjusted p-values.
+    """
+    k = len(average_ranks)
+    rows, columns = np.triu_indices(k, 1)
+    p = 2 * stats.norm.sf(rank_z(average_ranks, n_blocks)[rows, columns])
+    adjusted = holm(p)
+
+    matrix = np.ones((k, k))
+    matrix[rows, columns] = adjusted
+    matrix[columns, rows] = adjusted
+    return matrix
+
+
+def critical_difference(average_ranks, n_blocks, alpha=0.05):
+    """
+    Compute the Nemenyi critical difference and the groups it connects.
+
+    :param average_ranks: ndarray
+        Average rank of every competitor.
+    :param n_blocks: int
+        The number of blocks the ranks were averaged over.
+    :param alpha: float, optional
+        Significance level (default is 0.05).
+    :return: tuple
+        The critical difference and the cliques, as lists of competitor
+        positions ordered by rank, of competitors whose ranks differ by no
+        more than the critical difference. Cliques contained in another
+        one are left out, as in a critical difference diagram.
+    """
+    k = len(average_ranks)
+    q = stats.studentized_range.ppf(1 - alpha, k, np.inf) / np.sqrt(2)
+    cd = q * np.sqrt(k * (k + 1) / (6.0 * n_blocks))
+
+    order = np.argsort(average_ranks, kind="stable")
+    sorted_ranks = average_ranks[order]
+    # Furthest competitor within the critical difference of each one
+    ends = np.searchsorted(sorted_ranks, sorted_ranks + cd, side="right")
+    cliques, reach = [], 0
+    for start, end in enumerate(ends):
+        if end > reach and end - start > 1:
+            cliques.append(order[start:end].tolist())
+        reach = max(reach, end)
+    return cd, cliques
+
+
+def rank_report(df, metric="balanced_accuracy", by="method", alpha=0.05):
+    """
+    Rank the competitors on a metric and test their differences.
+
+    :param df: pandas.DataFrame
+        Long table as returned by results.load_data.
+    :param metric: str, optional
+        The metric compared (default is "balanced_accuracy").
+    :param by: str, optional
+        The competitors, see blocks (default is "method").
+    :param alpha: float, optional
+        Significance level of the critical difference (default is 0.05).
+    :return: dict
+        The average ranks, the Friedman test, the Nemenyi and Holm p-values
+        of every pair and the critical difference data.
+    """
+    scores, labels = blocks(df, metric, by)
+    n_blocks = len(scores)
+    if n_blocks == 0 or len(labels) < 2:
+        raise ValueError(f"Not enough complete blocks to rank {by} on {metric}")
 
-# List of JSON files
-json_files = glob.glob('results/average_*.json')
+    ranks = rank_tensor(scores, metric)
+    average_ranks = ranks.mean(axis=0)
+    cd, cliques = critical_difference(average_ranks, n_blocks, alpha)
 
-# Store results
-ranking_results = {}
+    return {
+        "metric": metric,
+        "by": by,
+        "n_blocks": n_blocks,
+        "average_ranks": pd.Series(average_ranks, index=labels).sort_values(),
+        "friedman": friedman_test(ranks),
+        "nemenyi": pd.DataFrame(
+            nemenyi_test(average_ranks, n_blocks), index=labels, columns=labels
+        ),
+        "holm": pd.DataFrame(
+            holm_test(average_ranks, n_blocks), index=labels, columns=labels
+        ),
+        "critical_difference": cd,
+        "cliques": [[labels[i] for i in clique] for clique in cliques],
+    }
 
-# Loop through all JSON files
-for json_file in json_files:
-    with open(json_file) as file:
-        json_data = json.load(file)
 
-    # Extract the filename without the extension
-    json_filename = json_file.split('/')[-1].split('.')[0]
+def ranking_table(df, metric="balanced_accuracy"):
+    """
+    Rank the classifiers of every dataset and method.
 
-    # Iterate through all datasets in the JSON file
-    for dataset_name, dataset in json_data.items():
-        # Get results for classifiers
-        random_forest_result = dataset['random_forest']['balanced_accuracy']
-        decision_tree_result = dataset['decision_tree']['balanced_accuracy']
-        naive_bayes_result = dataset['naive_bayes']['balanced_accuracy']
+    :param df: pandas.DataFrame
+        Long table as returned by results.load_data.
+    :param metric: str, optional
+        The metric compared (default is "balanced_accuracy").
+    :return: pandas.DataFrame
+        One row per dataset, method and classifier with its score and rank,
+        best classifier first.
+    """
+    tensor, datasets, methods, models = score_tensor(df, metric)
+    ranks = rank_tensor(tensor, metric)
 
-        # Perform ranking test based on balanced_accuracy results
-        ranking = sorted([
-            ('Random Forest', random_forest_result),
-            ('Decision Tree', decision_tree_result),
-            ('Naive Bayes', naive_bayes_result)
-        ], key=lambda x: x[1], reverse=True)
+    index = pd.MultiIndex.from_product(
+        [datasets, methods, models], names=["Dataset", "Method", "Classifier"]
+    )
+    table = pd.DataFrame(
+        {"Score": tensor.ravel(), "Rank": ranks.ravel()}, index=index
+    ).reset_index()
+    table = table.dropna(subset=["Score"])
+    table["Classifier"] = table["Classifier"].str.replace("_", " ").str.title()
+    return table.sort_values(
+        ["Dataset", "Method", "Rank"], kind="stable", ignore_index=True
+    )
 
-        # Add results to ranking_results dictionary
-        if dataset_name not in ranking_results:
-            ranking_results[dataset_name] = []
 
-        ranking_results[dataset_name].append((json_filename, ranking))
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Rank the methods and classifiers and test their differences."
+    )
+    parser.add_argument("--results", default=os.path.join(os.getcwd(), "results"))
+    parser.add_argument("--metric", default="balanced_accuracy")
+    parser.add_argument("--by", choices=COMPARISONS, default="method")
+    parser.add_argument("--alpha", type=float, default=0.05)
+    return parser.parse_args(argv)
 
-df = pd.DataFrame(columns=['Dataset', 'Method', 'Classifier', 'Score'])
 
-# Display ranking test results for each dataset
-for dataset_name, rankings in ranking_results.items():
-    for i, (json_filename, ranking) in enumerate(rankings):
-        for classifier, score in ranking:
-            temp_df = pd.DataFrame({'Dataset': dataset_name, 'Method': json_filename.split("_")[-1], 'Classifier': classifier, 'Score': score}, index=[0])
-            df = pd.concat([df, temp_df], ignore_index=True)
+if __name__ == "__main__":
+    args = parse_args()
+    df = load_data(args.results)
 
-# Print the resulting DataFrame
-print(df)
-df.to_excel('ranking_results.xlsx', index=False)
+    table = ranking_table(df, args.metric)
+    print(table)
+    table.to_excel("ranking_results.xlsx", index=False)
 
+    report = rank_report(df, args.metric, args.by, args.alpha)
+    print(f"Average ranks of {args.by} on {args.metric}:")
+    print(report["average_ranks"].to_string())
+    print(f"Friedman: {report['friedman']}")
+    print(f"Critical difference: {report['critical_difference']:.4f}")
+    print(f"Cliques: {report['cliques']}")
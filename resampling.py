@@ -0,0 +1,247 @@
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from checkpoint import RunManifest
+from statistic import PAIRING, holm, load_records, write_report
+
+# The competitors compared, every (sampling method, model) pair
+PAIR = ["method", "model"]
+
+
+def pair_matrix(df, metric=None):
+    """
+    Arrange the per-fold results as observations x (method, model) pairs.
+
+    :param df: DataFrame
+        Long table as returned by statistic.load_records.
+    :param metric: str, optional
+        Keep a single metric (default is every metric, as an extra leading
+        column level).
+    :return: DataFrame
+        One row per dataset and fold, NaN where a pair was not evaluated.
+    """
+    columns = PAIR if metric is not None else ["metric"] + PAIR
+    if metric is not None:
+        df = df[df["metric"] == metric]
+    return df.pivot_table(index=PAIRING, columns=columns, values="value", observed=True)
+
+
+def bootstrap_weights(n_obs, n_resamples, rng):
+    """
+    Draw bootstrap resamples as one index tensor and count the draws.
+
+    :param n_obs: int
+        The number of observations.
+    :param n_resamples: int
+        The number of resamples.
+    :param rng: numpy.random.Generator
+        The random generator.
+    :return: ndarray
+        Matrix (resamples x observations) with the number of times every
+        observation was drawn, so weights @ values sums every resample.
+    """
+    indices = rng.integers(0, n_obs, size=(n_resamples, n_obs))
+    offsets = np.arange(n_resamples)[:, None] * n_obs
+    counts = np.bincount((indices + offsets).ravel(), minlength=n_resamples * n_obs)
+    return counts.reshape(n_resamples, n_obs).astype(np.float64)
+
+
+def resampled_means(values, weights):
+    """
+    Compute the mean of every column in every resample, skipping NaN.
+
+    :param values: ndarray
+        Matrix (observations x columns).
+    :param weights: ndarray
+        Matrix (resamples x observations) of draw counts.
+    :return: ndarray
+        Matrix (resamples x columns).
+    """
+    present = ~np.isnan(values)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (weights @ np.where(present, values, 0.0)) / (weights @ present)
+
+
+def bootstrap_ci(
+    values, n_resamples=10000, confidence=0.95, random_state=42, weights=None
+):
+    """
+    Compute percentile bootstrap confidence intervals of column means.
+
+    Every column is resampled with the same draws, so the intervals of
+    columns measured on the same folds stay paired.
+
+    :param values: ndarray
+        Matrix (observations x columns).
+    :param n_resamples: int, optional
+        The number of resamples (default is 10000).
+    :param confidence: float, optional
+        Level of the intervals (default is 0.95).
+    :param random_state: int, optional
+        Seed of the random generator (default is 42).
+    :param weights: ndarray, optional
+        Draw counts to reuse, as returned by bootstrap_weights (default is
+        to draw new ones).
+    :return: tuple
+        The mean, lower and upper bound of every column.
+    """
+    if weights is None:
+        rng = np.random.default_rng(random_state)
+        weights = bootstrap_weights(len(values), n_resamples, rng)
+    means = resampled_means(values, weights)
+    tail = (1 - confidence) / 2 * 100
+    lower, upper = np.nanpercentile(means, [tail, 100 - tail], axis=0)
+    return np.nanmean(values, axis=0), lower, upper
+
+
+def permutation_test(differences, n_resamples=10000, random_state=42):
+    """
+    Run paired sign-flip permutation tests of several mean differences.
+
+    Under the null hypothesis the sign of every paired difference is
+    exchangeable, so the resamples flip the signs of the observations. All
+    2^n sign patterns are used when there are no more than n_resamples of
+    them, which makes the test exact.
+
+    :param differences: ndarray
+        Matrix (observations x comparisons) of paired differences, NaN
+        where a pair is missing.
+    :param n_resamples: int, optional
+        The number of random sign patterns (default is 10000).
+    :param random_state: int, optional
+        Seed of the random generator (default is 42).
+    :return: ndarray
+        Two-sided p-value of every comparison.
+    """
+    n_obs = len(differences)
+    if 2**n_obs <= n_resamples:
+        # Row k flips the observations set in the bits of k
+        bits = (np.arange(2**n_obs)[:, None] >> np.arange(n_obs)) & 1
+        signs = 1.0 - 2.0 * bits
+        exact = True
+    else:
+        rng = np.random.default_rng(random_state)
+        signs = rng.choice((1.0, -1.0), size=(n_resamples, n_obs))
+        exact = False
+
+    # Missing differences count as 0, they do not move any sum
+    filled = np.nan_to_num(differences)
+    observed = np.abs(filled.sum(axis=0))
+    # Allow for rounding, identical sums must count as at least as extreme
+    tolerance = 1e-12 * np.maximum(1.0, observed)
+    extreme = (np.abs(signs @ filled) >= observed - tolerance).sum(axis=0)
+
+    p_value = extreme / len(signs) if exact else (extreme + 1) / (len(signs) + 1)
+    p_value[(~np.isnan(differences)).sum(axis=0) == 0] = np.nan
+    return p_value
+
+
+def compare_pairs(
+    df, metric="balanced_accuracy", n_resamples=10000, confidence=0.95, random_state=42
+):
+    """
+    Compare every two (method, model) pairs on a metric.
+
+    :param df: DataFrame
+        Long table as returned by statistic.load_records.
+    :param metric: str, optional
+        The metric compared (default is "balanced_accuracy").
+    :param n_resamples: int, optional
+        The number of bootstrap resamples and sign patterns (default is
+        10000).
+    :param confidence: float, optional
+        Level of the intervals (default is 0.95).
+    :param random_state: int, optional
+        Seed of the random generator (default is 42).
+    :return: DataFrame
+        One row per comparison with the mean difference (first - second)
+        over the shared folds, its bootstrap interval and the permutation
+        p-value, raw and Holm adjusted.
+    """
+    matrix = pair_matrix(df, metric)
+    values = matrix.to_numpy()
+    first, second = np.triu_indices(values.shape[1], 1)
+    differences = values[:, first] - values[:, second]
+
+    mean, lower, upper = bootstrap_ci(
+        differences, n_resamples, confidence, random_state
+    )
+    p_value = permutation_test(differences, n_resamples, random_state)
+
+    table = pd.DataFrame(
+        {
+            "method1": matrix.columns.get_level_values("method")[first],
+            "model1": matrix.columns.get_level_values("model")[first],
+            "method2": matrix.columns.get_level_values("method")[second],
+            "model2": matrix.columns.get_level_values("model")[second],
+            "n": (~np.isnan(differences)).sum(axis=0),
+            "mean_difference": mean,
+            "ci_low": lower,
+            "ci_high": upper,
+            "p_value": p_value,
+            "p_adjusted": holm(p_value),
+        }
+    )
+    table.insert(0, "metric", metric)
+    return table
+
+
+def confidence_table(df, n_resamples=10000, confidence=0.95, random_state=42):
+    """
+    Compute bootstrap intervals of the mean of every metric and pair.
+
+    One set of draws is shared by every metric, method and model.
+
+    :param df: DataFrame
+        Long table as returned by statistic.load_records.
+    :param n_resamples: int, optional
+        The number of resamples (default is 10000).
+    :param confidence: float, optional
+        Level of the intervals (default is 0.95).
+    :param random_state: int, optional
+        Seed of the random generator (default is 42).
+    :return: DataFrame
+        One row per metric, method and model with the number of folds, the
+        mean and its interval.
+    """
+    matrix = pair_matrix(df)
+    values = matrix.to_numpy()
+    mean, lower, upper = bootstrap_ci(values, n_resamples, confidence, random_state)
+
+    table = matrix.columns.to_frame(index=False)
+    table["n"] = (~np.isnan(values)).sum(axis=0)
+    table["mean"] = mean
+    table["ci_low"] = lower
+    table["ci_high"] = upper
+    return table
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Bootstrap intervals and permutation tests of the results."
+    )
+    parser.add_argument("--results", default=os.path.join(os.getcwd(), "results"))
+    parser.add_argument("--metric", default="balanced_accuracy")
+    parser.add_argument("--resamples", type=int, default=10000)
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    runs = RunManifest(os.path.join(args.results, "run_manifest.json")).cell_runs()
+    df = load_records(os.path.join(args.results, "records.jsonl"), runs)
+    tables = {
+        "confidence": confidence_table(df, args.resamples, args.confidence, args.seed),
+        "comparisons": compare_pairs(
+            df, args.metric, args.resamples, args.confidence, args.seed
+        ),
+    }
+    path = os.path.join(args.results, "resampling.json")
+    write_report(tables, path, 1 - args.confidence)
+    print(tables["comparisons"].sort_values("p_value").head(20).to_string())
+    print(f"Saved the report to {path}")
@@ -0,0 +1,212 @@
+import os
+import json
+import math
+
+from metrics import METRIC_NAMES
+
+
+def is_valid_record(record):
+    """
+    Check that a record holds a finite value for every metric.
+
+    :param record: dict
+        A record of the result store.
+    :return: bool
+        Whether the record is complete.
+    """
+    metrics = record.get("metrics")
+    if not isinstance(metrics, dict):
+        return False
+    return all(
+        isinstance(metrics.get(name), (int, float)) and math.isfinite(metrics[name])
+        for name in METRIC_NAMES
+    )
+
+
+class ResultStore:
+    """
+    Append-only JSONL store with one record per (method, dataset, model, fold).
+
+    Records are appended as soon as a fold is evaluated, so a crash only
+    loses the folds that were still running. When a key is written more
+    than once the last record wins.
+
+    :param path: str
+        Path to the JSONL file.
+    :param runs: dict, optional
+        Dictionary {(method, model): hash} of the settings every cell depends
+        on. The hash of its cell is stored with every new record, so that
+        only results of the same settings count as completed.
+    """
+
+    def __init__(self, path, runs=None):
+        self.path = path
+        self.runs = runs
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def append(self, records):
+        """
+        Append records to the store and flush them to disk.
+
+        :param records: list of dict
+            Records with "method", "dataset", "model", "fold" and "metrics",
+            and optionally the "timings" of the model.
+        """
+        if self.runs is not None:
+            records = [
+                dict(record, run=self.runs.get((record["method"], record["model"])))
+                for record in records
+            ]
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        # A crash mid-write leaves a torn last line, end it so it is skipped
+        # on load instead of swallowing the first new record
+        if not self.ends_with_newline():
+            lines = "\n" + lines
+        with open(self.path, "a") as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def ends_with_newline(self):
+        """
+        Check that the store is empty or its last line is complete.
+
+        :return: bool
+            Whether new records can be appended as they are.
+        """
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                return f.read(1) == b"\n"
+        except OSError:
+            # Missing or empty file
+            return True
+
+    def append_task(self, task, fold_metrics, fold_timings=None):
+        """
+        Append the results of a scheduler task.
+
+        :param task: Task
+            The finished task.
+        :param fold_metrics: dict
+            Dictionary {model: metrics} returned by the task.
+        :param fold_timings: dict, optional
+            Dictionary {model: timings} returned by the task, stored under
+            "timings" next to the metrics.
+        """
+        fold_timings = fold_timings or {}
+        self.append(
+            [
+                {
+                    "method": task.method,
+                    "dataset": task.dataset,
+                    "model": model,
+                    "fold": task.fold,
+                    "metrics": metrics,
+                    "timings": fold_timings.get(model, {}),
+                }
+                for model, metrics in fold_metrics.items()
+            ]
+        )
+
+    def records(self):
+        """
+        Read the stored records, last record per key.
+
+        Lines that cannot be parsed, such as a line cut off by a crash,
+        are skipped.
+
+        :return: dict
+            Dictionary {(method, dataset, model, fold): record}, in the order
+            the keys were first written.
+        """
+        records = {}
+        if not os.path.exists(self.path):
+            return records
+
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    key = (
+                        record["method"],
+                        record["dataset"],
+                        record["model"],
+                        record["fold"],
+                    )
+                except (ValueError, KeyError, TypeError):
+                    continue
+                records[key] = record
+        return records
+
+    def completed(self):
+        """
+        Get the keys of the stored records that do not need to be rerun.
+
+        Records with missing or non-finite metrics, and records written with
+        other settings for their cell, are not completed.
+
+        :return: set of tuple
+            Set of (method, dataset, model, fold).
+        """
+        return {
+            key
+            for key, record in self.records().items()
+            if is_valid_record(record) and self.is_current(record)
+        }
+
+    def is_current(self, record):
+        """
+        Check that a record was written with the current settings of its cell.
+
+        :param record: dict
+            A record of the result store.
+        :return: bool
+            Whether the hash of the record matches its cell, always True
+            without runs.
+        """
+        if self.runs is None:
+            return True
+        cell = (record.get("method"), record.get("model"))
+        return cell in self.runs and record.get("run") == self.runs[cell]
+
+    def export(self, method, datasets=None, models=None, records=None):
+        """
+        Export the records of a method to the layout of the JSON results.
+
+        Only the records written with the current settings of their cell are
+        exported, as in completed().
+
+        :param method: str
+            The sampling method (or "raw_data" / "umce").
+        :param datasets: list of str, optional
+            Order of the datasets (default is the order they were written in).
+        :param models: list of str, optional
+            Order of the models (default is the order they were written in).
+        :param records: dict, optional
+            Records as returned by records() (default is read from disk).
+        :return: dict
+            Dictionary {dataset: {model: [metrics for each fold]}}.
+        """
+        records = self.records() if records is None else records
+        selected = [
+            r for key, r in records.items() if key[0] == method and self.is_current(r)
+        ]
+
+        def rank(order):
+            return {name: i for i, name in enumerate(order or [])}
+
+        dataset_rank, model_rank = rank(datasets), rank(models)
+        selected.sort(
+            key=lambda r: (
+                dataset_rank.get(r["dataset"], len(dataset_rank)),
+                model_rank.get(r["model"], len(model_rank)),
+                r["fold"],
+            )
+        )
+
+        result = {}
+        for record in selected:
+            models_result = result.setdefault(record["dataset"], {})
+            models_result.setdefault(record["model"], []).append(record["metrics"])
+        return result
@@ -1,77 +1,361 @@
+import os
 import json
+import pickle
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import pandas as pd
-import os
-import statsmodels.api as sm
-import statsmodels.formula.api as smf
+from scipy import stats
 from statsmodels.stats.multicomp import pairwise_tukeyhsd
 
+from handle_pickle import load_pickle, save_pickle
+
+COLUMNS = ["dataset", "model", "metric", "value", "method"]
+CATEGORIES = ["dataset", "model", "metric", "method"]
+# Terms of value ~ C(model) + C(method) + C(model):C(method)
+TERMS = ["C(model)", "C(method)", "C(model):C(method)"]
+ANOVA_COLUMNS = ["sum_sq", "df", "F", "PR(>F)"]
+# Bump to invalidate every cached design, e.g. after changing the coding
+DESIGN_VERSION = 1
+
+
+def method_name(file_path):
+    """
+    Derive the method of an average file from its name.
+
+    :param file_path: str
+        Path to an average_<method>.json file.
+    :return: str
+        The last word of the file name, e.g. "smote" or "umce".
+    """
+    return os.path.splitext(os.path.basename(file_path))[0].split("_")[-1]
+
 
-def load_data(directory):
+def load_data(directory, metrics=None):
     """
-    Load data from all json files in a directory that contain "average" in their filename,
-    and flatten it to a pandas DataFrame.
+    Load data from all json files in a directory that contain "average" in
+    their filename, and flatten it to a long pandas DataFrame.
+
+    Every (dataset, model, method) becomes one row of a wide table, which is
+    melted once, so no row is built per value.
 
     :param directory: str
         Path to the directory containing the json files.
+    :param metrics: iterable of str, optional
+        The metrics to keep (default is every metric found).
     :return: pandas.DataFrame
-        DataFrame containing the loaded data.
+        DataFrame with the COLUMNS, where dataset, model, metric and method
+        are categorical and value is float64.
     """
+    file_paths = sorted(
+        os.path.join(directory, f)
+        for f in os.listdir(directory)
+        if f.endswith(".json") and "average" in f
+    )
 
-    # Find all json files in the directory that contain "average" in the filename
-    file_paths = [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(".json") and "average" in f]
-
-    # List to store data from all files
-    all_data = []
-
+    index, rows = [], []
     for file_path in file_paths:
-        # Load the data from the json file
         with open(file_path, "r") as f:
             data = json.load(f)
+        method = method_name(file_path)
+        for dataset, models in data.items():
+            for model, model_metrics in models.items():
+                index.append((dataset, model, method))
+                rows.append(model_metrics)
 
-        # Method attribute is derived from the file name
-        method = os.path.splitext(os.path.basename(file_path))[0]
-        method = method.split('_')[-1]
+    wide = pd.DataFrame.from_records(
+        rows,
+        index=pd.MultiIndex.from_tuples(index, names=["dataset", "model", "method"]),
+    )
+    if metrics is not None:
+        wide = wide[[column for column in wide.columns if column in set(metrics)]]
 
-        # Flatten json structure
-        rows = []
-        for dataset, models in data.items():
-            for model, metrics in models.items():
-                for metric, value in metrics.items():
-                    # Check if the metric is one of the ones we're interested in
-                    if metric in {"f1_score", "balanced_accuracy", "auc_roc"}:
-                        row = {
-                            "dataset": dataset,
-                            "model": model,
-                            "metric": metric,
-                            "value": value,
-                            "method": method  # Added method attribute
-                        }
-                        rows.append(row)
-
-        # Convert the data for this file into a DataFrame and add it to the list
-        all_data.append(pd.DataFrame(rows))
-
-    # Concatenate all data into a single DataFrame
-    df = pd.concat(all_data, ignore_index=True)
+    df = wide.reset_index().melt(
+        id_vars=["dataset", "model", "method"], var_name="metric"
+    )
+    df = df.dropna(subset=["value"]).reset_index(drop=True)
+    df["value"] = df["value"].astype(np.float64)
+    df = df.reindex(columns=COLUMNS)
+    for column in CATEGORIES:
+        df[column] = df[column].astype("category")
     return df
 
+
+def treatment_dummies(codes, n_levels):
+    """
+    Encode a factor with treatment coding, the first level as reference.
+
+    :param codes: ndarray
+        The level of every row, from 0 to n_levels - 1.
+    :param n_levels: int
+        The number of levels.
+    :return: ndarray
+        Matrix of shape (len(codes), n_levels - 1).
+    """
+    return np.eye(n_levels)[codes][:, 1:]
+
+
+def column_basis(X):
+    """
+    Get an orthonormal basis of the column space of a design matrix.
+
+    Rank deficient designs, e.g. from empty model/method cells, are handled
+    by dropping the singular directions.
+
+    :param X: ndarray
+        The design matrix.
+    :return: ndarray
+        Matrix Q with orthonormal columns spanning the columns of X.
+    """
+    U, s, _ = np.linalg.svd(X, full_matrices=False)
+    tolerance = s.max(initial=0.0) * max(X.shape) * np.finfo(np.float64).eps
+    return U[:, s > tolerance]
+
+
+def fit_designs(model_codes, method_codes, n_models, n_methods):
+    """
+    Build the OLS designs needed by a type II two-way ANOVA.
+
+    :param model_codes: ndarray
+        The model level of every row.
+    :param method_codes: ndarray
+        The method level of every row.
+    :param n_models: int
+        The number of models.
+    :param n_methods: int
+        The number of methods.
+    :return: dict
+        Dictionary {name: Q} with the orthonormal bases of the designs
+        "model" (intercept and model), "method", "additive" (both factors)
+        and "full" (with the interaction).
+    """
+    intercept = np.ones((len(model_codes), 1))
+    model = treatment_dummies(model_codes, n_models)
+    method = treatment_dummies(method_codes, n_methods)
+    interaction = (model[:, :, None] * method[:, None, :]).reshape(len(model_codes), -1)
+    designs = {
+        "model": [intercept, model],
+        "method": [intercept, method],
+        "additive": [intercept, model, method],
+        "full": [intercept, model, method, interaction],
+    }
+    return {name: column_basis(np.hstack(blocks)) for name, blocks in designs.items()}
+
+
+class DesignCache:
+    """
+    On-disk cache of the ANOVA designs.
+
+    The designs only depend on the model and method of every row, so they
+    are shared by every metric with the same rows, and reused between runs
+    as long as the result files describe the same grid.
+
+    :param directory: str, optional
+        Directory where the cached designs are stored (default is None, keep
+        them in memory only).
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.designs = {}
+
+    def key(self, model_codes, method_codes, n_models, n_methods):
+        digest = hashlib.sha256()
+        digest.update(repr((DESIGN_VERSION, n_models, n_methods)).encode())
+        digest.update(np.ascontiguousarray(model_codes, dtype=np.int64).tobytes())
+        digest.update(np.ascontiguousarray(method_codes, dtype=np.int64).tobytes())
+        return digest.hexdigest()
+
+    def get(self, model_codes, method_codes, n_models, n_methods):
+        """
+        Return the designs of a grid, building them if needed.
+
+        :return: dict
+            The designs, as returned by fit_designs.
+        """
+        key = self.key(model_codes, method_codes, n_models, n_methods)
+        if key in self.designs:
+            return self.designs[key]
+
+        if self.directory is None:
+            designs = fit_designs(model_codes, method_codes, n_models, n_methods)
+            self.designs[key] = designs
+            return designs
+
+        path = os.path.join(self.directory, key + ".pkl")
+        try:
+            entry = load_pickle(path)
+            designs = entry["designs"] if entry.get("key") == key else None
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError, KeyError):
+            designs = None
+
+        if designs is None:
+            designs = fit_designs(model_codes, method_codes, n_models, n_methods)
+            os.makedirs(self.directory, exist_ok=True)
+            save_pickle({"key": key, "designs": designs}, path)
+        self.designs[key] = designs
+        return designs
+
+
+def residual_sum_of_squares(Q, Y):
+    """
+    Compute the residual sum of squares of several responses at once.
+
+    :param Q: ndarray
+        Orthonormal basis of the design.
+    :param Y: ndarray
+        Matrix with one response per column.
+    :return: ndarray
+        The residual sum of squares of every column.
+    """
+    residuals = Y - Q @ (Q.T @ Y)
+    return np.einsum("ij,ij->j", residuals, residuals)
+
+
+def anova_tables(df, cache=None):
+    """
+    Run a type II two-way ANOVA of value ~ model * method for every metric.
+
+    The metrics observed on the same rows share one set of designs and are
+    solved together as columns of one response matrix.
+
+    :param df: pandas.DataFrame
+        Long table as returned by load_data.
+    :param cache: DesignCache, optional
+        Cache of the designs (default is to build them in memory).
+    :return: pandas.DataFrame
+        ANOVA table indexed by (metric, term), with the ANOVA_COLUMNS in the
+        layout of statsmodels' anova_lm(typ=2).
+    """
+    cache = DesignCache() if cache is None else cache
+    wide = df.pivot_table(
+        index=["dataset", "model", "method"],
+        columns="metric",
+        values="value",
+        observed=True,
+    )
+    model_levels = wide.index.levels[1]
+    method_levels = wide.index.levels[2]
+
+    tables = []
+    present = wide.notna().to_numpy()
+    masks, groups = np.unique(present, axis=1, return_inverse=True)
+    for group, mask in enumerate(masks.T):
+        metrics = wide.columns[np.ravel(groups) == group]
+        rows = wide.index[mask]
+        model_codes = model_levels.get_indexer(rows.get_level_values("model"))
+        method_codes = method_levels.get_indexer(rows.get_level_values("method"))
+        designs = cache.get(
+            model_codes, method_codes, len(model_levels), len(method_levels)
+        )
+
+        Y = wide.loc[mask, metrics].to_numpy(dtype=np.float64)
+        rss = {name: residual_sum_of_squares(Q, Y) for name, Q in designs.items()}
+        rank = {name: Q.shape[1] for name, Q in designs.items()}
+
+        sum_sq = np.vstack(
+            [
+                rss["method"] - rss["additive"],
+                rss["model"] - rss["additive"],
+                rss["additive"] - rss["full"],
+                rss["full"],
+            ]
+        )
+        dof = np.array(
+            [
+                rank["additive"] - rank["method"],
+                rank["additive"] - rank["model"],
+                rank["full"] - rank["additive"],
+                len(Y) - rank["full"],
+            ],
+            dtype=np.float64,
+        )
+        with np.errstate(invalid="ignore", divide="ignore"):
+            F = (sum_sq[:3] / dof[:3, None]) / (sum_sq[3] / dof[3])
+            p = stats.f.sf(F, dof[:3, None], dof[3])
+
+        for i, metric in enumerate(metrics):
+            table = pd.DataFrame(
+                {
+                    "sum_sq": sum_sq[:, i],
+                    "df": dof,
+                    "F": np.append(F[:, i], np.nan),
+                    "PR(>F)": np.append(p[:, i], np.nan),
+                },
+                index=pd.Index(TERMS + ["Residual"], name="term"),
+            )
+            tables.append(pd.concat({metric: table}, names=["metric"]))
+
+    if not tables:
+        return pd.DataFrame(columns=ANOVA_COLUMNS)
+    return pd.concat(tables)
+
+
+def tukey_table(values, groups):
+    """
+    Run Tukey's HSD test on one metric.
+
+    :param values: ndarray
+        The observed values.
+    :param groups: ndarray
+        The group of every value.
+    :return: pandas.DataFrame
+        The pairwise comparisons.
+    """
+    result = pairwise_tukeyhsd(values, groups)
+    table = result._results_table.data
+    return pd.DataFrame(data=table[1:], columns=table[0])
+
+
+def tukey_tables(df, n_jobs=None):
+    """
+    Run Tukey's HSD test of every model/method group for every metric.
+
+    :param df: pandas.DataFrame
+        Long table as returned by load_data.
+    :param n_jobs: int, optional
+        Number of worker processes (default is the number of CPUs).
+        With 1 the metrics are tested in the current process.
+    :return: pandas.DataFrame
+        The pairwise comparisons with a leading metric column.
+    """
+    groups = df["model"].astype(str) + df["method"].astype(str)
+    metrics = list(df["metric"].cat.categories)
+    arguments = [
+        (
+            df["value"].to_numpy()[mask],
+            groups.to_numpy()[mask],
+        )
+        for mask in (df["metric"] == metric for metric in metrics)
+    ]
+
+    n_jobs = min(n_jobs or os.cpu_count() or 1, len(metrics))
+    if n_jobs <= 1:
+        tables = [tukey_table(*args) for args in arguments]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            tables = list(executor.map(tukey_table, *zip(*arguments)))
+
+    if not tables:
+        return pd.DataFrame()
+    result = pd.concat(tables, keys=metrics, names=["metric"])
+    return result.reset_index(level=0).reset_index(drop=True)
+
+
 if __name__ == "__main__":
-    df = load_data(os.path.join(os.getcwd(), 'results'))
+    df = load_data(os.path.join(os.getcwd(), "results"))
     df.to_excel("flatten.xlsx", index=False)
 
-    df = df[df['metric'] == 'balanced_accuracy']
-
-    # Perform one-way ANOVA
-    formula = 'value ~ C(model) + C(method) + C(model):C(method)'
-    model = smf.ols(formula, data=df).fit()
-    anova_table = sm.stats.anova_lm(model, typ=2)
+    # Type II ANOVA of value ~ C(model) + C(method) + C(model):C(method)
+    cache = DesignCache(os.path.join(os.getcwd(), "dataframes", "cache", "designs"))
+    anova_table = anova_tables(df, cache)
     print(anova_table)
 
-    # Perform Tukey's HSD test
-    tukey_result = pairwise_tukeyhsd(df['value'], df['model'] + df['method'])
-    print(tukey_result)
+    # Tukey's HSD test of every model and method
+    tukey_result_frame = tukey_tables(df)
+    print(tukey_result_frame)
 
     # Export ANOVA table and Tukey's HSD test results to separate files
-    anova_table.to_excel("anova_results.xlsx", index=False)
-    tukey_result_frame = pd.DataFrame(data=tukey_result._results_table.data[1:], columns=tukey_result._results_table.data[0])
+    anova_table.reset_index().to_excel("anova_results.xlsx", index=False)
     tukey_result_frame.to_csv("tukey_results.csv", index=False)
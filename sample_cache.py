@@ -0,0 +1,152 @@
+import os
+import json
+import pickle
+import hashlib
+
+import pandas as pd
+
+from handle_pickle import load_pickle, save_pickle
+
+# Bump to invalidate every cached entry, e.g. after changing a sampler
+CACHE_VERSION = 1
+
+
+def hash_dataframe(df):
+    """
+    Compute a content hash of a DataFrame.
+
+    :param df: DataFrame
+        The dataframe to hash.
+    :return: str
+        Hex digest of the columns, dtypes and values of the dataframe.
+    """
+    digest = hashlib.sha256()
+    digest.update(repr(list(df.columns)).encode())
+    digest.update(repr([str(dtype) for dtype in df.dtypes]).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def cache_key(data_hash, dataset, fold, sampler, params):
+    """
+    Build the cache key of a sampled fold.
+
+    :param data_hash: str
+        Content hash of the input dataframe.
+    :param dataset: str
+        The name of the dataset.
+    :param fold: str
+        The file name of the fold, the KEEL file it was read from.
+    :param sampler: str
+        The name of the sampling function.
+    :param params: dict
+        The parameters passed to the sampling function, including the seed.
+    :return: str
+        The cache key.
+    """
+    payload = {
+        "version": CACHE_VERSION,
+        "data": data_hash,
+        "dataset": dataset,
+        "fold": fold,
+        "sampler": sampler,
+        "params": params,
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class SampleCache:
+    """
+    Content-addressed on-disk cache for sampled datasets.
+
+    Every (dataset, fold, sampler, params, seed) combination is stored in its
+    own file, so only missing or invalid entries are ever recomputed.
+
+    :param directory: str
+        Directory where the cached entries are stored.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        """
+        Get the path of a cache entry.
+
+        :param key: str
+            The cache key.
+        :return: str
+            Path to the file of the entry.
+        """
+        return os.path.join(self.directory, key[:2], key + ".pkl")
+
+    def load(self, key):
+        """
+        Load a cache entry.
+
+        :param key: str
+            The cache key.
+        :return: DataFrame or None
+            The cached dataframe, or None if the entry is missing or invalid.
+        """
+        try:
+            entry = load_pickle(self.path(key))
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError, AttributeError):
+            return None
+        if not isinstance(entry, dict) or entry.get("key") != key:
+            return None
+        if not isinstance(entry.get("data"), pd.DataFrame):
+            return None
+        return entry["data"]
+
+    def save(self, key, df):
+        """
+        Save a cache entry atomically.
+
+        :param key: str
+            The cache key.
+        :param df: DataFrame
+            The sampled dataframe.
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        save_pickle({"key": key, "data": df}, path)
+
+    def get_or_compute(
+        self, df, dataset, fold, func, target_col, refresh=False, **params
+    ):
+        """
+        Return a sampled fold from the cache, computing it if needed.
+
+        :param df: DataFrame
+            The input dataframe.
+        :param dataset: str
+            The name of the dataset.
+        :param fold: str
+            The file name of the fold, the KEEL file it was read from.
+        :param func: callable
+            The sampling function, called as func(df, target_col, **params).
+        :param target_col: str
+            The name of the target column (class labels).
+        :param refresh: bool, optional
+            Whether to recompute the entry even if it is cached (default is False).
+        :return: DataFrame
+            The sampled dataframe.
+        """
+        key = cache_key(
+            hash_dataframe(df),
+            dataset,
+            fold,
+            func.__name__,
+            {"target_col": target_col, **params},
+        )
+        if not refresh:
+            cached = self.load(key)
+            if cached is not None:
+                return cached
+
+        sampled = func(df, target_col, **params)
+        self.save(key, sampled)
+        return sampled
@@ -1,9 +1,90 @@
+import numpy as np
 import pandas as pd
-from sklearn.utils import resample
+from sklearn.utils import check_random_state
 from imblearn.over_sampling import SMOTE, ADASYN
 
+from neighbours import SHARED_CACHE, CachedNeighbours
 
-def random_undersampling(df, target_col):
+
+def class_indices(y):
+    """
+    Group the row positions of every class, largest class first.
+
+    :param y: array-like
+        The class labels.
+    :return: list of tuple
+        List of (label, positions) sorted by decreasing class size, ties
+        broken by the first occurrence of the label.
+    """
+    labels, first, inverse, counts = np.unique(
+        np.asarray(y), return_index=True, return_inverse=True, return_counts=True
+    )
+    positions = np.split(np.argsort(inverse, kind="stable"), np.cumsum(counts)[:-1])
+    order = np.lexsort((first, -counts))
+    return [(labels[i], positions[i]) for i in order]
+
+
+def undersample_indices(y, random_state=42, sampling_ratio=1.0):
+    """
+    Select rows for random undersampling without copying any data.
+
+    Every class larger than the target size is reduced to it by sampling
+    without replacement, the other classes are kept.
+
+    :param y: array-like
+        The class labels.
+    :param random_state: int, optional
+        Seed of the random number generator (default is 42).
+    :param sampling_ratio: float, optional
+        Desired ratio of the minority class size to the size of every other
+        class after resampling (default is 1.0).
+    :return: ndarray
+        Positions of the selected rows, largest class first.
+    """
+    classes = class_indices(y)
+    n_target = int(len(classes[-1][1]) / sampling_ratio)
+    rng = check_random_state(random_state)
+
+    selected = []
+    for _, positions in classes:
+        if len(positions) > n_target:
+            shuffled = np.arange(len(positions))
+            rng.shuffle(shuffled)
+            positions = positions[shuffled[:n_target]]
+        selected.append(positions)
+    return np.concatenate(selected)
+
+
+def oversample_indices(y, random_state=42, sampling_ratio=1.0):
+    """
+    Select rows for random oversampling without copying any data.
+
+    Every class smaller than the target size is redrawn with replacement
+    to the target size, the other classes are kept.
+
+    :param y: array-like
+        The class labels.
+    :param random_state: int, optional
+        Seed of the random number generator (default is 42).
+    :param sampling_ratio: float, optional
+        Desired ratio of the size of every other class to the majority
+        class size after resampling (default is 1.0).
+    :return: ndarray
+        Positions of the selected rows, largest class first.
+    """
+    classes = class_indices(y)
+    n_target = int(len(classes[0][1]) * sampling_ratio)
+    rng = check_random_state(random_state)
+
+    selected = []
+    for _, positions in classes:
+        if len(positions) < n_target:
+            positions = positions[rng.randint(0, len(positions), size=n_target)]
+        selected.append(positions)
+    return np.concatenate(selected)
+
+
+def random_undersampling(df, target_col, random_state=42, sampling_ratio=1.0):
     """
     Perform random undersampling to balance the classes.
 
@@ -11,35 +92,21 @@ def random_undersampling(df, target_col):
         The input dataframe with imbalanced classes.
     :param target_col: str
         The name of the target column (class labels).
+    :param random_state: int, optional
+        Seed of the random number generator (default is 42).
+    :param sampling_ratio: float, optional
+        Desired ratio of the minority class size to the size of every other
+        class after resampling (default is 1.0).
     :return: DataFrame
         The resulting dataframe after undersampling.
     """
-    # Calculate class frequencies
-    class_frequencies = df[target_col].value_counts()
-
-    # Identify majority and minority classes
-    majority_class = class_frequencies.idxmax()
-    minority_class = class_frequencies.idxmin()
-
-    # Separate the majority and minority classes
-    majority_instances = df[df[target_col] == majority_class]
-    minority_instances = df[df[target_col] == minority_class]
-
-    # Perform random undersampling on the majority class
-    majority_undersampled = resample(
-        majority_instances,
-        replace=False,
-        n_samples=len(minority_instances),
-        random_state=42,
+    indices = undersample_indices(
+        df[target_col].to_numpy(), random_state, sampling_ratio
     )
-
-    # Concatenate the undersampled majority class with the minority class
-    undersampled_df = pd.concat([majority_undersampled, minority_instances])
-
-    return undersampled_df
+    return df.iloc[indices]
 
 
-def random_oversampling(df, target_col):
+def random_oversampling(df, target_col, random_state=42, sampling_ratio=1.0):
     """
     Perform random oversampling to balance the classes.
 
@@ -47,35 +114,21 @@ def random_oversampling(df, target_col):
         The input dataframe with imbalanced classes.
     :param target_col: str
         The name of the target column (class labels).
+    :param random_state: int, optional
+        Seed of the random number generator (default is 42).
+    :param sampling_ratio: float, optional
+        Desired ratio of the size of every other class to the majority
+        class size after resampling (default is 1.0).
     :return: DataFrame
         The resulting dataframe after oversampling.
     """
-    # Calculate class frequencies
-    class_frequencies = df[target_col].value_counts()
-
-    # Identify majority and minority classes
-    majority_class = class_frequencies.idxmax()
-    minority_class = class_frequencies.idxmin()
-
-    # Separate the majority and minority classes
-    majority_instances = df[df[target_col] == majority_class]
-    minority_instances = df[df[target_col] == minority_class]
-
-    # Perform random oversampling on the minority class
-    minority_oversampled = resample(
-        minority_instances,
-        replace=True,
-        n_samples=len(majority_instances),
-        random_state=42,
+    indices = oversample_indices(
+        df[target_col].to_numpy(), random_state, sampling_ratio
     )
+    return df.iloc[indices]
 
-    # Concatenate the oversampled minority class with the majority class
-    oversampled_df = pd.concat([majority_instances, minority_oversampled])
-
-    return oversampled_df
 
-
-def perform_smote(df, target_col):
+def perform_smote(df, target_col, random_state=42, k_neighbors=None):
     """
     Perform Synthetic Minority Over-sampling Technique (SMOTE) to balance the classes.
 
@@ -83,6 +136,11 @@ def perform_smote(df, target_col):
         The input dataframe with imbalanced classes.
     :param target_col: str
         The name of the target column (class labels).
+    :param random_state: int, optional
+        Seed of the random number generator (default is 42).
+    :param k_neighbors: int, optional
+        Number of nearest neighbours (default is min(5, number of classes - 1)).
+        Neighbours are taken from the shared neighbour cache.
     :return: DataFrame
         The resulting dataframe after applying SMOTE.
     """
@@ -94,12 +152,13 @@ def perform_smote(df, target_col):
     num_classes = len(set(y))
 
     # Determine the number of neighbors for SMOTE
-    n_neighbors = min(
-        5, num_classes - 1
-    )  # Set the maximum number of neighbors to (num_classes - 1)
+    if k_neighbors is None:
+        # Set the maximum number of neighbors to (num_classes - 1)
+        k_neighbors = min(5, num_classes - 1)
+    nn = CachedNeighbours(n_neighbors=k_neighbors + 1)
 
     # Apply SMOTE
-    smote = SMOTE(random_state=42, k_neighbors=n_neighbors)
+    smote = SMOTE(random_state=random_state, k_neighbors=nn)
     X_resampled, y_resampled = smote.fit_resample(X, y)
 
     # Convert the resampled arrays back to a DataFrame
@@ -111,7 +170,7 @@ def perform_smote(df, target_col):
     return resampled_df
 
 
-def perform_adasyn(df, target_col):
+def perform_adasyn(df, target_col, random_state=42, k_neighbors=None):
     """
     Perform Adaptive Synthetic (ADASYN) sampling approach to balance the classes.
 
@@ -119,6 +178,11 @@ def perform_adasyn(df, target_col):
         The input dataframe with imbalanced classes.
     :param target_col: str
         The name of the target column (class labels).
+    :param random_state: int, optional
+        Seed of the random number generator (default is 42).
+    :param k_neighbors: int, optional
+        Number of nearest neighbours (default is min(5, number of classes - 1)).
+        Neighbours are taken from the shared neighbour cache.
     :return: DataFrame
         The resulting dataframe after applying ADASYN.
     """
@@ -130,12 +194,13 @@ def perform_adasyn(df, target_col):
     num_classes = len(set(y))
 
     # Determine the number of neighbors for ADASYN
-    n_neighbors = min(
-        5, num_classes - 1
-    )  # Set the maximum number of neighbors to (num_classes - 1)
+    if k_neighbors is None:
+        # Set the maximum number of neighbors to (num_classes - 1)
+        k_neighbors = min(5, num_classes - 1)
+    nn = CachedNeighbours(n_neighbors=k_neighbors + 1)
 
     # Apply ADASYN
-    adasyn = ADASYN(random_state=42, n_neighbors=n_neighbors)
+    adasyn = ADASYN(random_state=random_state, n_neighbors=nn)
     X_resampled, y_resampled = adasyn.fit_resample(X, y)
 
     # Convert the resampled arrays back to a DataFrame
@@ -145,3 +210,43 @@ def perform_adasyn(df, target_col):
     resampled_df[target_col] = y_resampled
 
     return resampled_df
+
+
+def neighbour_sweep(df, target_col, func, k_values, random_state=42):
+    """
+    Run a SMOTE-family sampler for several numbers of neighbours.
+
+    The neighbour graphs are computed once at the largest k and sliced for
+    the smaller ones.
+
+    :param df: DataFrame
+        The input dataframe with imbalanced classes.
+    :param target_col: str
+        The name of the target column (class labels).
+    :param func: callable
+        perform_smote or perform_adasyn.
+    :param k_values: list of int
+        The numbers of neighbours to try.
+    :param random_state: int, optional
+        Seed of the random number generator (default is 42).
+    :return: dict
+        Dictionary {k: resampled dataframe}.
+    """
+    previous = SHARED_CACHE.max_neighbors
+    SHARED_CACHE.max_neighbors = max(k_values) + 1
+    try:
+        return {
+            k: func(df, target_col, random_state=random_state, k_neighbors=k)
+            for k in k_values
+        }
+    finally:
+        SHARED_CACHE.max_neighbors = previous
+
+
+# Sampling methods available to the experiments, by name
+SAMPLERS = {
+    "random_undersampling": random_undersampling,
+    "random_oversampling": random_oversampling,
+    "perform_smote": perform_smote,
+    "perform_adasyn": perform_adasyn,
+}
@@ -0,0 +1,204 @@
+import os
+import zlib
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from models import ESTIMATORS, VARIANTS, evaluate_fold, fold_input
+from profiling import PROFILER, stage
+
+Task = namedtuple("Task", ["method", "dataset", "fold", "models"])
+
+# Data shared with the worker processes, set once per worker by _init_worker
+_DATA = None
+_STORE = None
+
+
+def build_tasks(data, models=None, folds=None):
+    """
+    Flatten the experiment grid into a list of independent tasks.
+
+    :param data: dict
+        Dictionary {method: {dataset: [train_dfs, test_dfs]}}.
+    :param models: list of str, optional
+        Names of the models to run (default is every registered model).
+    :param folds: list of int, optional
+        Indices of the folds to run (default is every fold).
+    :return: list of Task
+        One task per (method, dataset, fold), in grid order. All models
+        of a task share the preparation of its fold.
+    """
+    models = tuple(ESTIMATORS) if models is None else tuple(models)
+    tasks = []
+    for method, datasets in data.items():
+        for dataset, (train_dfs, test_dfs) in datasets.items():
+            for fold in range(min(len(train_dfs), len(test_dfs))):
+                if folds is not None and fold not in folds:
+                    continue
+                tasks.append(Task(method, dataset, fold, models))
+    return tasks
+
+
+def skip_completed(tasks, completed):
+    """
+    Drop the models, and tasks, whose results are already available.
+
+    :param tasks: list of Task
+        The tasks to filter.
+    :param completed: set of tuple
+        Set of finished (method, dataset, model, fold).
+    :return: list of Task
+        The tasks still to run, each with only its unfinished models.
+    """
+    pending = []
+    for task in tasks:
+        models = tuple(
+            model
+            for model in task.models
+            if (task.method, task.dataset, model, task.fold) not in completed
+        )
+        if models:
+            pending.append(task._replace(models=models))
+    return pending
+
+
+def task_seed(task, seed=42):
+    """
+    Derive a stable random seed for a task.
+
+    The seed depends only on the method, dataset and fold of the task,
+    so it is the same no matter which worker runs it or in which order.
+
+    :param task: Task
+        The task to derive the seed for.
+    :param seed: int, optional
+        Base seed of the run (default is 42).
+    :return: int
+        The seed for the task.
+    """
+    key = "/".join(str(part) for part in task[:3]).encode()
+    return (zlib.crc32(key) ^ seed) & 0xFFFFFFFF
+
+
+def _init_worker(data, store=None, registry=None):
+    global _DATA, _STORE
+    _DATA = data
+    _STORE = store
+    if registry is not None:
+        # Models registered at run time are not known to spawned workers
+        ESTIMATORS.update(registry[0])
+        VARIANTS.update(registry[1])
+
+
+def run_task(task, seed=42):
+    """
+    Train and evaluate the models of a task on its fold.
+
+    :param task: Task
+        The task to run.
+    :param seed: int, optional
+        Base seed of the run (default is 42).
+    :return: tuple
+        Dictionaries {model: metrics} and {model: timings} for the fold.
+    """
+    train_dfs, test_dfs = _DATA[task.method][task.dataset]
+    with stage("task", method=task.method, dataset=task.dataset, fold=task.fold):
+        return evaluate_fold(
+            fold_input(train_dfs, task.fold),
+            fold_input(test_dfs, task.fold),
+            task.models,
+            store=_STORE,
+            context=task[:3],
+            seed=task_seed(task, seed),
+        )
+
+
+def _run_chunk(chunk, seed):
+    # The stage records of the chunk are sent back with the results, records
+    # inherited from the parent by a forked worker are not
+    start = len(PROFILER.records)
+    return [run_task(task, seed) for task in chunk], PROFILER.drain(start)
+
+
+def default_chunksize(n_tasks, n_jobs):
+    """
+    Pick a chunk size that keeps every worker busy with a few chunks.
+
+    :param n_tasks: int
+        Number of tasks to run.
+    :param n_jobs: int
+        Number of worker processes.
+    :return: int
+        The chunk size.
+    """
+    return max(1, n_tasks // (n_jobs * 4))
+
+
+def run_tasks(
+    tasks, data, n_jobs=None, chunksize=None, seed=42, store=None, callback=None
+):
+    """
+    Run tasks on a process pool and assemble the results.
+
+    Results are collected in task order, so the output is the same as
+    for a serial run regardless of the number of workers. The callback is
+    called as soon as each task finishes, in completion order. The stage
+    timings recorded by the workers are merged into the profiler of the
+    current process.
+
+    :param tasks: list of Task
+        The tasks to run, usually created with build_tasks.
+    :param data: dict
+        Dictionary {method: {dataset: [train_dfs, test_dfs]}}.
+    :param n_jobs: int, optional
+        Number of worker processes (default is the number of CPUs).
+        With 1 the tasks run in the current process.
+    :param chunksize: int, optional
+        Number of tasks sent to a worker at once (default is chosen
+        from the number of tasks and workers).
+    :param seed: int, optional
+        Base seed of the run (default is 42).
+    :param store: ModelStore, optional
+        Store used to reuse and save the per-fold predictions.
+    :param callback: callable, optional
+        Called as callback(task, fold_metrics, fold_timings) for every
+        finished task.
+    :return: dict
+        Dictionary {method: {dataset: {model: [fold metrics]}}}.
+    """
+    n_jobs = n_jobs or os.cpu_count() or 1
+    metrics = [None] * len(tasks)
+
+    def collect(start, output):
+        chunk_outputs, records = output
+        PROFILER.extend(records)
+        for index, (fold_metrics, fold_timings) in enumerate(chunk_outputs, start):
+            metrics[index] = fold_metrics
+            if callback is not None:
+                callback(tasks[index], fold_metrics, fold_timings)
+
+    if n_jobs == 1:
+        _init_worker(data, store)
+        for index, task in enumerate(tasks):
+            collect(index, _run_chunk([task], seed))
+    else:
+        chunksize = chunksize or default_chunksize(len(tasks), n_jobs)
+        with ProcessPoolExecutor(
+            max_workers=n_jobs,
+            initializer=_init_worker,
+            initargs=(data, store, (ESTIMATORS, VARIANTS)),
+        ) as executor:
+            futures = {
+                executor.submit(
+                    _run_chunk, tasks[start : start + chunksize], seed
+                ): start
+                for start in range(0, len(tasks), chunksize)
+            }
+            for future in as_completed(futures):
+                collect(futures[future], future.result())
+
+    results = {}
+    for task, fold_metrics in zip(tasks, metrics):
+        models = results.setdefault(task.method, {}).setdefault(task.dataset, {})
+        for model, model_metrics in fold_metrics.items():
+            models.setdefault(model, []).append(model_metrics)
+    return results
@@ -1,3 +1,11 @@
+import os
+import json
+import warnings
+import argparse
+from functools import lru_cache
+from itertools import combinations
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
 from scipy import stats
@@ -5,6 +13,18 @@ import statsmodels.api as sm
 from statsmodels.formula.api import ols
 from statsmodels.stats.multicomp import pairwise_tukeyhsd
 
+from checkpoint import RunManifest
+from handle_pickle import atomic_write
+from result_store import ResultStore
+
+FACTORS = ["metric", "method", "model"]
+# The observations of a slice, paired across methods and models
+PAIRING = ["dataset", "fold"]
+REPORT_VERSION = 1
+# Largest number of pairs with an exact Wilcoxon distribution, as in scipy 1.10;
+# newer versions fall back to a much slower permutation test on ties
+WILCOXON_EXACT = 50
+
 
 def load_data(file_path):
     """
@@ -19,16 +39,52 @@ def load_data(file_path):
     return df
 
 
-def descriptive_stats(df):
+def load_records(records_path, runs=None):
+    """
+    Load the per-fold results of a result store into a long table.
+
+    :param records_path: str
+        Path to the JSONL result store.
+    :param runs: dict, optional
+        Dictionary {(method, model): hash} of the current settings of every
+        cell, as returned by RunManifest.cell_runs. Records written with
+        other settings are left out, as in ResultStore.export (default is
+        None, every record).
+    :return: DataFrame
+        One row per method, dataset, model, fold and metric with its value.
+        The method, dataset, model and metric columns are categorical.
+    """
+    store = ResultStore(records_path, runs)
+    records = {
+        key: record
+        for key, record in store.records().items()
+        if store.is_current(record)
+    }
+    keys = ["method", "dataset", "model", "fold"]
+    wide = pd.DataFrame.from_records(
+        [record["metrics"] for record in records.values()],
+        index=pd.MultiIndex.from_tuples(list(records), names=keys),
+    )
+    df = wide.reset_index().melt(id_vars=keys, var_name="metric")
+    df = df.dropna(subset=["value"]).reset_index(drop=True)
+    df["value"] = df["value"].astype(np.float64)
+    for column in ["method", "dataset", "model", "metric"]:
+        df[column] = df[column].astype("category")
+    return df
+
+
+def descriptive_stats(df, by="model"):
     """
     Compute descriptive statistics for each model.
 
     :param df: DataFrame
-        The input data with columns 'model' and 'value'.
+        The input data with columns 'value' and the by columns.
+    :param by: str or list of str, optional
+        The columns to group by (default is "model").
     :return: DataFrame
         The computed descriptive statistics.
     """
-    descriptive_stats = df.groupby("model")["value"].describe()
+    descriptive_stats = df.groupby(by, observed=True)["value"].describe()
     return descriptive_stats
 
 
@@ -41,14 +97,17 @@ def test_normality(df):
     :return: dict
         The results of the Shapiro-Wilk test for each model.
     """
-    normality = {}
-    for model in df["model"].unique():
-        _, p = stats.shapiro(df[df["model"] == model]["value"])
-        if p > 0.05:
-            normality[model] = "Data is normally distributed."
-        else:
-            normality[model] = "Data is not normally distributed."
-    return normality
+    p_values = df.groupby("model", sort=False)["value"].agg(
+        lambda values: stats.shapiro(values)[1]
+    )
+    return {
+        model: (
+            "Data is normally distributed."
+            if p > 0.05
+            else "Data is not normally distributed."
+        )
+        for model, p in p_values.items()
+    }
 
 
 def anova_test(df):
@@ -78,9 +137,326 @@ def posthoc_test(df):
     return posthoc
 
 
+def normality_table(df, alpha=0.05):
+    """
+    Run the Shapiro-Wilk test of every metric x method x model slice.
+
+    The slices are laid out as the columns of one matrix of observations
+    and tested one column at a time on their non-NaN values, which works
+    with scipy releases without the vectorized shapiro.
+
+    :param df: DataFrame
+        Long table as returned by load_records.
+    :param alpha: float, optional
+        Significance level (default is 0.05).
+    :return: DataFrame
+        One row per slice with the number of observations, the W statistic,
+        the p-value and whether the values look normally distributed.
+    """
+    matrix = df.pivot_table(
+        index=PAIRING, columns=FACTORS, values="value", observed=True
+    )
+    values = matrix.to_numpy()
+    n = (~np.isnan(values)).sum(axis=0)
+    statistic = np.full(values.shape[1], np.nan)
+    p_value = np.full(values.shape[1], np.nan)
+    # Shapiro-Wilk needs at least three values
+    testable = n >= 3
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for column in np.flatnonzero(testable):
+            observed = values[:, column]
+            result = stats.shapiro(observed[~np.isnan(observed)])
+            statistic[column], p_value[column] = result
+
+    table = matrix.columns.to_frame(index=False)
+    table["n"] = n
+    table["statistic"] = statistic
+    table["p_value"] = p_value
+    table["normal"] = p_value > alpha
+    return table
+
+
+def slices(df, compare="model"):
+    """
+    Split the results into slices where one factor is compared.
+
+    :param df: DataFrame
+        Long table as returned by load_records.
+    :param compare: str, optional
+        The factor compared, "model" or "method" (default is "model"). The
+        slices are the metric x other factor combinations.
+    :return: list of tuple
+        List of (slice key, matrix) where the matrix has one row per
+        dataset and fold and one column per compared group.
+    """
+    other = "method" if compare == "model" else "model"
+    result = []
+    for key, group in df.groupby(["metric", other], observed=True, sort=True):
+        matrix = group.pivot_table(
+            index=PAIRING, columns=compare, values="value", observed=True
+        )
+        if matrix.shape[1] >= 2:
+            result.append(({"metric": key[0], other: key[1]}, matrix))
+    return result
+
+
+def holm(p_values):
+    """
+    Adjust p-values with Holm's step-down method, ignoring NaN.
+
+    :param p_values: ndarray
+        The raw p-values.
+    :return: ndarray
+        The adjusted p-values.
+    """
+    p_values = np.asarray(p_values, dtype=np.float64)
+    adjusted = np.full(len(p_values), np.nan)
+    valid = ~np.isnan(p_values)
+    p, m = p_values[valid], valid.sum()
+
+    # The i-th smallest p-value is multiplied by m - i, then made monotone
+    order = np.argsort(p, kind="stable")
+    steps = np.maximum.accumulate(p[order] * (m - np.arange(m)))
+    adjusted[np.flatnonzero(valid)[order]] = np.minimum(steps, 1.0)
+    return adjusted
+
+
+@lru_cache(maxsize=None)
+def tukey_critical(k, df, alpha):
+    """
+    Get the critical value of the studentized range.
+
+    Slices of the same shape share it, and computing it integrates the
+    distribution numerically, so it is cached.
+
+    :param k: int
+        The number of groups.
+    :param df: int
+        The residual degrees of freedom.
+    :param alpha: float
+        Significance level.
+    :return: float
+        The 1 - alpha quantile of the studentized range.
+    """
+    return stats.studentized_range.ppf(1 - alpha, k, df)
+
+
+def tukey_hsd(samples, labels, alpha=0.05):
+    """
+    Run the Tukey-Kramer HSD test of every pair of groups.
+
+    Gives the same comparisons as statsmodels' pairwise_tukeyhsd, without
+    recomputing the critical value of every slice.
+
+    :param samples: list of ndarray
+        The values of every group, at least two per group.
+    :param labels: list of str
+        The name of every group.
+    :param alpha: float, optional
+        Significance level (default is 0.05).
+    :return: list of dict
+        One record per pair with the mean difference (group2 - group1), its
+        adjusted p-value and confidence interval, and whether it is rejected.
+    """
+    order = np.argsort(labels, kind="stable")
+    counts = np.array([len(samples[i]) for i in order], dtype=np.float64)
+    means = np.array([samples[i].mean() for i in order])
+    df = int(counts.sum() - len(counts))
+    mse = sum(((samples[i] - samples[i].mean()) ** 2).sum() for i in order) / df
+
+    first, second = np.triu_indices(len(order), 1)
+    meandiff = means[second] - means[first]
+    se = np.sqrt(mse / 2 * (1 / counts[first] + 1 / counts[second]))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        p_value = stats.studentized_range.sf(np.abs(meandiff) / se, len(order), df)
+    margin = tukey_critical(len(order), df, alpha) * se
+    return [
+        {
+            "group1": labels[order[i]],
+            "group2": labels[order[j]],
+            "statistic": float(meandiff[index]),
+            "p_adjusted": float(min(p_value[index], 1.0)),
+            "lower": float(meandiff[index] - margin[index]),
+            "upper": float(meandiff[index] + margin[index]),
+            "reject": bool(np.abs(meandiff[index]) > margin[index]),
+        }
+        for index, (i, j) in enumerate(zip(first, second))
+    ]
+
+
+def slice_tests(key, compare, matrix, alpha=0.05):
+    """
+    Run the omnibus and pairwise tests of one slice.
+
+    :param key: dict
+        The metric and the fixed factor of the slice.
+    :param compare: str
+        The factor compared.
+    :param matrix: DataFrame
+        Observations (dataset and fold) x compared groups.
+    :param alpha: float, optional
+        Significance level (default is 0.05).
+    :return: tuple
+        The omnibus records (ANOVA and Kruskal-Wallis over all values of
+        every group) and the pairwise records (Wilcoxon signed-rank over
+        the paired observations, Holm adjusted, and Tukey HSD).
+    """
+    labels = [str(label) for label in matrix.columns]
+    values = matrix.to_numpy()
+    samples = [column[~np.isnan(column)] for column in values.T]
+    base = {**key, "compare": compare}
+
+    omnibus = []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for test, func in (("anova", stats.f_oneway), ("kruskal", stats.kruskal)):
+            try:
+                statistic, p_value = func(*samples)
+            except ValueError:
+                statistic, p_value = np.nan, np.nan
+            omnibus.append(
+                {
+                    **base,
+                    "test": test,
+                    "statistic": float(statistic),
+                    "p_value": float(p_value),
+                    "groups": len(samples),
+                    "n": int(sum(len(sample) for sample in samples)),
+                }
+            )
+
+        # All pairs at once, one column of differences per pair
+        pairs = list(combinations(range(len(labels)), 2))
+        first, second = np.array(pairs).T
+        differences = values[:, first] - values[:, second]
+        n_pairs = (~np.isnan(differences)).sum(axis=0)
+        try:
+            method = "exact" if len(differences) <= WILCOXON_EXACT else "approx"
+            wilcoxon = stats.wilcoxon(
+                differences, axis=0, nan_policy="omit", method=method
+            )
+            statistic, p_value = wilcoxon.statistic, wilcoxon.pvalue
+        except ValueError:
+            statistic = p_value = np.full(len(pairs), np.nan)
+    p_adjusted = holm(p_value)
+
+    pairwise = [
+        {
+            **base,
+            "test": "wilcoxon",
+            "group1": labels[i],
+            "group2": labels[j],
+            "n": int(n_pairs[index]),
+            "statistic": float(statistic[index]),
+            "p_value": float(p_value[index]),
+            "p_adjusted": float(p_adjusted[index]),
+            "reject": bool(p_adjusted[index] < alpha),
+        }
+        for index, (i, j) in enumerate(pairs)
+    ]
+
+    if all(len(sample) >= 2 for sample in samples):
+        pairwise.extend(
+            {**base, "test": "tukey", **record}
+            for record in tukey_hsd(samples, labels, alpha)
+        )
+    return omnibus, pairwise
+
+
+def _run_slices(tasks, alpha):
+    return [slice_tests(key, compare, matrix, alpha) for key, compare, matrix in tasks]
+
+
+def run_tests(df, compare=("model", "method"), alpha=0.05, n_jobs=None):
+    """
+    Run every test on every slice of the results.
+
+    :param df: DataFrame
+        Long table as returned by load_records.
+    :param compare: iterable of str, optional
+        The factors compared within the slices (default is both models and
+        methods).
+    :param alpha: float, optional
+        Significance level (default is 0.05).
+    :param n_jobs: int, optional
+        Number of worker processes (default is the number of CPUs).
+        With 1 the slices are tested in the current process.
+    :return: dict
+        Dictionary with the "descriptive", "normality", "omnibus" and
+        "pairwise" tables as DataFrames.
+    """
+    tasks = [
+        (key, factor, matrix)
+        for factor in compare
+        for key, matrix in slices(df, factor)
+    ]
+    n_jobs = n_jobs or os.cpu_count() or 1
+    if n_jobs == 1 or len(tasks) < 2:
+        results = _run_slices(tasks, alpha)
+    else:
+        # A few chunks per worker, slices are small and quick to test
+        chunksize = max(1, len(tasks) // (n_jobs * 4))
+        chunks = [tasks[i : i + chunksize] for i in range(0, len(tasks), chunksize)]
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = [
+                result
+                for chunk in executor.map(_run_slices, chunks, [alpha] * len(chunks))
+                for result in chunk
+            ]
+
+    def table(rows):
+        table = pd.DataFrame(rows)
+        leading = [c for c in FACTORS + ["compare", "test"] if c in table.columns]
+        return table[leading + [c for c in table.columns if c not in leading]]
+
+    return {
+        "descriptive": descriptive_stats(df, FACTORS).reset_index(),
+        "normality": normality_table(df, alpha),
+        "omnibus": table([row for omnibus, _ in results for row in omnibus]),
+        "pairwise": table([row for _, pairwise in results for row in pairwise]),
+    }
+
+
+def write_report(tables, path, alpha=0.05):
+    """
+    Write the test results to one JSON report.
+
+    :param tables: dict
+        Tables as returned by run_tests.
+    :param path: str
+        Path of the JSON file.
+    :param alpha: float, optional
+        The significance level the tests were run with (default is 0.05).
+    """
+    report = {"version": REPORT_VERSION, "alpha": alpha}
+    for name, table in tables.items():
+        # NaN is not valid JSON
+        table = table.astype(object).where(table.notna(), None)
+        report[name] = table.to_dict(orient="records")
+    with atomic_write(path) as json_file:
+        json.dump(report, json_file, indent=4, default=str)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Test the differences between the models and sampling methods."
+    )
+    parser.add_argument("--results", default=os.path.join(os.getcwd(), "results"))
+    parser.add_argument(
+        "--compare", nargs="+", choices=["model", "method"], default=["model", "method"]
+    )
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--n-jobs", type=int, default=None)
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
-    df = load_data("your_data.csv")
-    print("Descriptive statistics:\n", descriptive_stats(df))
-    print("Normality tests:\n", test_normality(df))
-    print("ANOVA table:\n", anova_test(df))
-    print("Post hoc test results:\n", posthoc_test(df))
+    args = parse_args()
+    runs = RunManifest(os.path.join(args.results, "run_manifest.json")).cell_runs()
+    df = load_records(os.path.join(args.results, "records.jsonl"), runs)
+    tables = run_tests(df, args.compare, args.alpha, args.n_jobs)
+    path = os.path.join(args.results, "statistics.json")
+    write_report(tables, path, args.alpha)
+    print(tables["omnibus"].to_string())
+    print(f"Saved the report to {path}")
@@ -1,97 +1,281 @@
+import zlib
+from collections import OrderedDict
+
 import numpy as np
-import pandas as pd
-from scipy.stats import mode
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.tree import DecisionTreeClassifier
-from sklearn.naive_bayes import GaussianNB
-from sklearn.metrics import (
-    accuracy_score,
-    balanced_accuracy_score,
-    precision_score,
-    recall_score,
-    f1_score,
-    roc_auc_score,
-)
-
-
-def calculate_metrics(y_true, y_pred):
-    accuracy = accuracy_score(y_true, y_pred)
-    balanced_accuracy = balanced_accuracy_score(y_true, y_pred)
-    precision = precision_score(y_true, y_pred)
-    recall = recall_score(y_true, y_pred)
-    f1 = f1_score(y_true, y_pred)
-    classification_error = 1 - accuracy
-    auc_roc = roc_auc_score(y_true, y_pred)
+from joblib import Parallel, delayed
+
+from metrics import evaluate_many
+from model_store import fold_fingerprint, model_config, store_key
+from models import ESTIMATORS, fold_arrays, iter_folds, predict_scores
+from profiling import stage, timings
+from voting import ensemble_predict, ensemble_scores, stack
+
+# Subset fits of the most recent folds and models, see fit_subsets
+_SUBSET_CACHE = OrderedDict()
+SUBSET_CACHE_SIZE = 64
+
+
+def split_majority(y, random_state=42):
+    """
+    Split the majority class into balanced subsets.
+
+    The majority class is shuffled and split into round(IR) parts, where IR
+    is the imbalance ratio, so every part is about the size of the minority
+    class.
+
+    :param y: ndarray
+        The encoded class labels (0 or 1).
+    :param random_state: int, optional
+        Seed used to shuffle the majority class (default is 42).
+    :return: tuple
+        Tuple (minority positions, list of majority subset positions).
+    """
+    counts = np.bincount(y, minlength=2)
+    minority = np.flatnonzero(y == np.argmin(counts))
+    majority = np.flatnonzero(y == np.argmax(counts))
+
+    k = round(len(majority) / len(minority))
+    shuffled = majority[np.random.RandomState(random_state).permutation(len(majority))]
+    return minority, np.array_split(shuffled, k)
+
 
+def subset_seeds(name, random_state, n_subsets):
+    """
+    Draw the seeds of the subset models of one model.
+
+    The seeds only depend on the model name, so a model gets the same fits
+    whichever other models are fitted with it.
+
+    :param name: str
+        The name of the model.
+    :param random_state: int
+        Seed of the run.
+    :param n_subsets: int
+        The number of subsets.
+    :return: ndarray
+        One seed per subset.
+    """
+    seed = (random_state + zlib.crc32(name.encode())) & 0xFFFFFFFF
+    return np.random.RandomState(seed).randint(2**31 - 1, size=n_subsets)
+
+
+def _fit_predict(name, seed, rows, held_out, X_train, y_train, X_test, weighted=True):
+    model = ESTIMATORS[name]()
+    if "random_state" in model.get_params():
+        model.set_params(random_state=seed)
+    with stage("umce_fit", model=name) as fit:
+        model.fit(X_train[rows], y_train[rows])
+    weight = None
+    if weighted:
+        # Accuracy on the majority rows of the other subsets and the
+        # minority, the subset's own majority rows would score about 1.0
+        weight = np.mean(model.predict(X_train[held_out]) == y_train[held_out])
+    with stage("umce_predict", model=name) as predict:
+        predictions = model.predict(X_test)
+    scores = predict_scores(model, X_test)
+    return predictions, scores, weight, fit["wall"], predict["wall"]
+
+
+def _load_fit(store, key):
+    entry = store.load(key)
+    if entry is None:
+        return None
+    meta = entry["meta"]
+    weights = meta["weights"]
     return {
-        "accuracy": accuracy,
-        "balanced_accuracy": balanced_accuracy,
-        "precision": precision,
-        "recall": recall,
-        "f1_score": f1,
-        "classification_error": classification_error,
-        "auc_roc": auc_roc,
+        "predictions": entry["y_pred"],
+        "scores": entry["y_score"],
+        "weights": None if weights is None else np.array(weights),
+        "fit_time": meta["fit_time"],
+        "predict_time": meta["predict_time"],
     }
 
 
-def majority_vote(prediction_lists):
-    return mode(prediction_lists, axis=0, keepdims=False)[0][0]
-
+def _save_fit(store, key, name, y_test, fit):
+    weights = fit["weights"]
+    meta = {
+        "method": "umce",
+        "model": name,
+        "kind": "subsets",
+        "weights": None if weights is None else weights.tolist(),
+        "fit_time": fit["fit_time"],
+        "predict_time": fit["predict_time"],
+    }
+    store.save(key, meta, y_test, fit["predictions"], fit["scores"])
 
-def create_imbalanced_ensemble(train_dfs, test_dfs):
-    metrics_rf = []
-    metrics_dt = []
-    metrics_nb = []
 
-    for train_df, test_df in zip(train_dfs, test_dfs):
-        train_df["Class"] = train_df["Class"].map({"negative": 0, "positive": 1})
-        test_df["Class"] = test_df["Class"].map({"negative": 0, "positive": 1})
-        class_counts = train_df["Class"].value_counts()
-        minority_label = class_counts.idxmin()
-        majority_label = class_counts.idxmax()
+def fit_subsets(
+    train_df,
+    test_df,
+    models=None,
+    n_jobs=None,
+    random_state=42,
+    weighted=True,
+    store=None,
+    target_column="Class",
+):
+    """
+    Fit every model on every balanced subset of a fold.
 
-        minority_samples = train_df[train_df["Class"] == minority_label]
-        majority_samples = train_df[train_df["Class"] == majority_label]
+    The subset models are fitted concurrently and the test matrix is built
+    once per fold. The predictions of the most recent folds are cached in
+    memory and, if a store is given, on disk, so changing only the voting
+    rule does not refit anything. The inputs are not modified.
 
-        imbalance_ratio = len(majority_samples) / len(minority_samples)
-        k = round(imbalance_ratio)
+    :param train_df: DataFrame or tuple
+        The training dataset, or its arrays (X, y).
+    :param test_df: DataFrame or tuple
+        The testing dataset, or its arrays (X, y).
+    :param models: list of str, optional
+        Names of the models to fit (default is every registered model).
+    :param n_jobs: int, optional
+        Number of threads used to fit the subset models (default is 1).
+    :param random_state: int, optional
+        Seed of the subsets and of the subset models (default is 42).
+    :param weighted: bool, optional
+        Whether to compute the held-out accuracy of the subset models, only
+        needed by the "weighted" voting rule (default is True).
+    :param store: ModelStore, optional
+        Store used to reuse and save the subset predictions.
+    :param target_column: str, optional
+        The name of the target column (default is "Class").
+    :return: tuple
+        Tuple (y_test, fits), where fits is a dictionary {model: fit} and
+        every fit is a dictionary with the stacked "predictions" and
+        "scores" (one row per subset, scores is None if the model has no
+        predict_proba), the "weights" (held-out accuracy, None if not
+        weighted) of the subsets and their total "fit_time" and
+        "predict_time".
+    """
+    models = tuple(ESTIMATORS) if models is None else tuple(models)
+    X_train, y_train = fold_arrays(train_df, target_column)
+    X_test, y_test = fold_arrays(test_df, target_column)
+    X_test = X_test.astype(X_train.dtype, copy=False)
 
-        shuffled_majority_samples = majority_samples.sample(frac=1, random_state=42)
-        majority_subsets = np.array_split(shuffled_majority_samples, k)
+    data_hash = fold_fingerprint(X_train, y_train, X_test, y_test)
+    keys, fits = {}, {}
+    for name in models:
+        config = model_config(ESTIMATORS[name]())
+        keys[name] = store_key(
+            "umce", None, None, name, config, data_hash, random_state
+        )
+        fit = _SUBSET_CACHE.get(keys[name])
+        if fit is None and store is not None:
+            fit = _load_fit(store, keys[name])
+        # Fits without weights are refitted for the weighted rule
+        if fit is not None and (fit["weights"] is not None or not weighted):
+            fits[name] = fit
 
-        rf_predictions = []
-        dt_predictions = []
-        nb_predictions = []
+    missing = [name for name in models if name not in fits]
+    if missing:
+        minority, subsets = split_majority(y_train, random_state)
+        rows = [np.concatenate([subset, minority]) for subset in subsets]
+        held_out = [
+            np.concatenate([*subsets[:i], *subsets[i + 1 :], minority])
+            for i in range(len(subsets))
+        ]
+        jobs = [
+            (name, subset, seed)
+            for name in missing
+            for subset, seed in enumerate(subset_seeds(name, random_state, len(rows)))
+        ]
 
-        for i in range(k):
-            training_set = pd.concat([majority_subsets[i], minority_samples])
+        # Tree fitting releases the GIL, threads avoid copying the fold
+        outputs = Parallel(n_jobs=n_jobs, prefer="threads")(
+            delayed(_fit_predict)(
+                name,
+                seed,
+                rows[subset],
+                held_out[subset],
+                X_train,
+                y_train,
+                X_test,
+                weighted,
+            )
+            for name, subset, seed in jobs
+        )
 
-            X_train = training_set.drop("Class", axis=1).values
-            y_train = training_set["Class"].values
+        for name in missing:
+            predictions, scores, weights, fit_times, predict_times = zip(
+                *(out for job, out in zip(jobs, outputs) if job[0] == name)
+            )
+            has_scores = all(score is not None for score in scores)
+            fits[name] = {
+                "predictions": stack(predictions),
+                "scores": stack(scores, np.float64) if has_scores else None,
+                "weights": np.array(weights) if weighted else None,
+                "fit_time": sum(fit_times),
+                "predict_time": sum(predict_times),
+            }
+            if store is not None:
+                _save_fit(store, keys[name], name, y_test, fits[name])
 
-            X_test = test_df.drop("Class", axis=1).values
-            y_test = test_df["Class"].values
+    for name in models:
+        _SUBSET_CACHE[keys[name]] = fits[name]
+        _SUBSET_CACHE.move_to_end(keys[name])
+    while len(_SUBSET_CACHE) > SUBSET_CACHE_SIZE:
+        _SUBSET_CACHE.popitem(last=False)
+    return y_test, {name: fits[name] for name in models}
 
-            rf_classifier = RandomForestClassifier()  # Random Forest classifier
-            rf_classifier.fit(X_train, y_train)
-            rf_predictions.append(rf_classifier.predict(X_test))
 
-            dt_classifier = DecisionTreeClassifier()  # Decision Tree classifier
-            dt_classifier.fit(X_train, y_train)
-            dt_predictions.append(dt_classifier.predict(X_test))
+def create_imbalanced_ensemble(
+    train_dfs,
+    test_dfs,
+    vote="hard",
+    models=None,
+    n_jobs=None,
+    folds=None,
+    random_state=42,
+    store=None,
+):
+    """
+    Train and evaluate an undersampled majority class ensemble (UMCE).
 
-            nb_classifier = GaussianNB()  # Naive Bayes classifier
-            nb_classifier.fit(X_train, y_train)
-            nb_predictions.append(nb_classifier.predict(X_test))
+    The folds are loaded one at a time, so only the fold being fitted is
+    held in memory.
 
-        # Majority vote
-        rf_majority_vote = majority_vote(rf_predictions)
-        dt_majority_vote = majority_vote(dt_predictions)
-        nb_majority_vote = majority_vote(nb_predictions)
+    :param train_dfs: list of DataFrame or StoredFrames
+        The list of training datasets.
+    :param test_dfs: list of DataFrame or StoredFrames
+        The list of testing datasets.
+    :param vote: str or callable, optional
+        "hard" (majority), "soft" (mean probability), "weighted" (accuracy
+        on the training rows a subset model did not fit), or a callable
+        combining the stacked subset predictions of shape (k, n_test)
+        (default is "hard").
+    :param models: list of str, optional
+        Names of the models to use (default is every registered model).
+    :param n_jobs: int, optional
+        Number of threads used to fit the subset models (default is 1).
+    :param folds: list of int, optional
+        Indices of the folds to evaluate (default is every fold).
+    :param random_state: int, optional
+        Seed of the subsets and of the subset models (default is 42).
+    :param store: ModelStore, optional
+        Store used to reuse and save the subset predictions.
+    :return: tuple
+        Tuple (metrics, timings), each with one list per model and one entry
+        per evaluated fold. The timings hold the total "fit_time" and
+        "predict_time" of the subset models. ROC-AUC and PR-AUC are computed
+        from the ensemble scores of the voting rule (share of votes, mean
+        probability or weighted share of votes).
+    """
+    models = tuple(ESTIMATORS) if models is None else tuple(models)
+    evaluations, times = [], []
 
-        # Calculate metrics
-        metrics_rf.append(calculate_metrics(y_test, rf_majority_vote))
-        metrics_dt.append(calculate_metrics(y_test, dt_majority_vote))
-        metrics_nb.append(calculate_metrics(y_test, nb_majority_vote))
+    for train, test in iter_folds(train_dfs, test_dfs, folds):
+        y_test, fits = fit_subsets(
+            train, test, models, n_jobs, random_state, vote == "weighted", store
+        )
+        for name in models:
+            fit = fits[name]
+            predictions = ensemble_predict(fit, vote)
+            evaluations.append((y_test, predictions, ensemble_scores(fit, vote)))
+            times.append(timings(fit))
 
-    return metrics_rf, metrics_dt, metrics_nb
+    # Every fold and model is evaluated in one batch
+    metrics = evaluate_many(evaluations)
+    return (
+        tuple(metrics[i :: len(models)] for i in range(len(models))),
+        tuple(times[i :: len(models)] for i in range(len(models))),
+    )
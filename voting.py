@@ -0,0 +1,137 @@
+import numpy as np
+
+
+def stack(arrays, dtype=None):
+    """
+    Stack per-model outputs into one contiguous array.
+
+    :param arrays: list of array-like
+        One prediction or probability vector per model, all of length n.
+    :param dtype: numpy dtype, optional
+        The dtype of the result (default is inferred from the inputs).
+    :return: ndarray
+        C-contiguous array of shape (k, n).
+    """
+    return np.ascontiguousarray(np.vstack(arrays), dtype=dtype)
+
+
+def hard_vote(predictions):
+    """
+    Per-sample majority vote over the predicted labels.
+
+    Ties go to the smallest label, as with scipy.stats.mode.
+
+    :param predictions: array-like
+        Predicted labels of shape (k, n), one row per model.
+    :return: ndarray
+        The ensemble prediction for each of the n samples.
+    """
+    predictions = np.asarray(predictions)
+    labels, inverse = np.unique(predictions, return_inverse=True)
+    inverse = inverse.reshape(predictions.shape)
+    counts = (inverse[None, :, :] == np.arange(len(labels))[:, None, None]).sum(axis=1)
+    return labels[counts.argmax(axis=0)]
+
+
+def soft_vote(scores, threshold=0.5):
+    """
+    Per-sample vote on the mean predicted probability of the positive class.
+
+    :param scores: array-like
+        Predicted probabilities of shape (k, n), one row per model.
+    :param threshold: float, optional
+        Mean probability above which a sample is positive (default is 0.5).
+    :return: ndarray
+        The ensemble prediction (0 or 1) for each of the n samples.
+    """
+    return (np.asarray(scores).mean(axis=0) > threshold).astype(np.int8)
+
+
+def weighted_vote(predictions, weights):
+    """
+    Per-sample vote with one weight per model, e.g. its accuracy.
+
+    :param predictions: array-like
+        Predicted labels (0 or 1) of shape (k, n), one row per model.
+    :param weights: array-like
+        Non-negative weight of each of the k models.
+    :return: ndarray
+        The ensemble prediction (0 or 1) for each of the n samples.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    support = weights @ np.asarray(predictions, dtype=np.float64)
+    return (support > weights.sum() / 2).astype(np.int8)
+
+
+def vote_share(predictions, weights=None):
+    """
+    Per-sample (weighted) share of the models voting for the positive class.
+
+    :param predictions: array-like
+        Predicted labels (0 or 1) of shape (k, n), one row per model.
+    :param weights: array-like, optional
+        Non-negative weight of each of the k models (default is None, equal
+        weights).
+    :return: ndarray
+        The share of positive votes for each of the n samples.
+    """
+    predictions = np.asarray(predictions, dtype=np.float64)
+    if weights is None:
+        return predictions.mean(axis=0)
+    weights = np.asarray(weights, dtype=np.float64)
+    total = weights.sum()
+    support = weights @ predictions
+    return support / total if total else np.zeros_like(support)
+
+
+VOTE_RULES = {
+    "hard": lambda fit: hard_vote(fit["predictions"]),
+    "soft": lambda fit: soft_vote(fit["scores"]),
+    "weighted": lambda fit: weighted_vote(fit["predictions"], fit["weights"]),
+}
+
+
+def ensemble_predict(fit, rule="hard"):
+    """
+    Combine the outputs of an ensemble with a voting rule.
+
+    :param fit: dict
+        Dictionary with the stacked "predictions", "scores" (None if the
+        models give no probabilities) and "weights" of the ensemble members.
+    :param rule: str or callable, optional
+        "hard", "soft", "weighted", or a callable applied to the stacked
+        predictions (default is "hard").
+    :return: ndarray
+        The ensemble prediction for each sample.
+    """
+    if callable(rule):
+        return rule(fit["predictions"])
+    if rule == "soft" and fit["scores"] is None:
+        raise ValueError("Soft voting needs models with predict_proba")
+    return VOTE_RULES[rule](fit)
+
+
+# Positive class score of the ensemble under every voting rule
+VOTE_SCORES = {
+    "hard": lambda fit: vote_share(fit["predictions"]),
+    "soft": lambda fit: np.asarray(fit["scores"]).mean(axis=0),
+    "weighted": lambda fit: vote_share(fit["predictions"], fit["weights"]),
+}
+
+
+def ensemble_scores(fit, rule="hard"):
+    """
+    Score the positive class of every sample consistently with a voting rule.
+
+    :param fit: dict
+        Dictionary with the stacked "predictions", "scores" and "weights"
+        of the ensemble members.
+    :param rule: str or callable, optional
+        "hard" (share of votes), "soft" (mean probability), "weighted"
+        (weighted share of votes), or a callable (default is "hard").
+    :return: ndarray or None
+        The scores, or None for a callable rule.
+    """
+    if callable(rule):
+        return None
+    return VOTE_SCORES[rule](fit)